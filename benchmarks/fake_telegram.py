@@ -0,0 +1,104 @@
+"""Локальный fake Telegram Bot API для нагрузочных прогонов без сети.
+
+Отвечает на POST /bot<token>/<method> так, как отвечал бы Telegram: sendMessage возвращает Message,
+answerCallbackQuery / deleteMessage / editMessageReplyMarkup — True, getUpdates ждёт timeout и отдаёт [].
+Считает вызовы по методам; --latency-ms добавляет задержку к каждому ответу (как у настоящего API).
+
+Отдельно:  python benchmarks/fake_telegram.py --port 8081
+           TELEGRAM_API_URL=http://127.0.0.1:8081 BOT_TOKEN=1:fake python main.py
+Из кода:   server = FakeTelegramServer(); url = await server.start(); ...; await server.stop()
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+
+from aiohttp import web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+
+class FakeTelegramServer:
+    def __init__(self, latency_ms=0.0, host="127.0.0.1", port=0):
+        self.latency = latency_ms / 1000
+        self.host = host
+        self.port = port
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+        self._runner = None
+
+    async def start(self):
+        """Запустить сервер; возвращает базовый URL для TelegramAPIServer.from_base()."""
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{self.host}:{port}"
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def _message(self, params):
+        chat_id = int(params.get("chat_id", 0))
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+        }
+        if "text" in params:
+            message["text"] = params["text"]
+        if "reply_markup" in params:
+            markup = json.loads(params["reply_markup"])
+            if "inline_keyboard" in markup:
+                message["reply_markup"] = markup
+        return message
+
+    async def _handle(self, request):
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        params = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        name = method.lower()
+        if name == "getme":
+            result = BOT_USER
+        elif name == "getupdates":
+            await asyncio.sleep(min(float(params.get("timeout", 0) or 0), 1.0))
+            result = []
+        elif name in ("sendmessage", "editmessagetext"):
+            result = self._message(params)
+        else:
+            # answerCallbackQuery, deleteMessage, editMessageReplyMarkup, deleteWebhook, setMyCommands, ...
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+
+async def _serve(args):
+    server = FakeTelegramServer(latency_ms=args.latency_ms, host=args.host, port=args.port)
+    url = await server.start()
+    print(f"Fake Bot API on {url}")
+    try:
+        while True:
+            await asyncio.sleep(60)
+            print(json.dumps(dict(server.calls)))
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    try:
+        asyncio.run(_serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
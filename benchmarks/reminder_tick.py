@@ -0,0 +1,237 @@
+"""Бенчмарк тика напоминаний на синтетических пользователях.
+
+Засевает отдельную схему Postgres пользователями (10k / 100k / 1M), прогоняет reminder_tick из main.py
+для каждого сценария и источника (memory — индекс в памяти, sql — get_due_reminders), затем разбирает
+outbox через MessageSender с ботом-заглушкой, который только считает отправки. Сеть не нужна.
+
+Результаты — JSON (по записи на размер × сценарий × источник): время тика, round trip'ы к БД,
+пиковая память Python во время тика (отдельным прогоном под tracemalloc), отправок в секунду.
+Отправки считаются на первых --max-drain сообщениях outbox.
+
+    python benchmarks/reminder_tick.py --database-url postgresql://localhost/bench --sizes 10000,100000 \\
+        --output results.json
+
+Все таблицы создаются в схеме --schema (по умолчанию bench_reminders) и пересоздаются при каждом запуске.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import psycopg
+from psycopg.conninfo import make_conninfo
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Сценарии: SQL-выражения для review_time и timezone_offset (i — номер пользователя) и минута тика (UTC)
+SCENARIOS = {
+    # Все в Москве и все выбрали 21:00 — худший случай: напоминание положено каждому в одну минуту
+    "everyone_2100": {
+        "review_time": "'21:00'",
+        "timezone_offset": "3",
+        "tick_utc": "18:00",
+    },
+    # Время разбора равномерно по суткам — в минуту приходится ~1/1440 пользователей
+    "uniform_review_times": {
+        "review_time": "to_char(make_time((i % 1440) / 60, (i % 1440) % 60, 0), 'HH24:MI')",
+        "timezone_offset": "3",
+        "tick_utc": "18:00",
+    },
+    # Вечерние времена по всем поясам России; в 10:00 UTC ещё и check-in (13:00 МСК) у подписчиков
+    "mixed_timezones": {
+        "review_time": "to_char(make_time(19 + i % 4, (i / 4) % 4 * 15, 0), 'HH24:MI')",
+        "timezone_offset": "2 + i % 11",
+        "tick_utc": "10:00",
+    },
+}
+
+
+class RecordingBot:
+    """Заглушка Bot: считает вызовы, ничего не отправляет."""
+
+    def __init__(self):
+        self.sent = 0
+
+    async def send_message(self, chat_id, **kwargs):
+        self.sent += 1
+
+    async def delete_message(self, chat_id, **kwargs):
+        self.sent += 1
+
+
+async def seed(size, scenario):
+    from db import get_connection, return_connection
+    spec = SCENARIOS[scenario]
+    conn = await get_connection()
+    try:
+        cursor = conn.cursor()
+        await cursor.execute("TRUNCATE users, events, outbox, payments RESTART IDENTITY CASCADE")
+        await cursor.execute(f"""
+            INSERT INTO users (telegram_id, review_time, timezone_offset, subscription_ends_at_d, trial_used, name)
+            SELECT 10000000 + i, {spec['review_time']}, {spec['timezone_offset']},
+                   CASE WHEN i % 2 = 0 THEN current_date + 30 END, i % 2 = 0, 'User ' || i
+            FROM generate_series(1, {int(size)}) AS i
+        """)
+        # Немного событий за сегодня — вечерний разбор выбирает другой текст для таких пользователей
+        await cursor.execute("""
+            INSERT INTO events (user_id, datetime_ts, local_date, text)
+            SELECT id, now(), current_date, 'benchmark' FROM users WHERE id % 10 = 0
+        """)
+        await conn.commit()
+        await cursor.execute("ANALYZE users")
+        await cursor.execute("ANALYZE events")
+        await conn.commit()
+    finally:
+        await return_connection(conn)
+
+
+async def reset_marks():
+    from db import get_connection, return_connection
+    conn = await get_connection()
+    try:
+        cursor = conn.cursor()
+        await cursor.execute("""
+            UPDATE users SET last_review_sent_date = NULL, last_checkin_sent_date = NULL,
+                             last_subscription_expiry_notified_date = NULL
+        """)
+        await cursor.execute("TRUNCATE outbox")
+        await conn.commit()
+    finally:
+        await return_connection(conn)
+
+
+async def drain_outbox(max_messages):
+    """Разобрать outbox ботом-заглушкой (без лимитов Telegram). Возвращает (отправлено, секунды)."""
+    from outbox import OutboxWorkers
+    from sender import MessageSender
+    bot = RecordingBot()
+    sender = MessageSender(bot, workers=8, rate=1_000_000, per_chat_interval=0)
+    sender.start()
+    outbox = OutboxWorkers(sender, batch_size=500)
+    started = time.perf_counter()
+    try:
+        while bot.sent < max_messages and await outbox.process_batch():
+            pass
+    finally:
+        await sender.stop()
+    return bot.sent, time.perf_counter() - started
+
+
+class _Outbox:
+    def notify(self):
+        pass
+
+
+async def tick_once(scenario, source, trace_memory=False):
+    """Сбросить отметки, (для memory) построить индекс и выполнить один тик. tracemalloc заметно
+    замедляет код, поэтому время и память меряются в разных прогонах."""
+    import main
+    from budget import budget_scope
+    from db import get_users_for_scheduler
+
+    hour, minute = map(int, SCENARIOS[scenario]["tick_utc"].split(":"))
+    tick_at = datetime.now(timezone.utc).replace(hour=hour, minute=minute, second=0, microsecond=0)
+    main.REMINDER_SOURCE = source
+    await reset_marks()
+
+    result = {"tick_utc": tick_at.strftime("%H:%M")}
+    if trace_memory:
+        tracemalloc.start()
+    if source == "memory":
+        started = time.perf_counter()
+        main.reminder_scheduler.load(await get_users_for_scheduler(), now_utc=tick_at)
+        result["index_load_seconds"] = round(time.perf_counter() - started, 4)
+        result["index_entries"] = len(main.reminder_scheduler)
+        if trace_memory:
+            result["index_memory_bytes"] = tracemalloc.get_traced_memory()[0]
+    if trace_memory:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+
+    started = time.perf_counter()
+    with budget_scope(f"benchmark:{scenario}:{source}") as scope:
+        result["enqueued"] = await main.reminder_tick(_Outbox(), tick_at)
+    result["tick_seconds"] = round(time.perf_counter() - started, 4)
+    result["db_round_trips"] = scope.round_trips if scope else None
+    result["db_checkouts"] = scope.checkouts if scope else None
+    if trace_memory:
+        result["tick_peak_memory_bytes"] = tracemalloc.get_traced_memory()[1] - baseline
+        tracemalloc.stop()
+    return result
+
+
+async def run_case(size, scenario, source, max_drain, trace_memory):
+    result = {"users": size, "scenario": scenario, "source": source}
+    result.update(await tick_once(scenario, source))
+    sent, send_seconds = await drain_outbox(max_drain)
+    result.update({
+        "sent": sent,
+        "send_seconds": round(send_seconds, 4),
+        "sends_per_second": round(sent / send_seconds, 1) if send_seconds > 0 else None,
+    })
+    if trace_memory:
+        traced = await tick_once(scenario, source, trace_memory=True)
+        result["tick_peak_memory_bytes"] = traced["tick_peak_memory_bytes"]
+        if "index_memory_bytes" in traced:
+            result["index_memory_bytes"] = traced["index_memory_bytes"]
+    return result
+
+
+async def run(args):
+    from db import init_db, close_pool
+    await init_db()
+    results = []
+    try:
+        for size in args.sizes:
+            for scenario in args.scenarios:
+                await seed(size, scenario)
+                for source in args.sources:
+                    result = await run_case(size, scenario, source, args.max_drain, not args.no_memory)
+                    print(json.dumps(result), file=sys.stderr)
+                    results.append(result)
+    finally:
+        await close_pool()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=os.environ.get("BENCH_DATABASE_URL"),
+                        help="Postgres для бенчмарка (или BENCH_DATABASE_URL)")
+    parser.add_argument("--schema", default="bench_reminders")
+    parser.add_argument("--sizes", default="10000,100000,1000000",
+                        type=lambda v: [int(x) for x in v.split(",")])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        type=lambda v: [x for x in v.split(",") if x in SCENARIOS])
+    parser.add_argument("--sources", default="memory,sql", type=lambda v: v.split(","))
+    parser.add_argument("--max-drain", type=int, default=20000,
+                        help="сколько сообщений outbox разобрать для замера отправок в секунду")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="не делать второй прогон под tracemalloc (пиковая память)")
+    parser.add_argument("--output", help="файл для JSON (по умолчанию stdout)")
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error("--database-url or BENCH_DATABASE_URL is required")
+
+    with psycopg.connect(args.database_url, autocommit=True) as conn:
+        conn.execute(f'DROP SCHEMA IF EXISTS "{args.schema}" CASCADE')
+        conn.execute(f'CREATE SCHEMA "{args.schema}"')
+    os.environ["DATABASE_URL"] = make_conninfo(args.database_url, options=f"-c search_path={args.schema}")
+    os.environ.setdefault("DB_BUDGET_MODE", "warn")
+
+    results = asyncio.run(run(args))
+    output = json.dumps({"benchmark": "reminder_tick", "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""Прогон потоков апдейтов через настоящий Dispatcher бота (main.create_dispatcher) без сети.
+
+Bot смотрит на локальный fake Bot API (benchmarks/fake_telegram.py), БД — отдельная схема Postgres.
+Апдейты каждого пользователя идут строго по очереди (FSM), разные пользователи — параллельно:
+для каждого уровня --concurrency одновременно активны столько пользователей. На уровень — свежие
+telegram_id, так что онбординг каждый раз проходит с нуля.
+
+Потоки: сгенерированные сценарии (--scenarios) или записанные апдейты (--updates file.jsonl,
+по объекту Update в строке; update_id переназначаются, порядок внутри пользователя сохраняется).
+
+Результат — JSON: по уровню параллельности апдейтов в секунду, p50/p99 времени обработки апдейта
+(feed_update целиком, включая вызовы fake API), ошибки, вызовы Bot API и разбивка по шагам сценария.
+
+    python benchmarks/replay.py --database-url postgresql://localhost/bench --users 200 \\
+        --concurrency 1,8,32 --output replay.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+
+import psycopg
+from psycopg.conninfo import make_conninfo
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_telegram import FakeTelegramServer, BOT_USER  # noqa: E402
+
+BENCH_TOKEN = "123456:BENCHMARK-TOKEN"
+
+
+def message(text):
+    return ("message", text)
+
+
+def callback(data):
+    return ("callback_query", data)
+
+
+# Шаги сценариев: (имя шага, апдейт). Все сценарии начинаются с онбординга — иначе нет пользователя
+ONBOARDING = [
+    ("start", message("/start")),
+    ("name", message("Аня")),
+    ("gender", callback("gender_yes")),
+    ("review_time", message("21:30")),
+    ("timezone", callback("tz_moscow")),  # заодно включает пробный период
+]
+MOMENT = [
+    ("moment_button", message("📌 Записать момент")),
+    ("moment_text", message("Грызла ногти на созвоне, нервничала из-за дедлайна")),
+]
+REVIEW = MOMENT + MOMENT + [
+    ("review", message("/review")),
+    ("review_answer", message("Скучно и тревожно, руки сами тянулись")),
+    ("review_answer", message("Устала, хотелось отвлечься")),
+]
+TIMEZONE = [
+    ("settings_timezone", message("🌍 Изменить часовой пояс")),
+    ("timezone", callback("tz_yekaterinburg")),
+]
+# Без YOOKASSA_* sub_pay отвечает «оплата недоступна» — внешний API не вызывается
+PAYMENT = [
+    ("subscription", message("💳 Подписка")),
+    ("sub_trial", callback("sub_trial")),
+    ("sub_pay", callback("sub_pay")),
+]
+
+SCENARIOS = {
+    "onboarding": ONBOARDING,
+    "moment": ONBOARDING + MOMENT,
+    "review": ONBOARDING + REVIEW,
+    "timezone": ONBOARDING + TIMEZONE,
+    "payment": ONBOARDING + PAYMENT,
+    "mixed": ONBOARDING + MOMENT + REVIEW + TIMEZONE + PAYMENT,
+}
+
+
+def build_update(kind, payload, tg_id, message_id):
+    """Словарь Update для шага сценария (update_id проставляется при отправке)."""
+    user = {"id": tg_id, "is_bot": False, "first_name": "Bench", "language_code": "ru"}
+    chat = {"id": tg_id, "type": "private", "first_name": "Bench"}
+    now = int(time.time())
+    if kind == "message":
+        return {"message": {"message_id": message_id, "date": now, "chat": chat, "from": user, "text": payload}}
+    return {"callback_query": {
+        "id": str(message_id),
+        "from": user,
+        "chat_instance": str(tg_id),
+        "data": payload,
+        "message": {"message_id": message_id, "date": now, "chat": chat, "from": BOT_USER, "text": "…"},
+    }}
+
+
+def generated_streams(scenarios, users, first_tg_id):
+    """[(tg_id, [(step, update_dict), ...])] — сценарии раздаются пользователям по кругу."""
+    streams = []
+    for i, scenario in zip(range(users), itertools.cycle(scenarios)):
+        tg_id = first_tg_id + i
+        steps = [(name, build_update(kind, payload, tg_id, n + 1))
+                 for n, (name, (kind, payload)) in enumerate(SCENARIOS[scenario])]
+        streams.append((tg_id, steps))
+    return streams
+
+
+def recorded_streams(path, first_tg_id):
+    """Записанные апдейты, сгруппированные по отправителю. telegram_id сдвигаются, чтобы уровни
+    не пересекались; шаг — тип апдейта и команда/callback_data."""
+    by_user = defaultdict(list)
+    id_map = {}
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            update = json.loads(line)
+            update.pop("update_id", None)
+            kind = "message" if "message" in update else "callback_query" if "callback_query" in update else None
+            if kind is None:
+                continue
+            event = update[kind]
+            original = event["from"]["id"]
+            tg_id = id_map.setdefault(original, first_tg_id + len(id_map))
+            event["from"]["id"] = tg_id
+            chat = event["chat"] if kind == "message" else event.get("message", {}).get("chat")
+            if chat is not None:
+                chat["id"] = tg_id
+            label = event.get("text", "") if kind == "message" else event.get("data", "")
+            step = f"{kind}:{label.split()[0] if label.startswith('/') else label.split('_')[0]}"
+            by_user[tg_id].append((step, update))
+    return list(by_user.items())
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(p * (len(sorted_values) - 1))))]
+
+
+def summarize(latencies):
+    values = sorted(latencies)
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 0.50) * 1000, 2) if values else None,
+        "p99_ms": round(percentile(values, 0.99) * 1000, 2) if values else None,
+        "max_ms": round(values[-1] * 1000, 2) if values else None,
+    }
+
+
+async def run_level(dp, bot, streams, concurrency, update_ids):
+    from aiogram.types import Update
+
+    latencies = []
+    by_step = defaultdict(list)
+    errors = Counter()
+    queue = asyncio.Queue()
+    for stream in streams:
+        queue.put_nowait(stream)
+
+    async def worker():
+        while not queue.empty():
+            _, steps = queue.get_nowait()
+            for step, data in steps:
+                update = Update.model_validate({"update_id": next(update_ids), **data}, context={"bot": bot})
+                started = time.perf_counter()
+                try:
+                    await dp.feed_update(bot, update)
+                except Exception as e:
+                    errors[type(e).__name__] += 1
+                elapsed = time.perf_counter() - started
+                latencies.append(elapsed)
+                by_step[step].append(elapsed)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    seconds = time.perf_counter() - started
+    result = {
+        "concurrency": concurrency,
+        "users": len(streams),
+        "updates": len(latencies),
+        "seconds": round(seconds, 3),
+        "updates_per_second": round(len(latencies) / seconds, 1) if seconds > 0 else None,
+        **summarize(latencies),
+        "errors": dict(errors),
+        "steps": {step: summarize(values) for step, values in sorted(by_step.items())},
+    }
+    return result
+
+
+async def run(args):
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    import main
+    from db import init_db, close_pool
+
+    await init_db()
+    server = FakeTelegramServer(latency_ms=args.api_latency_ms)
+    url = await server.start()
+    bot = Bot(token=BENCH_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(url)))
+    bot.session.middleware(main.TelegramTracingMiddleware())
+    dp = main.create_dispatcher()
+    update_ids = itertools.count(1)
+    results = []
+    try:
+        for level, concurrency in enumerate(args.concurrency):
+            first_tg_id = 900_000_000 + level * 1_000_000
+            if args.updates:
+                streams = recorded_streams(args.updates, first_tg_id)
+            else:
+                streams = generated_streams(args.scenarios, args.users, first_tg_id)
+            server.calls.clear()
+            result = await run_level(dp, bot, streams, concurrency, update_ids)
+            result["bot_api_calls"] = dict(server.calls)
+            print(json.dumps({k: v for k, v in result.items() if k != "steps"}), file=sys.stderr)
+            results.append(result)
+    finally:
+        await bot.session.close()
+        await server.stop()
+        await close_pool()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=os.environ.get("BENCH_DATABASE_URL"),
+                        help="Postgres для прогона (или BENCH_DATABASE_URL)")
+    parser.add_argument("--schema", default="bench_replay")
+    parser.add_argument("--users", type=int, default=200, help="пользователей на уровень параллельности")
+    parser.add_argument("--concurrency", default="1,4,16,64", type=lambda v: [int(x) for x in v.split(",")])
+    parser.add_argument("--scenarios", default="mixed",
+                        type=lambda v: [x for x in v.split(",") if x in SCENARIOS],
+                        help=f"через запятую: {', '.join(SCENARIOS)}")
+    parser.add_argument("--updates", help="JSONL с записанными апдейтами вместо сценариев")
+    parser.add_argument("--api-latency-ms", type=float, default=0.0, help="задержка ответа fake Bot API")
+    parser.add_argument("--output", help="файл для JSON (по умолчанию stdout)")
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error("--database-url or BENCH_DATABASE_URL is required")
+    if not args.scenarios and not args.updates:
+        parser.error("no known scenarios given")
+
+    with psycopg.connect(args.database_url, autocommit=True) as conn:
+        conn.execute(f'DROP SCHEMA IF EXISTS "{args.schema}" CASCADE')
+        conn.execute(f'CREATE SCHEMA "{args.schema}"')
+    os.environ["DATABASE_URL"] = make_conninfo(args.database_url, options=f"-c search_path={args.schema}")
+    # Лог медленных апдейтов под нагрузкой только мешает замеру; оплата — без внешнего API
+    os.environ.setdefault("SLOW_UPDATE_MS", "60000")
+    os.environ.pop("YOOKASSA_SHOP_ID", None)
+    os.environ.pop("YOOKASSA_SECRET_KEY", None)
+
+    results = asyncio.run(run(args))
+    output = json.dumps({"benchmark": "replay", "results": results}, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import functools
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import psycopg
+
+# --- Бюджет обращений к БД ---
+# Считаем, сколько раз код ходил в Postgres: выдачи соединений из пула (checkouts) и сетевые
+# round trip'ы (execute, commit, rollback). Хендлеры, тик напоминаний и API объявляют бюджет
+# через @round_trip_budget(n) или budget_scope(name, n); превышение — признак N+1 или лишних
+# перечитываний. DB_BUDGET_MODE: warn (по умолчанию, строка в лог), raise (для тестов/CI), off.
+
+DB_BUDGET_MODE = os.environ.get("DB_BUDGET_MODE", "warn").lower()
+
+_current_scope = ContextVar("db_budget_scope", default=None)
+
+
+class RoundTripBudgetExceeded(AssertionError):
+    pass
+
+
+class BudgetScope:
+    __slots__ = ("name", "limit", "checkouts", "round_trips", "parent")
+
+    def __init__(self, name, limit, parent=None):
+        self.name = name
+        self.limit = limit
+        self.checkouts = 0
+        self.round_trips = 0
+        self.parent = parent
+
+
+def _count(checkouts=0, round_trips=0):
+    scope = _current_scope.get()
+    # Вложенные области (хендлер вызывает другой хендлер) учитываются и во внешней
+    while scope is not None:
+        scope.checkouts += checkouts
+        scope.round_trips += round_trips
+        scope = scope.parent
+
+
+def count_checkout():
+    _count(checkouts=1)
+
+
+def current_scope():
+    return _current_scope.get()
+
+
+@contextmanager
+def budget_scope(name, limit=None):
+    """Область подсчёта; limit — допустимое число round trip'ов (None — только считать)."""
+    if DB_BUDGET_MODE == "off":
+        yield None
+        return
+    scope = BudgetScope(name, limit, parent=_current_scope.get())
+    token = _current_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _current_scope.reset(token)
+    if limit is not None and scope.round_trips > limit:
+        message = (f"DB budget exceeded in {name}: {scope.round_trips} round trips "
+                   f"(limit {limit}), {scope.checkouts} pool checkouts")
+        if DB_BUDGET_MODE == "raise":
+            raise RoundTripBudgetExceeded(message)
+        print(message)
+
+
+@contextmanager
+def uncounted():
+    """Служебные обращения (проверка соединения пулом) не относятся к коду хендлера и не считаются."""
+    token = _current_scope.set(None)
+    try:
+        yield
+    finally:
+        _current_scope.reset(token)
+
+
+def round_trip_budget(limit, name=None):
+    """Декоратор async-функции: не больше limit round trip'ов к БД за один вызов."""
+    def decorator(func):
+        scope_name = name or func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with budget_scope(scope_name, limit):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# --- Подсчёт на уровне psycopg (подключается в пул db.py) ---
+class CountingCursor(psycopg.AsyncCursor):
+    async def execute(self, query, params=None, **kwargs):
+        _count(round_trips=1)
+        return await super().execute(query, params, **kwargs)
+
+    async def executemany(self, query, params_seq, **kwargs):
+        _count(round_trips=1)
+        return await super().executemany(query, params_seq, **kwargs)
+
+
+class CountingConnection(psycopg.AsyncConnection):
+    async def commit(self):
+        _count(round_trips=1)
+        return await super().commit()
+
+    async def rollback(self):
+        _count(round_trips=1)
+        return await super().rollback()
@@ -0,0 +1,60 @@
+import asyncio
+import os
+import secrets
+import socket
+
+from db import cluster_heartbeat, leave_cluster
+from metrics import REMINDER_SHARDS_OWNED
+
+# --- Несколько реплик бота ---
+# Пользователи делятся на shards частей по users.id % shards. Каждая живая реплика раз в heartbeat_interval
+# продлевает аренду своих шардов в Postgres (reminder_shards) и занимает свободные до справедливой доли,
+# лишние отдаёт — при появлении/падении реплики шарды перераспределяются за один-два heartbeat.
+# Упавшая реплика теряет шарды, когда истекает lease_seconds. Владение проверяется в самом запросе
+# напоминаний (get_due_reminders), а outbox не вставит одно напоминание дважды (idempotency_key),
+# поэтому два узла не отправят одно и то же даже в момент передачи шарда.
+
+
+class ClusterMember:
+    def __init__(self, shards, heartbeat_interval=10, lease_seconds=30, node_id=None):
+        self.shards = shards
+        self.heartbeat_interval = heartbeat_interval
+        self.lease_seconds = lease_seconds
+        self.node_id = node_id or f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(3)}"
+        self.owned = []
+        self._task = None
+
+    async def heartbeat(self):
+        owned = await cluster_heartbeat(self.node_id, self.shards, self.lease_seconds)
+        if owned != self.owned:
+            print(f"Cluster node {self.node_id}: reminder shards {owned} of {self.shards}")
+        self.owned = owned
+        REMINDER_SHARDS_OWNED.set(len(owned))
+        return owned
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        try:
+            await leave_cluster(self.node_id)
+        except Exception as e:
+            print(f"Cluster leave error: {e}")
+        self.owned = []
+        REMINDER_SHARDS_OWNED.set(0)
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.heartbeat()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Аренда истечёт сама; другие узлы заберут шарды, если мы не восстановимся
+                print(f"Cluster heartbeat error: {e}")
+            await asyncio.sleep(self.heartbeat_interval)
@@ -1,37 +1,53 @@
 
 import os
+import time
+import asyncio
+import weakref
+import functools
+from collections import OrderedDict
+from dataclasses import dataclass, fields, replace
 import psycopg
-try:
-    from psycopg_pool import ConnectionPool
-except ImportError:
-    # Fallback if pool package not available
-    from psycopg import pool
-    ConnectionPool = pool.ConnectionPool
-from datetime import datetime, date
+from psycopg.types.json import Jsonb
+from psycopg_pool import AsyncConnectionPool
+
+from metrics import (
+    DB_QUERY_DURATION, DB_ERRORS, DB_POOL_CONNECTIONS, DB_POOL_WAITING, USER_CACHE_ENTRIES, USER_CACHE_LOOKUPS,
+    REGISTRY,
+)
+from tracing import record_db, record_pool_wait
+from budget import CountingConnection, CountingCursor, count_checkout, uncounted
+from datetime import datetime, date, time as dt_time, timedelta, timezone
 
 # --- Подключение к базе ---
 # Get DATABASE_URL from environment variable (Railway provides this)
 # Don't check at import time - check when actually using the database
 
-# Connection pool for better performance
+# Асинхронный пул соединений: запросы не блокируют event loop aiogram/aiohttp
+# DB_POOL_MIN_SIZE / DB_POOL_MAX_SIZE — размер пула, DB_POOL_MAX_WAITING — сколько запросов может ждать
+# свободное соединение (остальные сразу получают ошибку), DB_CHECK_IDLE_SECONDS — соединение,
+# простоявшее без дела дольше этого, перед выдачей проверяется пулом (check); свежие выдаются без проверки.
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_MAX_WAITING = int(os.environ.get("DB_POOL_MAX_WAITING", "10"))
+DB_CHECK_IDLE_SECONDS = float(os.environ.get("DB_CHECK_IDLE_SECONDS", "30"))
+
 connection_pool = None
-_db_initialized = False
+_last_used = weakref.WeakKeyDictionary()  # соединение -> time.monotonic() последнего возврата в пул
 
 
-def _reset_pool_on_connection_error():
-    """Закрывает пул при ошибке соединения (SSL/EOF), чтобы следующие запросы создали новые соединения."""
-    global connection_pool
-    if connection_pool is not None:
-        try:
-            connection_pool.close()
-        except Exception:
-            pass
-        connection_pool = None
+async def _check_idle_connection(conn):
+    """check-callback пула: проверяем только долго простаивавшие соединения (их мог закрыть сервер/прокси).
+    Исключение — пул выбрасывает это соединение и выдаёт другое; остальные соединения не трогаются."""
+    last_used = _last_used.get(conn)
+    if last_used is not None and time.monotonic() - last_used < DB_CHECK_IDLE_SECONDS:
+        return
+    with uncounted():
+        await AsyncConnectionPool.check_connection(conn)
 
 
-def get_connection(timeout=60, _retry_after_fail=False):
-    """Get a connection from the pool. _retry_after_fail — только для внутренней повторной попытки."""
-    global connection_pool, _db_initialized
+async def get_connection(timeout=60):
+    """Get a connection from the pool."""
+    global connection_pool
     
     DATABASE_URL = os.environ.get("DATABASE_URL")
     if not DATABASE_URL:
@@ -41,101 +57,234 @@ def get_connection(timeout=60, _retry_after_fail=False):
         )
     
     if connection_pool is None:
-        connection_pool = ConnectionPool(
+        connection_pool = AsyncConnectionPool(
             DATABASE_URL,
-            min_size=1,
-            max_size=10,
+            open=False,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=max(DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE),
             timeout=60,
             reconnect_timeout=5,
-            max_waiting=10,
+            max_waiting=DB_POOL_MAX_WAITING,
             max_idle=120,   # 2 мин — меньше шанс получить «мёртвое» соединение (SSL EOF)
             max_lifetime=600,  # 10 мин
+            check=_check_idle_connection,
+            # Счётчики round trip'ов для бюджета обращений к БД (budget.py)
+            connection_class=CountingConnection,
+            kwargs={"cursor_factory": CountingCursor},
         )
+    if connection_pool.closed:
+        # Повторный open() у уже открытого пула ничего не делает — гонка между корутинами безопасна
+        await connection_pool.open()
     
-    if not _db_initialized:
-        try:
-            temp_conn = connection_pool.getconn(timeout=30)
-            try:
-                _init_db_with_connection(temp_conn)
-                _db_initialized = True
-            finally:
-                return_connection(temp_conn)
-        except Exception:
-            pass
-    
-    return _get_connection_checked(timeout, allow_retry=not _retry_after_fail)
+    started = time.perf_counter()
+    conn = await connection_pool.getconn(timeout=timeout)
+    record_pool_wait(time.perf_counter() - started)
+    count_checkout()
+    return conn
 
 
-def _get_connection_checked(timeout, allow_retry=True):
-    """Проверка соединения (SELECT 1). При сбое — одна повторная попытка через новый пул."""
-    conn = connection_pool.getconn(timeout=timeout)
-    try:
-        cur = conn.cursor()
-        cur.execute("SELECT 1")
-        cur.close()
-        return conn
-    except Exception:
-        try:
-            if not conn.closed:
-                conn.close()
-        except Exception:
-            pass
-        _reset_pool_on_connection_error()
-        if allow_retry:
-            return get_connection(timeout=timeout, _retry_after_fail=True)
-        raise
-
-
-def return_connection(conn):
-    """Return connection to the pool. При ошибке (SSL/EOF) закрывает соединение и сбрасывает пул."""
+async def return_connection(conn):
+    """Return connection to the pool. Битое соединение (SSL/EOF) закрываем — пул заменит только его."""
     if conn is None:
         return
     
     try:
-        if conn.closed:
-            return
-        if conn.info.transaction_status != 0:
-            conn.rollback()
+        if not conn.closed and conn.info.transaction_status != 0:
+            await conn.rollback()
     except Exception:
-        # Соединение битое (SSL error, unexpected eof) — закрываем и сбрасываем весь пул
         try:
-            if not conn.closed:
-                conn.close()
+            await conn.close()
         except Exception:
             pass
-        _reset_pool_on_connection_error()
-        return
     
+    _last_used[conn] = time.monotonic()
     try:
-        if conn.closed:
-            return
-        connection_pool.putconn(conn)
+        # Закрытое соединение пул не возвращает в оборот, а открывает вместо него новое
+        await connection_pool.putconn(conn)
     except Exception:
         try:
-            if not conn.closed:
-                conn.close()
+            await conn.close()
         except Exception:
             pass
-        _reset_pool_on_connection_error()
 
-def close_pool():
+
+def get_pool_stats():
+    """Состояние пула (pool_size, pool_available, requests_waiting, ...) или {} до первого подключения."""
+    if connection_pool is None:
+        return {}
+    return connection_pool.get_stats()
+
+@REGISTRY.on_collect
+def _collect_pool_metrics():
+    stats = get_pool_stats()
+    if not stats:
+        return
+    DB_POOL_CONNECTIONS.set(stats["pool_size"] - stats["pool_available"], state="in_use")
+    DB_POOL_CONNECTIONS.set(stats["pool_available"], state="idle")
+    DB_POOL_WAITING.set(stats["requests_waiting"])
+
+
+def instrumented(func):
+    """Метрики функции доступа к БД: число вызовов и время (bot_db_query_duration_seconds), ошибки;
+    вызов также записывается в span текущего апдейта (tracing)."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            DB_ERRORS.inc(function=name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            DB_QUERY_DURATION.observe(elapsed, function=name)
+            record_db(name, elapsed)
+    return wrapper
+
+
+async def close_pool():
     """Закрывает пул соединений при остановке приложения."""
     global connection_pool
     if connection_pool:
+        pool, connection_pool = connection_pool, None
         try:
-            connection_pool.close()
+            await pool.close()
         except Exception:
             pass
-        connection_pool = None
 
 
-# --- Инициализация базы ---
-def _init_db_with_connection(conn):
-    """Внутренняя функция инициализации БД с уже полученным соединением."""
-    cursor = conn.cursor()
-    
-    # Create users table
-    cursor.execute("""
+# --- Запись пользователя ---
+# Явный список колонок вместо SELECT *: порядок колонок в таблице зависит от того,
+# в каком порядке когда-то выполнялись ALTER TABLE, а здесь он фиксирован.
+@dataclass(frozen=True, slots=True)
+class UserRecord:
+    id: int
+    telegram_id: int
+    current_streak: int
+    max_streak: int
+    last_clean_day: date | None
+    review_time: str | None
+    timezone_offset: int | None
+    created_at: datetime | None
+    name: str | None
+    is_female: bool | None
+    subscription_ends_at: date | None
+    trial_used: bool | None
+
+
+# Штамп версии данных мини-приложения (ETag /api/user и /api/events). timezone_offset — чтобы
+# get_user_local_date принимал штамп так же, как UserRecord.
+@dataclass(frozen=True, slots=True)
+class WebAppStamp:
+    user_id: int
+    api_version: int
+    last_event_id: int | None
+    timezone_offset: int | None
+
+
+# Поля UserRecord, колонки которых называются иначе: типизированные даты (миграции 6–8). Старые
+# VARCHAR-колонки с этими именами остаются для реплик прошлого релиза до contract-шага 14.
+USER_COLUMN_NAMES = {
+    "last_clean_day": "last_clean_day_d",
+    "created_at": "created_at_ts",
+    "subscription_ends_at": "subscription_ends_at_d",
+}
+USER_COLUMNS = ", ".join(USER_COLUMN_NAMES.get(f.name, f.name) for f in fields(UserRecord))
+
+
+def _user_columns(alias):
+    return ", ".join(f"{alias}.{USER_COLUMN_NAMES.get(f.name, f.name)}" for f in fields(UserRecord))
+
+
+# --- Кэш строк пользователей ---
+# Один update часто читает пользователя 2–3 раза (start, save_name, выбор пояса, send_paywall).
+# LRU+TTL кэш по telegram_id и id; все set_* обновляют строку в кэше (write-through) или сбрасывают её.
+# TTL ограничивает устаревание, если пользователя меняет другой процесс.
+class UserCache:
+    def __init__(self, maxsize=10000, ttl=30.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._rows = OrderedDict()  # id -> (expires_at, UserRecord)
+        self._ids_by_tg = {}        # telegram_id -> id
+
+    def get(self, user_id=None, tg_id=None):
+        if user_id is None:
+            user_id = self._ids_by_tg.get(tg_id)
+        entry = self._rows.get(user_id) if user_id is not None else None
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self.invalidate(user_id)
+            self.misses += 1
+            USER_CACHE_LOOKUPS.inc(result="miss")
+            return None
+        self._rows.move_to_end(user_id)
+        self.hits += 1
+        USER_CACHE_LOOKUPS.inc(result="hit")
+        return entry[1]
+
+    def put(self, row):
+        if self.maxsize <= 0 or not row:
+            return
+        user_id, tg_id = row.id, row.telegram_id
+        self._rows[user_id] = (time.monotonic() + self.ttl, row)
+        self._rows.move_to_end(user_id)
+        self._ids_by_tg[tg_id] = user_id
+        while len(self._rows) > self.maxsize:
+            _, (_, old_row) = self._rows.popitem(last=False)
+            self._ids_by_tg.pop(old_row.telegram_id, None)
+
+    def update(self, user_id, **changes):
+        """Write-through: поменять значения полей в закэшированной записи (без продления TTL)."""
+        entry = self._rows.get(user_id)
+        if entry is None:
+            return
+        self._rows[user_id] = (entry[0], replace(entry[1], **changes))
+
+    def invalidate(self, user_id=None, tg_id=None):
+        if user_id is None:
+            user_id = self._ids_by_tg.get(tg_id)
+        entry = self._rows.pop(user_id, None) if user_id is not None else None
+        if entry is not None:
+            self._ids_by_tg.pop(entry[1].telegram_id, None)
+        if tg_id is not None:
+            self._ids_by_tg.pop(tg_id, None)
+
+    def invalidate_many(self, user_ids):
+        for user_id in user_ids:
+            self.invalidate(user_id)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._rows),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+user_cache = UserCache(
+    maxsize=int(os.environ.get("USER_CACHE_SIZE", "10000")),
+    ttl=float(os.environ.get("USER_CACHE_TTL", "30")),
+)
+
+
+@REGISTRY.on_collect
+def _collect_user_cache_metrics():
+    USER_CACHE_ENTRIES.set(user_cache.stats()["size"])
+
+
+# --- Миграции схемы ---
+# Каждый шаг применяется ровно один раз; номер последнего примененного хранится в schema_version.
+# Шаги написаны идемпотентно (IF NOT EXISTS), чтобы базы, созданные до появления schema_version,
+# прошли их без ошибок. Новые изменения схемы — только новым шагом в конце списка.
+MIGRATIONS = [
+    (1, "base schema", [
+        """
         CREATE TABLE IF NOT EXISTS users (
             id SERIAL PRIMARY KEY,
             telegram_id BIGINT UNIQUE NOT NULL,
@@ -147,100 +296,32 @@ def _init_db_with_connection(conn):
             created_at VARCHAR(50),
             name VARCHAR(100)
         )
-    """)
-    
-    # Add timezone_offset column if it doesn't exist (for existing databases)
-    cursor.execute("""
-            DO $$ 
-            BEGIN
-                IF NOT EXISTS (
-                    SELECT 1 FROM information_schema.columns 
-                    WHERE table_name='users' AND column_name='timezone_offset'
-                ) THEN
-                    ALTER TABLE users ADD COLUMN timezone_offset INTEGER DEFAULT 3;
-                    UPDATE users SET timezone_offset = 3 WHERE timezone_offset IS NULL;
-                END IF;
-            END $$;
-    """)
-
-    # Add name column if it doesn't exist (for existing databases)
-    cursor.execute("""
-        DO $$ 
-        BEGIN
-            IF NOT EXISTS (
-                SELECT 1 FROM information_schema.columns 
-                WHERE table_name='users' AND column_name='name'
-            ) THEN
-                ALTER TABLE users ADD COLUMN name VARCHAR(100);
-            END IF;
-        END $$;
-    """)
-
-    # Add is_female column if it doesn't exist (for feminine endings in messages)
-    cursor.execute("""
-        DO $$ 
-        BEGIN
-            IF NOT EXISTS (
-                SELECT 1 FROM information_schema.columns 
-                WHERE table_name='users' AND column_name='is_female'
-            ) THEN
-                ALTER TABLE users ADD COLUMN is_female BOOLEAN;
-            END IF;
-        END $$;
-    """)
-
-    # Subscription: end date (inclusive), trial used once
-    cursor.execute("""
-        DO $$ 
-        BEGIN
-            IF NOT EXISTS (
-                SELECT 1 FROM information_schema.columns 
-                WHERE table_name='users' AND column_name='subscription_ends_at'
-            ) THEN
-                ALTER TABLE users ADD COLUMN subscription_ends_at VARCHAR(10);
-            END IF;
-        END $$;
-    """)
-    cursor.execute("""
-        DO $$ 
-        BEGIN
-            IF NOT EXISTS (
-                SELECT 1 FROM information_schema.columns 
-                WHERE table_name='users' AND column_name='trial_used'
-            ) THEN
-                ALTER TABLE users ADD COLUMN trial_used BOOLEAN DEFAULT FALSE;
-            END IF;
-        END $$;
-    """)
-    
-    # Add last_checkin_sent_date column to track when check-in notification was sent
-    cursor.execute("""
-        DO $$ 
-        BEGIN
-            IF NOT EXISTS (
-                SELECT 1 FROM information_schema.columns 
-                WHERE table_name='users' AND column_name='last_checkin_sent_date'
-            ) THEN
-                ALTER TABLE users ADD COLUMN last_checkin_sent_date VARCHAR(10);
-            END IF;
-        END $$;
-    """)
-    
-    # Add last_subscription_expiry_notified_date to track subscription expiry notifications
-    cursor.execute("""
-        DO $$ 
-        BEGIN
-            IF NOT EXISTS (
-                SELECT 1 FROM information_schema.columns 
-                WHERE table_name='users' AND column_name='last_subscription_expiry_notified_date'
-            ) THEN
-                ALTER TABLE users ADD COLUMN last_subscription_expiry_notified_date VARCHAR(10);
-            END IF;
-        END $$;
-    """)
-
-    # Payments table for YooKassa: link payment_id -> user_id (webhook)
-    cursor.execute("""
+        """,
+        # Columns added over time to existing databases
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS timezone_offset INTEGER DEFAULT 3",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS name VARCHAR(100)",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS is_female BOOLEAN",
+        # Subscription: end date (inclusive), trial used once
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS subscription_ends_at VARCHAR(10)",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS trial_used BOOLEAN DEFAULT FALSE",
+        # When the check-in / subscription expiry notifications were last sent
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS last_checkin_sent_date VARCHAR(10)",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS last_subscription_expiry_notified_date VARCHAR(10)",
+        """
+        CREATE TABLE IF NOT EXISTS events (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            datetime VARCHAR(50),
+            text TEXT,
+            analysis TEXT,
+            analyzed INTEGER DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_users_telegram_id ON users(telegram_id)",
+        "CREATE INDEX IF NOT EXISTS idx_events_user_datetime ON events(user_id, datetime)",
+        # Payments table for YooKassa: link payment_id -> user_id (webhook)
+        """
         CREATE TABLE IF NOT EXISTS payments (
             id SERIAL PRIMARY KEY,
             user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
@@ -249,384 +330,1456 @@ def _init_db_with_connection(conn):
             status VARCHAR(20) DEFAULT 'pending',
             created_at VARCHAR(50) NOT NULL
         )
-    """)
-    cursor.execute("""
-        CREATE INDEX IF NOT EXISTS idx_payments_yookassa_id ON payments(yookassa_payment_id);
-    """)
-    cursor.execute("""
-        DO $$ 
-        BEGIN
-            IF NOT EXISTS (
-                SELECT 1 FROM information_schema.columns 
-                WHERE table_name='payments' AND column_name='telegram_message_id'
-            ) THEN
-                ALTER TABLE payments ADD COLUMN telegram_message_id INTEGER;
-            END IF;
-        END $$;
-    """)
-    cursor.execute("""
-        DO $$ 
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_payments_yookassa_id ON payments(yookassa_payment_id)",
+        "ALTER TABLE payments ADD COLUMN IF NOT EXISTS telegram_message_id INTEGER",
+    ]),
+    (2, "payments: amount_cents -> amount_rub", [
+        # Old databases stored kopecks in amount_cents; convert once, together with the rename
+        """
+        DO $$
         BEGIN
             IF EXISTS (
-                SELECT 1 FROM information_schema.columns 
+                SELECT 1 FROM information_schema.columns
                 WHERE table_name='payments' AND column_name='amount_cents'
             ) THEN
                 ALTER TABLE payments RENAME COLUMN amount_cents TO amount_rub;
+                UPDATE payments SET amount_rub = amount_rub / 100 WHERE amount_rub > 1000;
             END IF;
         END $$;
-    """)
-    cursor.execute("""
-        UPDATE payments SET amount_rub = amount_rub / 100 WHERE amount_rub > 1000
-    """)
-
-    # Create events table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS events (
-            id SERIAL PRIMARY KEY,
-            user_id INTEGER NOT NULL,
-            datetime VARCHAR(50),
-            text TEXT,
-            analysis TEXT,
-            analyzed INTEGER DEFAULT 0,
-            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        """,
+    ]),
+    (3, "reminder bookkeeping", [
+        # The evening review reminder is sent at most once per local day
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS last_review_sent_date VARCHAR(10)",
+        # Indexes for get_due_reminders: (timezone, review time) slot lookup and
+        # (timezone, subscription end) for the check-in / expiry notices
+        """
+        CREATE INDEX IF NOT EXISTS idx_users_review_slot ON users(timezone_offset, review_time)
+        WHERE review_time IS NOT NULL
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_users_tz_subscription ON users(timezone_offset, subscription_ends_at)",
+    ]),
+    (4, "keyboard broadcast state", [
+        # Hash of the main keyboard layout last delivered to the user
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS keyboard_fingerprint VARCHAR(16)",
+        # Key-value state of background jobs (e.g. keyboard broadcast checkpoint)
+        """
+        CREATE TABLE IF NOT EXISTS bot_state (
+            key VARCHAR(50) PRIMARY KEY,
+            value TEXT,
+            updated_at VARCHAR(50)
         )
-    """)
-    
-    # Create index on telegram_id for faster lookups
-    cursor.execute("""
-        CREATE INDEX IF NOT EXISTS idx_users_telegram_id ON users(telegram_id);
-    """)
-    
-    # Create index on user_id and datetime for events
-    cursor.execute("""
-        CREATE INDEX IF NOT EXISTS idx_events_user_datetime ON events(user_id, datetime);
-    """)
+        """,
+    ]),
+    (5, "outbox", [
+        # Every outgoing notification is written here in the same transaction as its
+        # "already sent" mark, then delivered by outbox workers (FOR UPDATE SKIP LOCKED)
+        """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id BIGSERIAL PRIMARY KEY,
+            idempotency_key VARCHAR(200) UNIQUE NOT NULL,
+            chat_id BIGINT NOT NULL,
+            method VARCHAR(30) NOT NULL,
+            payload JSONB NOT NULL,
+            priority SMALLINT NOT NULL DEFAULT 1,
+            status VARCHAR(10) NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            last_error TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            sent_at TIMESTAMPTZ
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_outbox_ready ON outbox(priority, next_attempt_at)
+        WHERE status IN ('pending', 'sending')
+        """,
+    ]),
+    # Типизированные даты без долгих блокировок (expand/contract): теневые колонки timestamptz/date
+    # рядом со старыми VARCHAR -> пакетный backfill -> синхронизация в обе стороны, пока работают реплики
+    # прошлого релиза -> удаление старых колонок (шаг 14, только по DB_CONTRACT_MIGRATIONS).
+    # Код читает и пишет только типизированные колонки; старые реплики — только строковые.
+    (6, "typed dates: shadow columns", [
+        # STABLE, не IMMUTABLE: приведение строки зависит от TimeZone и DateStyle сессии
+        """
+        CREATE OR REPLACE FUNCTION legacy_ts(v TEXT) RETURNS TIMESTAMPTZ AS $$
+        BEGIN
+            IF v IS NULL OR v !~ '^[0-9]{4}-[0-9]{2}-[0-9]{2}' THEN
+                RETURN NULL;
+            END IF;
+            -- isoformat() без смещения писался по времени сервера, то есть UTC
+            IF v ~ '[T ].*(Z|[+-][0-9]{2}:?[0-9]{2})$' THEN
+                RETURN v::timestamptz;
+            END IF;
+            RETURN v::timestamp AT TIME ZONE 'UTC';
+        EXCEPTION WHEN others THEN
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql STABLE
+        """,
+        """
+        CREATE OR REPLACE FUNCTION legacy_date(v TEXT) RETURNS DATE AS $$
+        BEGIN
+            RETURN v::date;
+        EXCEPTION WHEN others THEN
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql STABLE
+        """,
+        "ALTER TABLE events ADD COLUMN IF NOT EXISTS datetime_ts TIMESTAMPTZ",
+        "ALTER TABLE events ADD COLUMN IF NOT EXISTS local_date DATE",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS created_at_ts TIMESTAMPTZ",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS last_clean_day_d DATE",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS subscription_ends_at_d DATE",
+        # Индексы строятся сейчас, пока колонки пустые, — без долгого CREATE INDEX на заполненной таблице
+        "CREATE INDEX IF NOT EXISTS idx_events_user_datetime_ts ON events(user_id, datetime_ts)",
+        "CREATE INDEX IF NOT EXISTS idx_events_user_local_date ON events(user_id, local_date)",
+        "CREATE INDEX IF NOT EXISTS idx_events_datetime_ts ON events(datetime_ts)",
+        "CREATE INDEX IF NOT EXISTS idx_users_created_at_ts ON users(created_at_ts)",
+        "CREATE INDEX IF NOT EXISTS idx_users_tz_subscription_d ON users(timezone_offset, subscription_ends_at_d)",
+        """
+        CREATE OR REPLACE FUNCTION events_sync_typed() RETURNS trigger AS $$
+        BEGIN
+            NEW.datetime_ts := legacy_ts(NEW.datetime);
+            NEW.local_date := ((NEW.datetime_ts AT TIME ZONE 'UTC') + make_interval(hours => COALESCE(
+                (SELECT timezone_offset FROM users WHERE id = NEW.user_id), 3)))::date;
+            RETURN NEW;
+        END $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE OR REPLACE FUNCTION users_sync_typed() RETURNS trigger AS $$
+        BEGIN
+            NEW.created_at_ts := legacy_ts(NEW.created_at);
+            NEW.last_clean_day_d := legacy_date(NEW.last_clean_day);
+            NEW.subscription_ends_at_d := legacy_date(NEW.subscription_ends_at);
+            RETURN NEW;
+        END $$ LANGUAGE plpgsql
+        """,
+        "DROP TRIGGER IF EXISTS events_sync_typed ON events",
+        """
+        CREATE TRIGGER events_sync_typed BEFORE INSERT OR UPDATE OF datetime ON events
+        FOR EACH ROW EXECUTE FUNCTION events_sync_typed()
+        """,
+        "DROP TRIGGER IF EXISTS users_sync_typed ON users",
+        """
+        CREATE TRIGGER users_sync_typed BEFORE INSERT OR UPDATE OF created_at, last_clean_day, subscription_ends_at
+        ON users FOR EACH ROW EXECUTE FUNCTION users_sync_typed()
+        """,
+    ]),
+    (7, "typed dates: backfill", [
+        lambda conn: _backfill_in_batches(conn, "users", """
+            UPDATE users SET created_at_ts = legacy_ts(created_at),
+                             last_clean_day_d = legacy_date(last_clean_day),
+                             subscription_ends_at_d = legacy_date(subscription_ends_at)
+            WHERE id >= %s AND id < %s
+        """),
+        lambda conn: _backfill_in_batches(conn, "events", """
+            UPDATE events e SET datetime_ts = legacy_ts(e.datetime),
+                                local_date = ((legacy_ts(e.datetime) AT TIME ZONE 'UTC')
+                                              + make_interval(hours => COALESCE(u.timezone_offset, 3)))::date
+            FROM users u
+            WHERE u.id = e.user_id AND e.id >= %s AND e.id < %s
+        """),
+    ]),
+    (8, "typed dates: two-way sync", [
+        # Новый код пишет только типизированные колонки, реплики прошлого релиза — только строковые;
+        # триггеры достраивают вторую сторону. Строки — в прежнем формате (naive UTC isoformat,
+        # YYYY-MM-DD), чтобы старые LIKE-запросы и сравнения строк продолжали работать.
+        "ALTER TABLE events ALTER COLUMN datetime_ts SET DEFAULT now()",
+        "ALTER TABLE users ALTER COLUMN created_at_ts SET DEFAULT now()",
+        """
+        CREATE OR REPLACE FUNCTION events_sync_typed() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                IF NEW.datetime IS NOT NULL THEN
+                    NEW.datetime_ts := legacy_ts(NEW.datetime);
+                ELSE
+                    NEW.datetime := to_char(NEW.datetime_ts AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS.US');
+                END IF;
+            ELSIF NEW.datetime_ts IS DISTINCT FROM OLD.datetime_ts THEN
+                NEW.datetime := to_char(NEW.datetime_ts AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS.US');
+            ELSIF NEW.datetime IS DISTINCT FROM OLD.datetime THEN
+                NEW.datetime_ts := legacy_ts(NEW.datetime);
+            END IF;
+            -- Старые реплики local_date не знают; новый код передает его сам
+            IF NEW.local_date IS NULL THEN
+                NEW.local_date := ((NEW.datetime_ts AT TIME ZONE 'UTC') + make_interval(hours => COALESCE(
+                    (SELECT timezone_offset FROM users WHERE id = NEW.user_id), 3)))::date;
+            END IF;
+            RETURN NEW;
+        END $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE OR REPLACE FUNCTION users_sync_typed() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                IF NEW.created_at IS NOT NULL THEN
+                    NEW.created_at_ts := legacy_ts(NEW.created_at);
+                ELSE
+                    NEW.created_at := to_char(NEW.created_at_ts AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS.US');
+                END IF;
+                IF NEW.last_clean_day IS NOT NULL THEN
+                    NEW.last_clean_day_d := legacy_date(NEW.last_clean_day);
+                ELSE
+                    NEW.last_clean_day := to_char(NEW.last_clean_day_d, 'YYYY-MM-DD');
+                END IF;
+                IF NEW.subscription_ends_at IS NOT NULL THEN
+                    NEW.subscription_ends_at_d := legacy_date(NEW.subscription_ends_at);
+                ELSE
+                    NEW.subscription_ends_at := to_char(NEW.subscription_ends_at_d, 'YYYY-MM-DD');
+                END IF;
+                RETURN NEW;
+            END IF;
+            IF NEW.created_at_ts IS DISTINCT FROM OLD.created_at_ts THEN
+                NEW.created_at := to_char(NEW.created_at_ts AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS.US');
+            ELSIF NEW.created_at IS DISTINCT FROM OLD.created_at THEN
+                NEW.created_at_ts := legacy_ts(NEW.created_at);
+            END IF;
+            IF NEW.last_clean_day_d IS DISTINCT FROM OLD.last_clean_day_d THEN
+                NEW.last_clean_day := to_char(NEW.last_clean_day_d, 'YYYY-MM-DD');
+            ELSIF NEW.last_clean_day IS DISTINCT FROM OLD.last_clean_day THEN
+                NEW.last_clean_day_d := legacy_date(NEW.last_clean_day);
+            END IF;
+            IF NEW.subscription_ends_at_d IS DISTINCT FROM OLD.subscription_ends_at_d THEN
+                NEW.subscription_ends_at := to_char(NEW.subscription_ends_at_d, 'YYYY-MM-DD');
+            ELSIF NEW.subscription_ends_at IS DISTINCT FROM OLD.subscription_ends_at THEN
+                NEW.subscription_ends_at_d := legacy_date(NEW.subscription_ends_at);
+            END IF;
+            RETURN NEW;
+        END $$ LANGUAGE plpgsql
+        """,
+        "DROP TRIGGER IF EXISTS events_sync_typed ON events",
+        """
+        CREATE TRIGGER events_sync_typed BEFORE INSERT OR UPDATE OF datetime, datetime_ts ON events
+        FOR EACH ROW EXECUTE FUNCTION events_sync_typed()
+        """,
+        "DROP TRIGGER IF EXISTS users_sync_typed ON users",
+        """
+        CREATE TRIGGER users_sync_typed BEFORE INSERT OR UPDATE OF created_at, last_clean_day, subscription_ends_at,
+            created_at_ts, last_clean_day_d, subscription_ends_at_d
+        ON users FOR EACH ROW EXECUTE FUNCTION users_sync_typed()
+        """,
+    ]),
+    (9, "fsm state", [
+        # Состояние FSM aiogram по чату/пользователю; scope — недефолтные части ключа хранилища
+        # (тред, business connection, destiny). Строки без state и data удаляются.
+        """
+        CREATE TABLE IF NOT EXISTS fsm_state (
+            chat_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            scope TEXT NOT NULL DEFAULT '',
+            state TEXT,
+            data JSONB,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (chat_id, user_id, scope)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_fsm_state_updated_at ON fsm_state(updated_at)",
+    ]),
+    (10, "cluster membership and reminder shards", [
+        # Живые процессы бота: каждый обновляет heartbeat_at; устаревшие строки считаются мертвыми
+        """
+        CREATE TABLE IF NOT EXISTS cluster_nodes (
+            node_id TEXT PRIMARY KEY,
+            started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            heartbeat_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """,
+        # Напоминания делятся по users.id % числу шардов; шард принадлежит узлу с неистекшей арендой
+        # (строки создаются по требованию под настроенное число шардов)
+        """
+        CREATE TABLE IF NOT EXISTS reminder_shards (
+            shard INTEGER PRIMARY KEY,
+            owner TEXT,
+            lease_until TIMESTAMPTZ
+        )
+        """,
+    ]),
+    (11, "processed updates", [
+        # update_id Telegram, занятые какой-либо репликой (UPDATE_DEDUP=shared); id ниже
+        # окна дедупликации удаляются
+        """
+        CREATE TABLE IF NOT EXISTS processed_updates (
+            update_id BIGINT PRIMARY KEY
+        )
+        """,
+    ]),
+    (12, "events keyset index", [
+        # Страницы истории: ORDER BY datetime_ts DESC, id DESC с границей (datetime_ts, id) < курсора;
+        # id делает порядок полным. Заменяет (user_id, datetime_ts) для диапазонов по пользователю.
+        # Строковый idx_events_user_datetime нужен старым репликам и уходит вместе с колонкой (шаг 14).
+        "CREATE INDEX IF NOT EXISTS idx_events_user_datetime_id ON events(user_id, datetime_ts DESC, id DESC)",
+        "DROP INDEX IF EXISTS idx_events_user_datetime_ts",
+    ]),
+    (13, "mini-app version stamps", [
+        # Условный GET для API мини-приложения: ETag строится из этих двух колонок, и повторное
+        # открытие обслуживается одной строкой users. api_version считает изменения колонок, которые
+        # показывает API; last_event_id ставит add_event тем же запросом, что и вставку.
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS api_version BIGINT NOT NULL DEFAULT 0",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS last_event_id INTEGER",
+        """
+        CREATE OR REPLACE FUNCTION users_bump_api_version() RETURNS trigger AS $$
+        BEGIN
+            NEW.api_version := OLD.api_version + 1;
+            RETURN NEW;
+        END $$ LANGUAGE plpgsql
+        """,
+        "DROP TRIGGER IF EXISTS users_bump_api_version ON users",
+        """
+        CREATE TRIGGER users_bump_api_version BEFORE UPDATE ON users FOR EACH ROW
+        WHEN ((OLD.name, OLD.current_streak, OLD.max_streak, OLD.timezone_offset)
+              IS DISTINCT FROM (NEW.name, NEW.current_streak, NEW.max_streak, NEW.timezone_offset))
+        EXECUTE FUNCTION users_bump_api_version()
+        """,
+        lambda conn: _backfill_in_batches(conn, "users", """
+            UPDATE users u SET last_event_id = (SELECT max(e.id) FROM events e WHERE e.user_id = u.id)
+            WHERE u.id >= %s AND u.id < %s
+        """),
+    ]),
+    (14, "typed dates: drop legacy columns", [
+        # Contract-шаг: после него не работают реплики релиза со строковыми датами (см. CONTRACT_MIGRATIONS)
+        "DROP TRIGGER IF EXISTS events_sync_typed ON events",
+        "DROP TRIGGER IF EXISTS users_sync_typed ON users",
+        "DROP FUNCTION IF EXISTS events_sync_typed()",
+        "DROP FUNCTION IF EXISTS users_sync_typed()",
+        "ALTER TABLE events DROP COLUMN IF EXISTS datetime",
+        "ALTER TABLE users DROP COLUMN IF EXISTS created_at",
+        "ALTER TABLE users DROP COLUMN IF EXISTS last_clean_day",
+        "ALTER TABLE users DROP COLUMN IF EXISTS subscription_ends_at",
+        "DROP FUNCTION IF EXISTS legacy_ts(TEXT)",
+        "DROP FUNCTION IF EXISTS legacy_date(TEXT)",
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+# Contract-шаги удаляют то, что читает прошлый релиз. Шаг применяется, только когда его номер указан
+# в DB_CONTRACT_MIGRATIONS (через запятую) — после того как все реплики переведены на текущий релиз;
+# до тех пор миграции останавливаются перед ним.
+CONTRACT_MIGRATIONS = frozenset({14})
+ALLOWED_CONTRACT_MIGRATIONS = frozenset(
+    int(v) for v in os.environ.get("DB_CONTRACT_MIGRATIONS", "").replace(",", " ").split()
+)
+MIGRATION_LOCK_ID = 72_110_001  # ключ pg_advisory_lock: миграции выполняет только один процесс
+BROADCAST_LOCK_ID = 72_110_002  # рассылка клавиатуры при деплое — только одна реплика
+BACKFILL_BATCH_SIZE = 5000
+
+
+async def _backfill_in_batches(conn, table, update_sql):
+    """Выполнить update_sql (параметры: начало и конец диапазона id) по диапазонам id,
+    с коммитом после каждой пачки, чтобы не держать блокировки строк на всю таблицу."""
+    cursor = conn.cursor()
+    await cursor.execute(f"SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0) FROM {table}")
+    first_id, last_id = await cursor.fetchone()
+    for batch_start in range(first_id, last_id + 1, BACKFILL_BATCH_SIZE):
+        await cursor.execute(update_sql, (batch_start, batch_start + BACKFILL_BATCH_SIZE))
+        await conn.commit()
+
+
+def _migration_target():
+    """Последняя версия, до которой можно мигрировать: все шаги до первого неразрешенного contract-шага."""
+    target = 0
+    for step_version, _, _ in MIGRATIONS:
+        if step_version in CONTRACT_MIGRATIONS and step_version not in ALLOWED_CONTRACT_MIGRATIONS:
+            break
+        target = step_version
+    return target
+
+
+async def _get_schema_version(cursor):
+    """Текущая версия схемы; 0 — таблицы schema_version ещё нет."""
+    try:
+        await cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    except psycopg.errors.UndefinedTable:
+        await cursor.connection.rollback()
+        return 0
+    return (await cursor.fetchone())[0]
+
 
-    conn.commit()
+async def _migrate(conn):
+    """Применить недостающие шаги MIGRATIONS. Возвращает список примененных версий."""
+    cursor = conn.cursor()
+    version = await _get_schema_version(cursor)
+    await conn.commit()
+    target = _migration_target()
+    if target < SCHEMA_VERSION and version < SCHEMA_VERSION:
+        print(f"DB migrations after {target} are waiting for DB_CONTRACT_MIGRATIONS "
+              f"(contract step; enable it once every replica runs this release)")
+    if version >= target:
+        return []
+
+    # Реплики, стартующие одновременно, ждут здесь, а не конкурируют за блокировки DDL
+    await cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+    try:
+        await cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name VARCHAR(100) NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+        """)
+        await conn.commit()
+        version = await _get_schema_version(cursor)  # пока ждали блокировку, мог мигрировать другой процесс
+        applied = []
+        for step_version, name, statements in MIGRATIONS:
+            if step_version <= version:
+                continue
+            if step_version > target:
+                break
+            # Каждый шаг — отдельная транзакция вместе с записью версии
+            # (шаг-функция, например пакетный backfill, может коммитить и сама)
+            for statement in statements:
+                if callable(statement):
+                    await statement(conn)
+                else:
+                    await cursor.execute(statement)
+            await cursor.execute(
+                "INSERT INTO schema_version (version, name) VALUES (%s, %s)",
+                (step_version, name)
+            )
+            await conn.commit()
+            applied.append(step_version)
+            print(f"DB migration {step_version} applied: {name}")
+        return applied
+    except Exception:
+        await conn.rollback()
+        raise
+    finally:
+        await cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+        await conn.commit()
 
-def init_db():
-    """Инициализация базы данных с повторными попытками при ошибках."""
-    global _db_initialized
+async def init_db():
+    """Инициализация базы данных (миграции схемы) с повторными попытками при ошибках."""
     max_retries = 3
     retry_delay = 2  # секунды
     
     for attempt in range(max_retries):
         try:
-            conn = get_connection(timeout=30)  # Уменьшаем timeout для init_db
+            conn = await get_connection(timeout=30)  # Уменьшаем timeout для init_db
             try:
-                _init_db_with_connection(conn)
-                _db_initialized = True
+                await _migrate(conn)
                 return
             finally:
-                return_connection(conn)
+                await return_connection(conn)
         except Exception as e:
             if attempt == max_retries - 1:
                 # Последняя попытка - пробрасываем ошибку
                 raise
             # Ждем перед следующей попыткой
-            import time
-            time.sleep(retry_delay)
+            await asyncio.sleep(retry_delay)
             continue
 
 
 # --- Работа с пользователем ---
-def get_user(tg_id):
-    conn = get_connection()
+@instrumented
+async def get_user(tg_id):
+    """UserRecord по telegram_id или None."""
+    user = user_cache.get(tg_id=tg_id)
+    if user:
+        return user
+    conn = await get_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE telegram_id = %s", (tg_id,))
-        row = cursor.fetchone()
+        await cursor.execute(f"SELECT {USER_COLUMNS} FROM users WHERE telegram_id = %s", (tg_id,))
+        row = await cursor.fetchone()
         if row:
-            # row is a tuple: (id, telegram_id, current_streak, max_streak, last_clean_day, review_time, timezone_offset, created_at)
-            return row
+            user = UserRecord(*row)
+            user_cache.put(user)
+            return user
         return None
     finally:
-        return_connection(conn)
+        await return_connection(conn)
 
-def create_user(tg_id):
-    conn = get_connection()
+@instrumented
+async def get_user_id(tg_id):
+    """Только внутренний id пользователя (для API мини-приложения) или None."""
+    user = user_cache.get(tg_id=tg_id)
+    if user:
+        return user.id
+    conn = await get_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute(
+        await cursor.execute("SELECT id FROM users WHERE telegram_id = %s", (tg_id,))
+        row = await cursor.fetchone()
+        return row[0] if row else None
+    finally:
+        await return_connection(conn)
+
+_WEBAPP_STAMP_SQL = "SELECT id, api_version, last_event_id, timezone_offset FROM users WHERE "
+
+@instrumented
+async def get_webapp_stamp(tg_id):
+    """WebAppStamp по telegram_id или None: один индексный lookup по users, без событий и без кэша
+    (штамп должен быть свежим даже если строку менял другой процесс)."""
+    row = await _execute_autocommit(_WEBAPP_STAMP_SQL + "telegram_id = %s", (tg_id,), fetch=True)
+    return WebAppStamp(*row) if row else None
+
+@instrumented
+async def get_webapp_stamp_by_id(user_id):
+    """То же по внутреннему id (из токена сессии мини-приложения) — lookup по первичному ключу."""
+    row = await _execute_autocommit(_WEBAPP_STAMP_SQL + "id = %s", (user_id,), fetch=True)
+    return WebAppStamp(*row) if row else None
+
+@instrumented
+async def create_user(tg_id):
+    conn = await get_connection()
+    try:
+        cursor = conn.cursor()
+        await cursor.execute(
             """
-            INSERT INTO users (telegram_id, last_clean_day, created_at)
-            VALUES (%s, %s, %s)
+            INSERT INTO users (telegram_id, last_clean_day_d)
+            VALUES (%s, %s)
             ON CONFLICT (telegram_id) DO NOTHING
             """,
-            (tg_id, date.today().isoformat(), datetime.now().isoformat())
+            (tg_id, date.today())
+        )
+        await conn.commit()
+    finally:
+        await return_connection(conn)
+    user_cache.invalidate(tg_id=tg_id)
+
+@instrumented
+async def set_streak(user_id, current_streak, max_streak, last_clean_day):
+    """Обновить серию дней без грызения (ответ «Да» на вечернем напоминании)."""
+    conn = await get_connection()
+    try:
+        cursor = conn.cursor()
+        await cursor.execute(
+            "UPDATE users SET current_streak = %s, max_streak = %s, last_clean_day_d = %s WHERE id = %s",
+            (current_streak, max_streak, last_clean_day, user_id)
         )
-        conn.commit()
+        await conn.commit()
+        user_cache.update(user_id, current_streak=current_streak, max_streak=max_streak, last_clean_day=last_clean_day)
     finally:
-        return_connection(conn)
+        await return_connection(conn)
+
+@instrumented
+async def reset_current_streak(user_id):
+    """Сбросить текущую серию (после разбора дня с событиями)."""
+    conn = await get_connection()
+    try:
+        cursor = conn.cursor()
+        await cursor.execute(
+            "UPDATE users SET current_streak = 0 WHERE id = %s",
+            (user_id,)
+        )
+        await conn.commit()
+        user_cache.update(user_id, current_streak=0)
+    finally:
+        await return_connection(conn)
 
 
 # --- Работа с событиями ---
-def add_event(user_id, text):
-    conn = get_connection()
+def _utc_day_bounds(day):
+    """[начало, конец) суток day в UTC — для range-запросов по timestamptz."""
+    start = datetime.combine(day, dt_time.min, timezone.utc)
+    return start, start + timedelta(days=1)
+
+@instrumented
+async def add_event(user_id, text):
+    """Записать событие; local_date — дата по часовому поясу пользователя на момент записи.
+    Тем же запросом обновляется users.last_event_id (штамп версии для ETag мини-приложения)."""
+    conn = await get_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO events (user_id, datetime, text) VALUES (%s, %s, %s)",
-            (user_id, datetime.now().isoformat(), text)
+        await cursor.execute(
+            """
+            WITH ins AS (
+                INSERT INTO events (user_id, datetime_ts, local_date, text)
+                SELECT id, now(), ((now() AT TIME ZONE 'UTC') + make_interval(hours => COALESCE(timezone_offset, 3)))::date, %s
+                FROM users WHERE id = %s
+                RETURNING id, user_id
+            )
+            UPDATE users u SET last_event_id = ins.id FROM ins WHERE u.id = ins.user_id
+            """,
+            (text, user_id)
         )
-        conn.commit()
+        await conn.commit()
     finally:
-        return_connection(conn)
+        await return_connection(conn)
 
-def get_today_events(user_id):
-    conn = get_connection()
+@instrumented
+async def get_today_events(user_id, local_date):
+    """Неразобранные события за local_date (дата по поясу пользователя): (id, user_id, datetime, text, analysis, analyzed)."""
+    conn = await get_connection()
     try:
         cursor = conn.cursor()
-        today = date.today().isoformat()
-        cursor.execute("""
-            SELECT * FROM events
-            WHERE user_id = %s AND datetime LIKE %s AND analyzed = 0
-            ORDER BY datetime
-        """, (user_id, f"{today}%"))
-        rows = cursor.fetchall()
+        await cursor.execute("""
+            SELECT id, user_id, datetime_ts, text, analysis, analyzed FROM events
+            WHERE user_id = %s AND local_date = %s AND analyzed = 0
+            ORDER BY datetime_ts
+        """, (user_id, local_date))
+        rows = await cursor.fetchall()
         # rows are already tuples
         return rows
     finally:
-        return_connection(conn)
+        await return_connection(conn)
 
-def save_analysis(event_id, analysis_text):
-    conn = get_connection()
+@instrumented
+async def get_recent_events(user_id, limit=100, before=None):
+    """Страница истории событий пользователя, от новых к старым: [(datetime, text, id)] — для мини-приложения.
+    before — курсор (datetime, id) последнего события предыдущей страницы; каждая страница — один
+    короткий проход по idx_events_user_datetime_id, независимо от глубины. События без datetime
+    (нераспознанные старые значения) в историю не попадают — у них нет места в порядке курсора."""
+    conn = await get_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE events SET analysis = %s, analyzed = 1 WHERE id = %s",
-            (analysis_text, event_id)
-        )
-        conn.commit()
+        if before is None:
+            await cursor.execute("""
+                SELECT datetime_ts, text, id FROM events
+                WHERE user_id = %s AND datetime_ts IS NOT NULL
+                ORDER BY datetime_ts DESC, id DESC
+                LIMIT %s
+            """, (user_id, limit))
+        else:
+            await cursor.execute("""
+                SELECT datetime_ts, text, id FROM events
+                WHERE user_id = %s AND (datetime_ts, id) < (%s, %s)
+                ORDER BY datetime_ts DESC, id DESC
+                LIMIT %s
+            """, (user_id, *before, limit))
+        return await cursor.fetchall()
     finally:
-        return_connection(conn)
+        await return_connection(conn)
 
+@instrumented
+async def get_event_counts_by_day(user_id, start_date, end_date):
+    """Число событий по дням local_date (дата по поясу пользователя) в [start_date, end_date]: {date: count}.
+    Дни без событий не возвращаются. Один index-only скан по idx_events_user_local_date."""
+    conn = await get_connection()
+    try:
+        cursor = conn.cursor()
+        await cursor.execute("""
+            SELECT local_date, count(*) FROM events
+            WHERE user_id = %s AND local_date BETWEEN %s AND %s
+            GROUP BY local_date
+        """, (user_id, start_date, end_date))
+        return dict(await cursor.fetchall())
+    finally:
+        await return_connection(conn)
 
-# --- Вечернее время для разбора ---
-def set_review_time(user_id, time_str):
-    conn = get_connection()
+@instrumented
+async def save_analysis(event_id, analysis_text):
+    conn = await get_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE users SET review_time = %s WHERE id = %s",
-            (time_str, user_id)
+        await cursor.execute(
+            "UPDATE events SET analysis = %s, analyzed = 1 WHERE id = %s",
+            (analysis_text, event_id)
         )
-        conn.commit()
+        await conn.commit()
     finally:
-        return_connection(conn)
+        await return_connection(conn)
 
-def get_users_with_review_time():
-    conn = get_connection()
+@instrumented
+async def get_event_text(user_id, event_id):
+    """Текст события пользователя (разбор хранит в FSM только id событий)."""
+    conn = await get_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute(
-            "SELECT id, telegram_id, review_time FROM users WHERE review_time IS NOT NULL"
+        await cursor.execute(
+            "SELECT text FROM events WHERE id = %s AND user_id = %s", (event_id, user_id)
         )
-        rows = cursor.fetchall()
-        # rows are already tuples
-        return rows
+        row = await cursor.fetchone()
+        return row[0] if row else None
     finally:
-        return_connection(conn)
+        await return_connection(conn)
+
 
-def get_all_users():
-    conn = get_connection()
+# --- Статистика для админа ---
+@instrumented
+async def get_bot_stats(day):
+    """(всего пользователей, новых за day, всего событий, активных за day) за один заход в пул.
+    day — дата (сутки по UTC)."""
+    day_start, day_end = _utc_day_bounds(day)
+    conn = await get_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT id, telegram_id, timezone_offset FROM users")
-        rows = cursor.fetchall()
-        # rows are already tuples
-        return rows
+        await cursor.execute("SELECT COUNT(*) FROM users")
+        users_count = (await cursor.fetchone())[0]
+        await cursor.execute(
+            "SELECT COUNT(*) FROM users WHERE created_at_ts >= %s AND created_at_ts < %s",
+            (day_start, day_end)
+        )
+        new_today = (await cursor.fetchone())[0]
+        await cursor.execute("SELECT COUNT(*) FROM events")
+        events_count = (await cursor.fetchone())[0]
+        await cursor.execute("""
+            SELECT COUNT(DISTINCT user_id)
+            FROM events
+            WHERE datetime_ts >= %s AND datetime_ts < %s
+        """, (day_start, day_end))
+        active_today = (await cursor.fetchone())[0]
+        return users_count, new_today, events_count, active_today
     finally:
-        return_connection(conn)
+        await return_connection(conn)
+
 
-def set_timezone(user_id, offset):
-    conn = get_connection()
+# --- Вечернее время для разбора ---
+@instrumented
+async def set_review_time(user_id, time_str):
+    conn = await get_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE users SET timezone_offset = %s WHERE id = %s",
-            (offset, user_id)
+        await cursor.execute(
+            "UPDATE users SET review_time = %s WHERE id = %s",
+            (time_str, user_id)
         )
-        conn.commit()
+        await conn.commit()
+        user_cache.update(user_id, review_time=time_str)
     finally:
-        return_connection(conn)
+        await return_connection(conn)
 
-def set_user_name(user_id, name):
-    conn = get_connection()
+
+@instrumented
+async def get_users_for_scheduler():
+    """(id, telegram_id, timezone_offset, review_time, subscription_ends_at) — для индекса напоминаний при старте."""
+    conn = await get_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE users SET name = %s WHERE id = %s",
-            (name.strip()[:100], user_id)
+        await cursor.execute(
+            "SELECT id, telegram_id, timezone_offset, review_time, subscription_ends_at_d FROM users"
         )
-        conn.commit()
+        return await cursor.fetchall()
     finally:
-        return_connection(conn)
+        await return_connection(conn)
 
-def set_user_is_female(user_id, is_female):
-    conn = get_connection()
+@instrumented
+async def set_timezone(user_id, offset, trial_ends_at=None):
+    """Сменить часовой пояс. trial_ends_at — заодно включить пробный период (тем же UPDATE)."""
+    conn = await get_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE users SET is_female = %s WHERE id = %s",
-            (bool(is_female), user_id)
-        )
-        conn.commit()
+        if trial_ends_at is None:
+            await cursor.execute(
+                "UPDATE users SET timezone_offset = %s WHERE id = %s",
+                (offset, user_id)
+            )
+            await conn.commit()
+            user_cache.update(user_id, timezone_offset=offset)
+        else:
+            await cursor.execute(
+                "UPDATE users SET timezone_offset = %s, subscription_ends_at_d = %s, trial_used = TRUE WHERE id = %s",
+                (offset, trial_ends_at, user_id)
+            )
+            await conn.commit()
+            user_cache.update(user_id, timezone_offset=offset, subscription_ends_at=trial_ends_at, trial_used=True)
     finally:
-        return_connection(conn)
+        await return_connection(conn)
 
-def get_users_with_review_time_and_tz():
-    conn = get_connection()
+@instrumented
+async def set_user_name(user_id, name):
+    conn = await get_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute(
-            "SELECT id, telegram_id, review_time, timezone_offset FROM users WHERE review_time IS NOT NULL"
+        await cursor.execute(
+            "UPDATE users SET name = %s WHERE id = %s",
+            (name.strip()[:100], user_id)
         )
-        rows = cursor.fetchall()
-        # rows are already tuples
-        return rows
+        await conn.commit()
+        user_cache.update(user_id, name=name.strip()[:100])
     finally:
-        return_connection(conn)
+        await return_connection(conn)
 
-
-# --- Подписка ---
-def set_subscription_ends_at(user_id, date_str):
-    """date_str: YYYY-MM-DD, subscription active until end of this day (inclusive)."""
-    conn = get_connection()
+@instrumented
+async def set_user_is_female(user_id, is_female):
+    conn = await get_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE users SET subscription_ends_at = %s WHERE id = %s",
-            (date_str, user_id)
+        await cursor.execute(
+            "UPDATE users SET is_female = %s WHERE id = %s",
+            (bool(is_female), user_id)
         )
-        conn.commit()
+        await conn.commit()
+        user_cache.update(user_id, is_female=bool(is_female))
     finally:
-        return_connection(conn)
+        await return_connection(conn)
+
 
-def set_trial_used(user_id, used=True):
-    conn = get_connection()
+# --- Подписка ---
+@instrumented
+async def start_trial(user_id, end_date):
+    """Пробный период: подписка до end_date и отметка trial_used — одним UPDATE."""
+    conn = await get_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE users SET trial_used = %s WHERE id = %s",
-            (bool(used), user_id)
+        await cursor.execute(
+            "UPDATE users SET subscription_ends_at_d = %s, trial_used = TRUE WHERE id = %s",
+            (end_date, user_id)
         )
-        conn.commit()
+        await conn.commit()
+        user_cache.update(user_id, subscription_ends_at=end_date, trial_used=True)
     finally:
-        return_connection(conn)
+        await return_connection(conn)
+
 
-def get_user_by_id(user_id):
-    """Get user row by internal id (for webhook)."""
-    conn = get_connection()
+@instrumented
+async def get_user_by_id(user_id):
+    """UserRecord по внутреннему id (для вебхука) или None."""
+    user = user_cache.get(user_id=user_id)
+    if user:
+        return user
+    conn = await get_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE id = %s", (user_id,))
-        return cursor.fetchone()
+        await cursor.execute(f"SELECT {USER_COLUMNS} FROM users WHERE id = %s", (user_id,))
+        row = await cursor.fetchone()
+        if not row:
+            return None
+        user = UserRecord(*row)
+        user_cache.put(user)
+        return user
     finally:
-        return_connection(conn)
+        await return_connection(conn)
 
 
 # --- Платежи YooKassa (для вебхука) ---
-def create_payment(user_id, yookassa_payment_id, amount_rub):
-    conn = get_connection()
+@instrumented
+async def create_payment(user_id, yookassa_payment_id, amount_rub):
+    conn = await get_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute(
+        await cursor.execute(
             """INSERT INTO payments (user_id, yookassa_payment_id, amount_rub, status, created_at)
                VALUES (%s, %s, %s, 'pending', %s)""",
             (user_id, yookassa_payment_id, amount_rub, datetime.now().isoformat())
         )
-        conn.commit()
+        await conn.commit()
     finally:
-        return_connection(conn)
+        await return_connection(conn)
 
-def get_payment_by_yookassa_id(yookassa_payment_id):
-    conn = get_connection()
+@instrumented
+async def get_payment_by_yookassa_id(yookassa_payment_id):
+    conn = await get_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute(
+        await cursor.execute(
             "SELECT id, user_id, yookassa_payment_id, status, telegram_message_id FROM payments WHERE yookassa_payment_id = %s",
             (yookassa_payment_id,)
         )
-        return cursor.fetchone()
+        return await cursor.fetchone()
     finally:
-        return_connection(conn)
+        await return_connection(conn)
 
-def set_payment_telegram_message(yookassa_payment_id, message_id):
+@instrumented
+async def set_payment_telegram_message(yookassa_payment_id, message_id):
     """Сохранить message_id сообщения со ссылкой на оплату (чтобы удалить после успеха)."""
-    conn = get_connection()
+    conn = await get_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute(
+        await cursor.execute(
             "UPDATE payments SET telegram_message_id = %s WHERE yookassa_payment_id = %s",
             (message_id, yookassa_payment_id)
         )
-        conn.commit()
+        await conn.commit()
     finally:
-        return_connection(conn)
+        await return_connection(conn)
 
-def mark_payment_succeeded(payment_id):
-    conn = get_connection()
+@instrumented
+async def mark_payment_succeeded(payment_id):
+    conn = await get_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute(
+        await cursor.execute(
             "UPDATE payments SET status = 'succeeded' WHERE id = %s",
             (payment_id,)
         )
-        conn.commit()
+        await conn.commit()
     finally:
-        return_connection(conn)
+        await return_connection(conn)
+
 
-def get_last_checkin_sent_date(user_id):
-    """Получить дату последнего отправленного check-in уведомления (YYYY-MM-DD или None)."""
-    conn = get_connection()
+# --- Кому пора отправить напоминание (одним запросом) ---
+# Для каждого возможного пояса (-12..+14) Postgres сам считает местное время на момент тика,
+# и по индексам выбираются только те, кому напоминание положено именно в эту минуту
+# и ещё не отправлено сегодня (по местной дате).
+# В кластере (node_id задан) берутся только пользователи из шардов, аренда которых у этого узла ещё
+# действует — проверка в том же запросе, по часам Postgres. window_minutes > 1 добирает минуты, пропущенные
+# при переходе шарда к другому узлу (отметки «отправлено сегодня» не дают отправить дважды).
+DUE_REMINDERS_SQL = """
+    WITH slots AS (
+        SELECT o AS tz_offset,
+               to_char(local_ts, 'HH24:MI') AS local_hhmm,
+               to_char(local_ts, 'YYYY-MM-DD') AS local_date,
+               local_ts::date AS local_day
+        FROM (
+            SELECT o, (%(now)s::timestamptz AT TIME ZONE 'UTC') + make_interval(hours => o, mins => -m) AS local_ts
+            FROM generate_series(-12, 14) AS o, generate_series(0, %(window_minutes)s - 1) AS m
+        ) t
+    ),
+    owned AS (
+        SELECT shard FROM reminder_shards
+        WHERE owner = %(node_id)s AND lease_until > now() AND shard < %(shards)s
+    ),
+    due AS (
+        SELECT 'review' AS kind, u.id, u.telegram_id, s.local_date
+        FROM slots s
+        JOIN users u ON u.timezone_offset = s.tz_offset AND u.review_time = s.local_hhmm
+        WHERE u.last_review_sent_date IS DISTINCT FROM s.local_date
+        UNION ALL
+        SELECT 'checkin', u.id, u.telegram_id, s.local_date
+        FROM slots s
+        JOIN users u ON u.timezone_offset = s.tz_offset
+        WHERE s.local_hhmm = %(checkin_time)s
+          AND (u.subscription_ends_at_d >= s.local_day OR u.telegram_id = ANY(%(checkin_always)s::bigint[]))
+          AND u.last_checkin_sent_date IS DISTINCT FROM s.local_date
+        UNION ALL
+        SELECT 'expiry', u.id, u.telegram_id, s.local_date
+        FROM slots s
+        JOIN users u ON u.timezone_offset = s.tz_offset AND u.subscription_ends_at_d = s.local_day
+        WHERE s.local_hhmm = %(expiry_time)s
+          AND u.last_subscription_expiry_notified_date IS DISTINCT FROM s.local_date
+    )
+    SELECT kind, id, telegram_id, local_date FROM due
+    WHERE %(node_id)s::text IS NULL OR mod(id, %(shards)s) IN (SELECT shard FROM owned)
+"""
+
+@instrumented
+async def get_due_reminders(now_utc, checkin_time="13:00", expiry_time="10:00", checkin_always=(),
+                            node_id=None, shards=1, window_minutes=1):
+    """Все напоминания на минуту now_utc: список (kind, user_id, telegram_id, local_date).
+    kind: 'review' | 'checkin' | 'expiry'; local_date — date по местному времени пользователя.
+    checkin_always — telegram_id, которым check-in положен без подписки (админ).
+    node_id/shards — только пользователи шардов этого узла (cluster.py); window_minutes — сколько
+    последних минут (включая текущую) просматривать."""
+    conn = await get_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute(
-            "SELECT last_checkin_sent_date FROM users WHERE id = %s",
-            (user_id,)
+        await cursor.execute(DUE_REMINDERS_SQL, {
+            "now": now_utc.replace(second=0, microsecond=0),
+            "checkin_time": checkin_time,
+            "expiry_time": expiry_time,
+            "checkin_always": list(checkin_always),
+            "node_id": node_id,
+            "shards": shards,
+            "window_minutes": window_minutes,
+        })
+        rows = await cursor.fetchall()
+        return [(kind, user_id, tg_id, date.fromisoformat(local_date)) for kind, user_id, tg_id, local_date in rows]
+    finally:
+        await return_connection(conn)
+
+
+# --- Пакетные операции для reminder_loop (константное число запросов на тик) ---
+REMINDER_SENT_COLUMNS = {
+    "review": "last_review_sent_date",
+    "checkin": "last_checkin_sent_date",
+    "expiry": "last_subscription_expiry_notified_date",
+}
+
+@instrumented
+async def get_reminder_targets(local_dates):
+    """Строки пользователей и число неразобранных событий за их местную дату — одним запросом.
+    local_dates — {user_id: date}. Возвращает {user_id: (UserRecord, last_sent, today_events)},
+    где last_sent — {kind: 'YYYY-MM-DD' или None}."""
+    if not local_dates:
+        return {}
+    conn = await get_connection()
+    try:
+        cursor = conn.cursor()
+        await cursor.execute(f"""
+            SELECT {_user_columns("u")},
+                   u.last_review_sent_date, u.last_checkin_sent_date, u.last_subscription_expiry_notified_date,
+                   (SELECT COUNT(*) FROM events e
+                    WHERE e.user_id = u.id AND e.local_date = d.local_date AND e.analyzed = 0) AS today_events
+            FROM unnest(%s::int[], %s::date[]) AS d(user_id, local_date)
+            JOIN users u ON u.id = d.user_id
+        """, (list(local_dates), list(local_dates.values())))
+        rows = await cursor.fetchall()
+        targets = {}
+        for row in rows:
+            user = UserRecord(*row[:-4])
+            last_sent = {"review": row[-4], "checkin": row[-3], "expiry": row[-2]}
+            targets[user.id] = (user, last_sent, row[-1])
+        return targets
+    finally:
+        await return_connection(conn)
+
+async def _mark_reminders_sent(cursor, kind, sent):
+    if not sent:
+        return
+    column = REMINDER_SENT_COLUMNS[kind]
+    await cursor.execute(
+        f"""
+        UPDATE users AS u SET {column} = v.sent_date
+        FROM unnest(%s::int[], %s::varchar[]) AS v(id, sent_date)
+        WHERE u.id = v.id
+        """,
+        ([user_id for user_id, _ in sent], [date_str for _, date_str in sent])
+    )
+
+
+# --- Состояние фоновых задач (ключ-значение) ---
+@instrumented
+async def get_bot_state(key):
+    conn = await get_connection()
+    try:
+        cursor = conn.cursor()
+        await cursor.execute("SELECT value FROM bot_state WHERE key = %s", (key,))
+        row = await cursor.fetchone()
+        return row[0] if row else None
+    finally:
+        await return_connection(conn)
+
+@instrumented
+async def set_bot_state(key, value):
+    conn = await get_connection()
+    try:
+        cursor = conn.cursor()
+        await cursor.execute(
+            """
+            INSERT INTO bot_state (key, value, updated_at) VALUES (%s, %s, %s)
+            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = EXCLUDED.updated_at
+            """,
+            (key, value, datetime.now().isoformat())
+        )
+        await conn.commit()
+    finally:
+        await return_connection(conn)
+
+
+# --- Состояние FSM (хранилище aiogram, fsm_storage.py) ---
+# key — (chat_id, user_id, scope). Строка, не менявшаяся дольше ttl_hours, считается брошенной: не читается,
+# при записи начинается заново и удаляется purge_fsm_states.
+# FSM трогается на каждом апдейте, а все запросы здесь — одиночные операторы, поэтому они выполняются
+# в autocommit: один round trip без отдельных COMMIT/ROLLBACK.
+_FSM_KEY = "chat_id = %(chat_id)s AND user_id = %(user_id)s AND scope = %(scope)s"
+_FSM_FRESH = "fsm_state.updated_at > now() - make_interval(hours => %(ttl_hours)s)"
+
+
+async def _execute_autocommit(query, params, fetch=False):
+    """Одиночный оператор вне транзакции (autocommit): один round trip без COMMIT/ROLLBACK."""
+    conn = await get_connection()
+    try:
+        await conn.set_autocommit(True)
+        try:
+            cursor = conn.cursor()
+            await cursor.execute(query, params)
+            return await cursor.fetchone() if fetch else None
+        finally:
+            if not conn.closed:
+                await conn.set_autocommit(False)
+    finally:
+        await return_connection(conn)
+
+async def _fsm_execute(query, key, fetch=False, **params):
+    return await _execute_autocommit(query, dict(zip(("chat_id", "user_id", "scope"), key), **params), fetch)
+
+@instrumented
+async def get_fsm_state(key, ttl_hours):
+    row = await _fsm_execute(
+        f"SELECT state FROM fsm_state WHERE {_FSM_KEY} AND {_FSM_FRESH}", key, fetch=True, ttl_hours=ttl_hours
+    )
+    return row[0] if row else None
+
+@instrumented
+async def get_fsm_data(key, ttl_hours):
+    row = await _fsm_execute(
+        f"SELECT data FROM fsm_state WHERE {_FSM_KEY} AND {_FSM_FRESH}", key, fetch=True, ttl_hours=ttl_hours
+    )
+    return row[0] if row and row[0] else {}
+
+@instrumented
+async def set_fsm_state(key, state, ttl_hours):
+    """state=None: сбросить состояние (строка без данных удаляется). Данные брошенной строки не наследуются."""
+    if state is None:
+        await _fsm_execute(f"""
+            WITH removed AS (
+                DELETE FROM fsm_state WHERE {_FSM_KEY} AND (data IS NULL OR NOT {_FSM_FRESH})
+            )
+            UPDATE fsm_state SET state = NULL, updated_at = now()
+            WHERE {_FSM_KEY} AND data IS NOT NULL AND {_FSM_FRESH}
+        """, key, ttl_hours=ttl_hours)
+    else:
+        await _fsm_execute(f"""
+            INSERT INTO fsm_state (chat_id, user_id, scope, state)
+            VALUES (%(chat_id)s, %(user_id)s, %(scope)s, %(state)s)
+            ON CONFLICT (chat_id, user_id, scope) DO UPDATE SET
+                state = EXCLUDED.state,
+                data = CASE WHEN {_FSM_FRESH} THEN fsm_state.data END,
+                updated_at = now()
+        """, key, state=state, ttl_hours=ttl_hours)
+
+@instrumented
+async def set_fsm_data(key, data, ttl_hours):
+    """Заменить данные целиком; пустой dict — удалить данные (и строку, если нет состояния)."""
+    if not data:
+        await _fsm_execute(f"""
+            WITH removed AS (
+                DELETE FROM fsm_state WHERE {_FSM_KEY} AND (state IS NULL OR NOT {_FSM_FRESH})
+            )
+            UPDATE fsm_state SET data = NULL, updated_at = now()
+            WHERE {_FSM_KEY} AND state IS NOT NULL AND {_FSM_FRESH}
+        """, key, ttl_hours=ttl_hours)
+    else:
+        await _fsm_execute(f"""
+            INSERT INTO fsm_state (chat_id, user_id, scope, data)
+            VALUES (%(chat_id)s, %(user_id)s, %(scope)s, %(data)s)
+            ON CONFLICT (chat_id, user_id, scope) DO UPDATE SET
+                data = EXCLUDED.data,
+                state = CASE WHEN {_FSM_FRESH} THEN fsm_state.state END,
+                updated_at = now()
+        """, key, data=Jsonb(data), ttl_hours=ttl_hours)
+
+@instrumented
+async def update_fsm_data(key, data, ttl_hours):
+    """Дописать ключи в данные одним запросом (вместо get + set); брошенная строка начинается заново."""
+    row = await _fsm_execute(f"""
+        INSERT INTO fsm_state (chat_id, user_id, scope, data)
+        VALUES (%(chat_id)s, %(user_id)s, %(scope)s, %(data)s)
+        ON CONFLICT (chat_id, user_id, scope) DO UPDATE SET
+            data = CASE WHEN {_FSM_FRESH} THEN COALESCE(fsm_state.data, '{{}}'::jsonb) || EXCLUDED.data
+                        ELSE EXCLUDED.data END,
+            state = CASE WHEN {_FSM_FRESH} THEN fsm_state.state END,
+            updated_at = now()
+        RETURNING data
+    """, key, fetch=True, data=Jsonb(data), ttl_hours=ttl_hours)
+    return row[0]
+
+@instrumented
+async def purge_fsm_states(ttl_hours):
+    """Удалить брошенные состояния (не менялись дольше ttl_hours). Возвращает число удалённых."""
+    conn = await get_connection()
+    try:
+        cursor = conn.cursor()
+        await cursor.execute(
+            "DELETE FROM fsm_state WHERE updated_at < now() - make_interval(hours => %s)",
+            (ttl_hours,)
         )
-        row = cursor.fetchone()
-        return row[0] if row and row[0] else None
+        await conn.commit()
+        return cursor.rowcount
+    finally:
+        await return_connection(conn)
+
+
+# --- Кластер: узлы и аренда шардов напоминаний (cluster.py) ---
+@instrumented
+async def cluster_heartbeat(node_id, shards, lease_seconds):
+    """Продлить жизнь узла и его аренды, отдать лишние шарды и занять свободные до справедливой доли
+    ceil(shards / живых узлов). Одна транзакция; возвращает отсортированный список шардов узла."""
+    conn = await get_connection()
+    try:
+        cursor = conn.cursor()
+        await cursor.execute("""
+            INSERT INTO cluster_nodes (node_id) VALUES (%s)
+            ON CONFLICT (node_id) DO UPDATE SET heartbeat_at = now()
+        """, (node_id,))
+        await cursor.execute("""
+            INSERT INTO reminder_shards (shard) SELECT generate_series(0, %s - 1)
+            ON CONFLICT (shard) DO NOTHING
+        """, (shards,))
+        # Узлы живы, пока не истекла аренда; давно умершие удаляем, чтобы таблица не росла
+        await cursor.execute("""
+            WITH gone AS (
+                DELETE FROM cluster_nodes WHERE heartbeat_at < now() - interval '1 day'
+            )
+            SELECT count(*) FROM cluster_nodes WHERE heartbeat_at > now() - make_interval(secs => %s)
+        """, (lease_seconds,))
+        live = max(1, (await cursor.fetchone())[0])
+        fair_share = -(-shards // live)
+        await cursor.execute("""
+            WITH mine AS (
+                SELECT shard, row_number() OVER (ORDER BY shard) AS n FROM reminder_shards
+                WHERE owner = %(node_id)s AND lease_until > now() AND shard < %(shards)s
+            ),
+            released AS (
+                UPDATE reminder_shards r SET owner = NULL, lease_until = NULL
+                FROM mine WHERE r.shard = mine.shard AND mine.n > %(fair_share)s
+            )
+            UPDATE reminder_shards r SET lease_until = now() + make_interval(secs => %(lease)s)
+            FROM mine WHERE r.shard = mine.shard AND mine.n <= %(fair_share)s
+            RETURNING r.shard
+        """, {"node_id": node_id, "shards": shards, "fair_share": fair_share, "lease": lease_seconds})
+        owned = [row[0] for row in await cursor.fetchall()]
+        if len(owned) < fair_share:
+            # Свободные и просроченные шарды; SKIP LOCKED — два узла не займут один шард
+            await cursor.execute("""
+                UPDATE reminder_shards SET owner = %(node_id)s,
+                                           lease_until = now() + make_interval(secs => %(lease)s)
+                WHERE shard IN (
+                    SELECT shard FROM reminder_shards
+                    WHERE shard < %(shards)s AND (owner IS NULL OR lease_until IS NULL OR lease_until <= now())
+                    ORDER BY shard LIMIT %(wanted)s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING shard
+            """, {"node_id": node_id, "shards": shards, "lease": lease_seconds,
+                  "wanted": fair_share - len(owned)})
+            owned.extend(row[0] for row in await cursor.fetchall())
+        await conn.commit()
+        return sorted(owned)
     finally:
-        return_connection(conn)
+        await return_connection(conn)
 
-def set_last_checkin_sent_date(user_id, date_str):
-    """Установить дату последнего отправленного check-in уведомления (YYYY-MM-DD)."""
-    conn = get_connection()
+@instrumented
+async def leave_cluster(node_id):
+    """Корректная остановка: сразу отдать шарды другим узлам, не дожидаясь истечения аренды."""
+    conn = await get_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE users SET last_checkin_sent_date = %s WHERE id = %s",
-            (date_str, user_id)
+        await cursor.execute(
+            "UPDATE reminder_shards SET owner = NULL, lease_until = NULL WHERE owner = %s", (node_id,)
         )
-        conn.commit()
+        await cursor.execute("DELETE FROM cluster_nodes WHERE node_id = %s", (node_id,))
+        await conn.commit()
     finally:
-        return_connection(conn)
+        await return_connection(conn)
 
-def get_last_subscription_expiry_notified_date(user_id):
-    """Получить дату последнего отправленного уведомления об окончании подписки (YYYY-MM-DD или None)."""
-    conn = get_connection()
+async def try_advisory_lock(lock_id):
+    """Сессионная блокировка pg_try_advisory_lock на отдельном соединении из пула.
+    Возвращает соединение (передать в release_advisory_lock) или None, если блокировку держит другой процесс.
+    Если процесс умрёт, Postgres снимет блокировку вместе с соединением."""
+    conn = await get_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute(
-            "SELECT last_subscription_expiry_notified_date FROM users WHERE id = %s",
-            (user_id,)
+        await cursor.execute("SELECT pg_try_advisory_lock(%s)", (lock_id,))
+        acquired = (await cursor.fetchone())[0]
+        await conn.commit()
+    except Exception:
+        await return_connection(conn)
+        raise
+    if not acquired:
+        await return_connection(conn)
+        return None
+    return conn
+
+async def release_advisory_lock(conn, lock_id):
+    try:
+        cursor = conn.cursor()
+        await cursor.execute("SELECT pg_advisory_unlock(%s)", (lock_id,))
+        await conn.commit()
+    except Exception:
+        # Соединение с блокировкой нельзя возвращать в пул: закрываем — блокировка снимется сама
+        await conn.close()
+    finally:
+        await return_connection(conn)
+
+
+# --- Дедупликация апдейтов между репликами (dedup.py, UPDATE_DEDUP=shared) ---
+@instrumented
+async def claim_update(update_id):
+    """True, если апдейт забран этим процессом; False — его уже обработала другая реплика."""
+    row = await _execute_autocommit(
+        "INSERT INTO processed_updates (update_id) VALUES (%s) ON CONFLICT DO NOTHING RETURNING 1",
+        (update_id,), fetch=True
+    )
+    return row is not None
+
+@instrumented
+async def purge_processed_updates(below_id):
+    await _execute_autocommit("DELETE FROM processed_updates WHERE update_id < %s", (below_id,))
+
+
+# --- Рассылка клавиатуры: только тем, у кого она изменилась ---
+@instrumented
+async def get_keyboard_broadcast_batch(after_id, limit, admin_tg_id, today, fingerprints):
+    """Следующие limit пользователей (id > after_id, по порядку id), которым нужна новая клавиатура.
+    fingerprints — {"admin": ..., "subscribed": ..., "unsubscribed": ...}: отпечаток нужной раскладки.
+    Возвращает (строки (id, telegram_id, нужный отпечаток), последний просмотренный id или None)."""
+    conn = await get_connection()
+    try:
+        cursor = conn.cursor()
+        await cursor.execute("""
+            WITH scanned AS (
+                SELECT id, telegram_id, keyboard_fingerprint,
+                       CASE
+                           WHEN telegram_id = %(admin)s THEN %(fp_admin)s
+                           WHEN subscription_ends_at_d >= %(today)s THEN %(fp_sub)s
+                           ELSE %(fp_unsub)s
+                       END AS wanted
+                FROM users
+                WHERE id > %(after_id)s
+                ORDER BY id
+                LIMIT %(limit)s
+            )
+            SELECT id, telegram_id, wanted, keyboard_fingerprint IS DISTINCT FROM wanted AS changed
+            FROM scanned
+            ORDER BY id
+        """, {
+            "admin": admin_tg_id,
+            "today": today,
+            "fp_admin": fingerprints["admin"],
+            "fp_sub": fingerprints["subscribed"],
+            "fp_unsub": fingerprints["unsubscribed"],
+            "after_id": after_id,
+            "limit": limit,
+        })
+        rows = await cursor.fetchall()
+        if not rows:
+            return [], None
+        return [(user_id, tg_id, wanted) for user_id, tg_id, wanted, changed in rows if changed], rows[-1][0]
+    finally:
+        await return_connection(conn)
+
+async def _set_keyboard_fingerprints(cursor, delivered):
+    if not delivered:
+        return
+    await cursor.execute(
+        """
+        UPDATE users AS u SET keyboard_fingerprint = v.fingerprint
+        FROM unnest(%s::int[], %s::varchar[]) AS v(id, fingerprint)
+        WHERE u.id = v.id
+        """,
+        ([user_id for user_id, _ in delivered], [fp for _, fp in delivered])
+    )
+
+
+# --- Outbox: надёжная очередь исходящих сообщений ---
+# Сообщение — кортеж (idempotency_key, chat_id, method, payload: dict, priority).
+# Повторная вставка с тем же ключом ничего не делает, поэтому продюсеры можно безопасно перезапускать.
+async def _insert_outbox(cursor, messages):
+    if not messages:
+        return 0
+    await cursor.execute(
+        """
+        INSERT INTO outbox (idempotency_key, chat_id, method, payload, priority)
+        SELECT * FROM unnest(%s::varchar[], %s::bigint[], %s::varchar[], %s::jsonb[], %s::smallint[])
+        ON CONFLICT (idempotency_key) DO NOTHING
+        """,
+        (
+            [m[0] for m in messages],
+            [m[1] for m in messages],
+            [m[2] for m in messages],
+            [Jsonb(m[3]) for m in messages],
+            [m[4] for m in messages],
+        )
+    )
+    return cursor.rowcount
+
+
+@instrumented
+async def enqueue_reminders(messages, sent_by_kind):
+    """Напоминания и отметки «отправлено сегодня» — в одной транзакции.
+    sent_by_kind — {kind: [(user_id, 'YYYY-MM-DD'), ...]}."""
+    conn = await get_connection()
+    try:
+        cursor = conn.cursor()
+        inserted = await _insert_outbox(cursor, messages)
+        for kind, sent in sent_by_kind.items():
+            await _mark_reminders_sent(cursor, kind, sent)
+        await conn.commit()
+        return inserted
+    finally:
+        await return_connection(conn)
+
+@instrumented
+async def enqueue_keyboard_batch(messages, delivered):
+    """Рассылка клавиатуры: сообщения в outbox и новые отпечатки раскладок — в одной транзакции."""
+    conn = await get_connection()
+    try:
+        cursor = conn.cursor()
+        inserted = await _insert_outbox(cursor, messages)
+        await _set_keyboard_fingerprints(cursor, delivered)
+        await conn.commit()
+        return inserted
+    finally:
+        await return_connection(conn)
+
+@instrumented
+async def complete_payment(payment_id, user_id, subscription_ends_at, messages):
+    """Успешная оплата: статус платежа, продление подписки и уведомления — одной транзакцией.
+    False — платёж уже был обработан (повторный вебхук), ничего не меняем."""
+    conn = await get_connection()
+    try:
+        cursor = conn.cursor()
+        await cursor.execute(
+            "UPDATE payments SET status = 'succeeded' WHERE id = %s AND status <> 'succeeded' RETURNING id",
+            (payment_id,)
+        )
+        if await cursor.fetchone() is None:
+            await conn.rollback()
+            return False
+        await cursor.execute(
+            "UPDATE users SET subscription_ends_at_d = %s WHERE id = %s",
+            (subscription_ends_at, user_id)
+        )
+        await _insert_outbox(cursor, messages)
+        await conn.commit()
+        user_cache.update(user_id, subscription_ends_at=subscription_ends_at)
+        return True
+    finally:
+        await return_connection(conn)
+
+@instrumented
+async def claim_outbox_batch(limit, lease_seconds=300):
+    """Забрать до limit готовых к отправке сообщений (FOR UPDATE SKIP LOCKED — воркеры не мешают друг другу).
+    Забранные строки получают статус 'sending' и «аренду»: если воркер упал, через lease_seconds их заберут снова.
+    Возвращает список (id, chat_id, method, payload, priority, attempts)."""
+    conn = await get_connection()
+    try:
+        cursor = conn.cursor()
+        await cursor.execute(
+            """
+            UPDATE outbox SET status = 'sending', attempts = attempts + 1,
+                   next_attempt_at = now() + make_interval(secs => %s)
+            WHERE id IN (
+                SELECT id FROM outbox
+                WHERE status IN ('pending', 'sending') AND next_attempt_at <= now()
+                ORDER BY priority, next_attempt_at
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, chat_id, method, payload, priority, attempts
+            """,
+            (lease_seconds, limit)
+        )
+        rows = await cursor.fetchall()
+        await conn.commit()
+        return sorted(rows, key=lambda r: (r[4], r[0]))
+    finally:
+        await return_connection(conn)
+
+@instrumented
+async def mark_outbox_sent(outbox_ids):
+    if not outbox_ids:
+        return
+    conn = await get_connection()
+    try:
+        cursor = conn.cursor()
+        await cursor.execute(
+            "UPDATE outbox SET status = 'sent', sent_at = now(), last_error = NULL WHERE id = ANY(%s::bigint[])",
+            (list(outbox_ids),)
+        )
+        await conn.commit()
+    finally:
+        await return_connection(conn)
+
+@instrumented
+async def mark_outbox_failed(failures):
+    """failures — список (id, ошибка, задержка до повтора в секундах или None для dead-letter)."""
+    if not failures:
+        return
+    conn = await get_connection()
+    try:
+        cursor = conn.cursor()
+        await cursor.execute(
+            """
+            UPDATE outbox AS o
+            SET status = CASE WHEN v.retry_in IS NULL THEN 'dead' ELSE 'pending' END,
+                next_attempt_at = now() + make_interval(secs => COALESCE(v.retry_in, 0)),
+                last_error = v.error
+            FROM unnest(%s::bigint[], %s::text[], %s::float8[]) AS v(id, error, retry_in)
+            WHERE o.id = v.id
+            """,
+            (
+                [f[0] for f in failures],
+                [f[1][:1000] for f in failures],
+                [f[2] for f in failures],
+            )
         )
-        row = cursor.fetchone()
-        return row[0] if row and row[0] else None
+        await conn.commit()
     finally:
-        return_connection(conn)
+        await return_connection(conn)
 
-def set_last_subscription_expiry_notified_date(user_id, date_str):
-    """Установить дату последнего отправленного уведомления об окончании подписки (YYYY-MM-DD)."""
-    conn = get_connection()
+@instrumented
+async def purge_outbox(keep_days=7):
+    """Удалить доставленные сообщения старше keep_days (dead-letter остаются для разбора)."""
+    conn = await get_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE users SET last_subscription_expiry_notified_date = %s WHERE id = %s",
-            (date_str, user_id)
+        await cursor.execute(
+            "DELETE FROM outbox WHERE status = 'sent' AND sent_at < now() - make_interval(days => %s)",
+            (keep_days,)
         )
-        conn.commit()
+        await conn.commit()
+        return cursor.rowcount
     finally:
-        return_connection(conn)
+        await return_connection(conn)
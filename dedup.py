@@ -0,0 +1,138 @@
+import asyncio
+
+from db import get_bot_state, set_bot_state, claim_update, purge_processed_updates
+
+# --- Дедупликация апдейтов Telegram ---
+# update_id у бота растут монотонно, поэтому хватает верхней отметки (high) и битовой карты последних
+# window id: память O(window) бит независимо от нагрузки, и нет «сброса» множества, после которого
+# дубли проходят снова. id старше окна на величину до window считаются уже обработанными; id ещё ниже —
+# возможный сброс счётчика: после недели без апдейтов Telegram начинает update_id с нового случайного
+# значения. Окно начинается заново, только когда подряд пришли RESET_CONFIRMATIONS новых id по
+# возрастанию (каждый не дальше window от предыдущего); одиночный старый повтор или поддельный вебхук
+# отбрасывается и состояние не стирает.
+# Режимы:
+#   memory  — только в процессе;
+#   persist — снимок (high + карта) раз в persist_interval сохраняется в bot_state и читается при старте:
+#             дубли после рестарта (Telegram повторяет неподтверждённые апдейты) тоже отсекаются;
+#   shared  — для нескольких реплик: кроме локального окна, каждый новый id «забирается» вставкой
+#             в processed_updates (один запрос); обработает только та реплика, чья вставка прошла.
+
+DEDUP_STATE_KEY = "update_dedup_window"
+RESET_CONFIRMATIONS = 3
+
+
+class UpdateWindow:
+    """Верхняя отметка + битовая карта окна (high - window, high]."""
+
+    __slots__ = ("window", "high", "bits", "reset_high", "reset_seen")
+
+    def __init__(self, window=4096):
+        self.window = window
+        self.high = None
+        self.bits = 0  # бит i — id (high - i) уже был
+        self.reset_high = None  # последний id кандидата в сброс и сколько таких пришло подряд
+        self.reset_seen = 0
+
+    def check_and_mark(self, update_id):
+        """True, если update_id уже встречался (или старше окна); иначе отметить и вернуть False."""
+        if self.high is None or update_id > self.high:
+            self.reset_high = None
+            shift = update_id - self.high if self.high is not None else self.window
+            self.bits = ((self.bits << shift) | 1) & ((1 << self.window) - 1) if shift < self.window else 1
+            self.high = update_id
+            return False
+        offset = self.high - update_id
+        if offset >= 2 * self.window:
+            return self._check_reset(update_id)
+        self.reset_high = None
+        if offset >= self.window:
+            return True
+        if self.bits >> offset & 1:
+            return True
+        self.bits |= 1 << offset
+        return False
+
+    def _check_reset(self, update_id):
+        """id намного ниже окна: до RESET_CONFIRMATIONS подряд идущих — дубль, затем окно с этого id."""
+        if self.reset_high is not None and 0 < update_id - self.reset_high <= self.window:
+            self.reset_seen += 1
+        else:
+            self.reset_seen = 1
+        self.reset_high = update_id
+        if self.reset_seen < RESET_CONFIRMATIONS:
+            return True
+        # Сброс update_id у Telegram: начинаем окно с этого id
+        self.high = update_id
+        self.bits = 1
+        self.reset_high = None
+        return False
+
+    def dump(self):
+        return f"{self.high}:{self.bits:x}" if self.high is not None else ""
+
+    def load(self, value):
+        if not value:
+            return
+        high, bits = value.split(":")
+        self.high = int(high)
+        self.bits = int(bits, 16) & ((1 << self.window) - 1)
+
+
+class UpdateDeduplicator:
+    def __init__(self, mode="persist", window=4096, persist_interval=5.0, bot_id=None):
+        self.mode = mode
+        self.window = UpdateWindow(window)
+        # update_id у каждого бота свои: снимок окна — под ключом с id бота (несколько ботов на одной базе)
+        self.state_key = f"{DEDUP_STATE_KEY}:{bot_id}" if bot_id else DEDUP_STATE_KEY
+        self.persist_interval = persist_interval
+        self._saved = None
+        self._task = None
+
+    async def is_duplicate(self, update_id):
+        if self.window.check_and_mark(update_id):
+            return True
+        if self.mode != "shared":
+            return False
+        try:
+            return not await claim_update(update_id)
+        except Exception as e:
+            # БД недоступна — лучше редкий дубль, чем потерянный апдейт
+            print(f"Update dedup claim error: {e}")
+            return False
+
+    async def start(self):
+        """Восстановить снимок окна (persist) и запустить фоновое сохранение / чистку."""
+        if self.mode == "persist":
+            try:
+                self.window.load(await get_bot_state(self.state_key))
+                self._saved = self.window.dump()
+            except Exception as e:
+                print(f"Update dedup load error: {e}")
+        if self.mode in ("persist", "shared") and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self._flush()
+
+    async def _flush(self):
+        try:
+            if self.mode == "persist":
+                value = self.window.dump()
+                if value != self._saved:
+                    await set_bot_state(self.state_key, value)
+                    self._saved = value
+            elif self.mode == "shared" and self.window.high is not None:
+                # Id старше окна отсекаются локально, их строки больше не нужны
+                await purge_processed_updates(self.window.high - self.window.window)
+        except Exception as e:
+            print(f"Update dedup flush error: {e}")
+
+    async def _loop(self):
+        interval = self.persist_interval if self.mode == "persist" else 600
+        while True:
+            await asyncio.sleep(interval)
+            await self._flush()
@@ -0,0 +1,66 @@
+import asyncio
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, DEFAULT_DESTINY
+
+from db import get_fsm_state, get_fsm_data, set_fsm_state, set_fsm_data, update_fsm_data, purge_fsm_states
+
+# --- FSM aiogram в Postgres ---
+# Состояние переживает рестарт (в том числе посреди /review) и общее для всех реплик бота.
+# Одна строка fsm_state на пользователя, только пока есть состояние или данные; в данных — только
+# маленькие значения (id событий, индекс), а не сами события. Брошенные состояния (не менялись дольше
+# ttl_hours) не читаются и раз в час удаляются.
+
+
+class PostgresStorage(BaseStorage):
+    def __init__(self, ttl_hours=24, purge_interval=3600):
+        self.ttl_hours = int(ttl_hours)
+        self.purge_interval = purge_interval
+        self._purge_task = None
+
+    @staticmethod
+    def _key(key: StorageKey):
+        """(chat_id, user_id, scope). Бот один на базу, поэтому bot_id не храним; scope пустой у обычных чатов."""
+        parts = []
+        if key.thread_id:
+            parts.append(f"t{key.thread_id}")
+        if key.business_connection_id:
+            parts.append(f"b{key.business_connection_id}")
+        if key.destiny != DEFAULT_DESTINY:
+            parts.append(f"d{key.destiny}")
+        return key.chat_id, key.user_id, ":".join(parts)
+
+    def start(self):
+        if self._purge_task is None:
+            self._purge_task = asyncio.create_task(self._purge_loop())
+
+    async def close(self):
+        if self._purge_task is not None:
+            self._purge_task.cancel()
+            await asyncio.gather(self._purge_task, return_exceptions=True)
+            self._purge_task = None
+
+    async def set_state(self, key, state=None):
+        if isinstance(state, State):
+            state = state.state
+        await set_fsm_state(self._key(key), state, self.ttl_hours)
+
+    async def get_state(self, key):
+        return await get_fsm_state(self._key(key), self.ttl_hours)
+
+    async def set_data(self, key, data):
+        await set_fsm_data(self._key(key), dict(data), self.ttl_hours)
+
+    async def get_data(self, key):
+        return await get_fsm_data(self._key(key), self.ttl_hours)
+
+    async def update_data(self, key, data):
+        return await update_fsm_data(self._key(key), dict(data), self.ttl_hours)
+
+    async def _purge_loop(self):
+        while True:
+            await asyncio.sleep(self.purge_interval)
+            try:
+                await purge_fsm_states(self.ttl_hours)
+            except Exception as e:
+                print(f"FSM purge error: {e}")
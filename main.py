@@ -1,11 +1,14 @@
 import asyncio
 import re
 import os
+import time
 import signal
 import hmac
+import base64
 import hashlib
 import json
 import urllib.parse
+from dataclasses import replace
 from datetime import datetime, timezone, timedelta, date
 from aiohttp import web
 from aiogram import Bot, Dispatcher
@@ -17,46 +20,42 @@ from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
 from aiogram import BaseMiddleware
 from aiogram.exceptions import TelegramBadRequest
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 
 from db import (
-    init_db, create_user, get_user, add_event,
-    get_today_events, save_analysis, set_review_time,
-    get_users_with_review_time, get_all_users, set_timezone,
-    get_users_with_review_time_and_tz, get_connection, return_connection,
-    set_user_name, set_user_is_female,
-    set_subscription_ends_at, set_trial_used, get_user_by_id,
+    init_db, create_user, get_user, get_user_id, add_event,
+    get_today_events, save_analysis, get_event_text, set_review_time,
+    set_timezone,
+    get_users_for_scheduler, get_due_reminders, get_reminder_targets,
+    set_user_name, set_user_is_female, set_streak, reset_current_streak,
+    get_recent_events, get_event_counts_by_day, get_webapp_stamp, get_webapp_stamp_by_id, get_bot_stats,
+    start_trial, get_user_by_id,
     create_payment as db_create_payment, get_payment_by_yookassa_id, mark_payment_succeeded,
-    set_payment_telegram_message
+    set_payment_telegram_message, get_bot_state, set_bot_state,
+    get_keyboard_broadcast_batch, enqueue_keyboard_batch, enqueue_reminders, complete_payment,
+    try_advisory_lock, release_advisory_lock, BROADCAST_LOCK_ID
 )
+from scheduler import ReminderScheduler, REVIEW, CHECKIN, EXPIRY, CHECKIN_TIME, EXPIRY_TIME
+from sender import MessageSender, PRIORITY_PAYMENT, PRIORITY_BROADCAST
+from outbox import OutboxWorkers, outbox_message
+from metrics import (
+    REGISTRY, CONTENT_TYPE as METRICS_CONTENT_TYPE, UPDATE_DURATION, API_REQUEST_DURATION,
+    REMINDER_TICK_DURATION, REMINDERS_DUE, REMINDERS_ENQUEUED
+)
+from tracing import TracingMiddleware, TelegramTracingMiddleware, set_handler
+from budget import round_trip_budget
+from fsm_storage import PostgresStorage
+from cluster import ClusterMember
+from dedup import UpdateDeduplicator
 
 # Опциональный импорт close_pool (может отсутствовать в старых версиях db.py)
 try:
     from db import close_pool
 except ImportError:
     # Если функция еще не добавлена в db.py, создаем заглушку
-    def close_pool():
-        pass
-
-# Опциональный импорт функций для отслеживания check-in уведомлений
-try:
-    from db import get_last_checkin_sent_date, set_last_checkin_sent_date
-except ImportError:
-    # Если функции еще не добавлены в db.py, создаем заглушки
-    def get_last_checkin_sent_date(user_id):
-        return None
-    
-    def set_last_checkin_sent_date(user_id, date_str):
-        pass
-
-# Опциональный импорт функций для отслеживания уведомлений об окончании подписки
-try:
-    from db import get_last_subscription_expiry_notified_date, set_last_subscription_expiry_notified_date
-except ImportError:
-    # Если функции еще не добавлены в db.py, создаем заглушки
-    def get_last_subscription_expiry_notified_date(user_id):
-        return None
-    
-    def set_last_subscription_expiry_notified_date(user_id, date_str):
+    async def close_pool():
         pass
 
 moscow_tz = timezone(timedelta(hours=3))
@@ -74,52 +73,95 @@ YOOKASSA_SECRET_KEY = os.environ.get("YOOKASSA_SECRET_KEY") # Секретный
 # Необязательные:
 # YOOKASSA_RETURN_URL — куда вернуть пользователя после оплаты (по умолчанию https://t.me/)
 # Порт для вебхука ЮKassa берётся из PORT (Railway подставляет сам) — ничего указывать не нужно
-
-# Инициализация БД при старте (с обработкой ошибок)
-try:
-    init_db()
-except Exception as e:
-    # Если не удалось подключиться при старте, попробуем позже при первом обращении
-    print(f"Warning: Could not initialize database at startup: {e}")
-    print("Database will be initialized on first use.")
-
-# Helper function to get timezone offset from user tuple
-# Handles both new schema (timezone_offset at index 6) and old schema (at index 7 if added)
+# REMINDER_SOURCE — откуда брать «кому пора напомнить»: memory (индекс в памяти, по умолчанию)
+#                   или sql (один запрос get_due_reminders к Postgres на каждый тик)
+REMINDER_SOURCE = os.environ.get("REMINDER_SOURCE", "memory").lower()
+# SEND_RATE_PER_SEC — общий темп рассылок/напоминаний (лимит Telegram ~30/с, часть оставляем ответам в чатах)
+# SEND_WORKERS — сколько сообщений отправляется параллельно
+SEND_RATE_PER_SEC = float(os.environ.get("SEND_RATE_PER_SEC", "25"))
+SEND_WORKERS = int(os.environ.get("SEND_WORKERS", "8"))
+# OUTBOX_WORKERS — сколько воркеров разбирают таблицу outbox; OUTBOX_MAX_ATTEMPTS — попыток до dead-letter
+OUTBOX_WORKERS = int(os.environ.get("OUTBOX_WORKERS", "2"))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "5"))
+# USER_CACHE_SIZE / USER_CACHE_TTL — кэш строк пользователей в db.py (по умолчанию 10000 строк на 30 с;
+#                   0 отключает кэш). Читаются в db.py.
+# DB_POOL_MIN_SIZE / DB_POOL_MAX_SIZE / DB_POOL_MAX_WAITING — размер пула соединений и очередь ожидания
+#                   (по умолчанию 1 / 10 / 10); DB_CHECK_IDLE_SECONDS — проверять соединения, простоявшие
+#                   дольше этого (30 с). Читаются в db.py.
+# DB_CONTRACT_MIGRATIONS — номера contract-миграций через запятую, которые разрешено применить (db.py,
+#                   CONTRACT_MIGRATIONS). Такие шаги удаляют то, что читает прошлый релиз (14 — старые
+#                   строковые колонки дат), поэтому задавать только после того, как все реплики обновлены.
+# SLOW_UPDATE_MS — апдейты дольше этого (мс) пишутся в лог одной JSON-строкой с разбивкой времени
+#                  (БД, ожидание пула, Telegram API, код хендлера) и списком вызовов
+SLOW_UPDATE_MS = float(os.environ.get("SLOW_UPDATE_MS", "1000"))
+# DB_BUDGET_MODE — бюджет обращений к БД на хендлер/тик/API-запрос (@round_trip_budget):
+#                  warn (по умолчанию, строка в лог), raise (исключение — для тестов и CI), off.
+#                  Сценарии бота в режиме raise прогоняет tests/test_round_trip_budgets.py (нужен TEST_DATABASE_URL)
+# METRICS_TOKEN — GET /metrics отдаётся только с заголовком Authorization: Bearer <METRICS_TOKEN>;
+#                 без переменной /metrics закрыт (404) — веб-сервер бота публичный
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+# TELEGRAM_API_URL — другой адрес Bot API (локальный telegram-bot-api или benchmarks/fake_telegram.py)
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")
+# TELEGRAM_WEBHOOK_URL — если задан (https://ВАШ-ДОМЕН.railway.app), апдейты принимаются вебхуком на том же
+#                  веб-сервере вместо long polling; при старте вызывается setWebhook. Без него — polling
+#                  (локальная разработка). TELEGRAM_WEBHOOK_PATH — путь (по умолчанию /webhook/telegram).
+#                  TELEGRAM_WEBHOOK_SECRET — секрет заголовка X-Telegram-Bot-Api-Secret-Token
+#                  (по умолчанию выводится из BOT_TOKEN, одинаковый на всех репликах)
+TELEGRAM_WEBHOOK_URL = os.environ.get("TELEGRAM_WEBHOOK_URL")
+TELEGRAM_WEBHOOK_PATH = os.environ.get("TELEGRAM_WEBHOOK_PATH", "/webhook/telegram")
+TELEGRAM_WEBHOOK_SECRET = os.environ.get("TELEGRAM_WEBHOOK_SECRET")
+# FSM_STORAGE — где хранить состояние диалогов: postgres (по умолчанию; переживает рестарт, общее для реплик)
+#               или memory (локальная разработка без БД). FSM_STATE_TTL_HOURS — через сколько часов без
+#               изменений состояние считается брошенным и удаляется (по умолчанию 24)
+FSM_STORAGE = os.environ.get("FSM_STORAGE", "postgres").lower()
+FSM_STATE_TTL_HOURS = int(os.environ.get("FSM_STATE_TTL_HOURS", "24"))
+# REMINDER_SHARDS — для нескольких реплик: пользователи делятся на столько шардов, реплики арендуют их
+#                   в Postgres и напоминания считают только для своих (cluster.py); напоминания тогда берутся
+#                   SQL-запросом (индекс в памяти не видит изменений, сделанных на других репликах).
+#                   0 (по умолчанию) — один процесс. Рассылка клавиатуры при деплое в любом случае идёт
+#                   только с одной реплики (advisory lock).
+# CLUSTER_HEARTBEAT_SECONDS / CLUSTER_LEASE_SECONDS — продление аренды и её срок (по умолчанию 10 / 30 с)
+# REMINDER_CATCHUP_MINUTES — в кластере запрос напоминаний просматривает столько последних минут, чтобы
+#                   не потерять минуту при передаче шарда между репликами (по умолчанию 5)
+# UPDATE_DEDUP — защита от повторной обработки апдейта: persist (по умолчанию; окно id в памяти, снимок
+#                в bot_state — переживает рестарт), shared (несколько реплик: id забирается в Postgres), memory.
+#                UPDATE_DEDUP_WINDOW — размер окна id (по умолчанию 4096)
+UPDATE_DEDUP = os.environ.get("UPDATE_DEDUP", "persist").lower()
+UPDATE_DEDUP_WINDOW = int(os.environ.get("UPDATE_DEDUP_WINDOW", "4096"))
+REMINDER_SHARDS = int(os.environ.get("REMINDER_SHARDS", "0"))
+CLUSTER_HEARTBEAT_SECONDS = float(os.environ.get("CLUSTER_HEARTBEAT_SECONDS", "10"))
+CLUSTER_LEASE_SECONDS = float(os.environ.get("CLUSTER_LEASE_SECONDS", "30"))
+REMINDER_CATCHUP_MINUTES = int(os.environ.get("REMINDER_CATCHUP_MINUTES", "5"))
+# /api/events: график по умолчанию за CHART_DEFAULT_DAYS дней, запрошенный диапазон — не длиннее CHART_MAX_DAYS
+CHART_DEFAULT_DAYS = 30
+CHART_MAX_DAYS = 400
+# WEBAPP_SESSION_TTL_SECONDS — сколько живёт токен сессии мини-приложения (/api/session, по умолчанию 3600);
+#                  WEBAPP_AUTH_MAX_AGE_SECONDS — initData старше (по auth_date) не принимается (по умолчанию 86400);
+#                  WEBAPP_SESSION_SECRET — ключ подписи токенов (по умолчанию выводится из BOT_TOKEN)
+WEBAPP_SESSION_TTL_SECONDS = int(os.environ.get("WEBAPP_SESSION_TTL_SECONDS", "3600"))
+WEBAPP_AUTH_MAX_AGE_SECONDS = int(os.environ.get("WEBAPP_AUTH_MAX_AGE_SECONDS", "86400"))
+WEBAPP_SESSION_SECRET = os.environ.get("WEBAPP_SESSION_SECRET")
+# /api/events: событий на страницу истории по умолчанию и максимум (limit=)
+EVENTS_PAGE_SIZE = 100
+EVENTS_PAGE_MAX = 200
+
+# user — db.UserRecord (явный список колонок, доступ по именам полей)
 def get_user_timezone(user):
-    """Get timezone offset from user tuple, handling both old and new schemas"""
-    if len(user) > 7:
-        # New schema: timezone_offset is at index 6, created_at at 7
-        return user[6] if user[6] is not None else 3
-    elif len(user) > 6:
-        # Old schema with added column: timezone_offset might be at index 7
-        # Check both positions
-        if user[6] is not None and isinstance(user[6], int):
-            return user[6]
-        elif len(user) > 7 and user[7] is not None and isinstance(user[7], int):
-            return user[7]
-    return 3  # Default to Moscow
-
-# User tuple: id, telegram_id, current_streak, max_streak, last_clean_day, review_time, timezone_offset, created_at, name, is_female (if columns exist)
-def get_user_name(user):
-    """Get name from user tuple. Name at index 8 after ALTER ADD name."""
-    if len(user) > 8 and user[8]:
-        return user[8].strip()
-    return None
+    """Смещение часового пояса пользователя; по умолчанию Москва (UTC+3)."""
+    return user.timezone_offset if user.timezone_offset is not None else 3
 
-def get_user_is_female(user):
-    """True if user is female (for feminine endings in messages)."""
-    if len(user) > 9 and user[9] is not None:
-        return bool(user[9])
-    return False
+def get_user_local_date(user):
+    """Сегодняшняя дата по часовому поясу пользователя."""
+    return datetime.now(timezone(timedelta(hours=get_user_timezone(user)))).date()
 
 def get_display_name(user):
     """Имя для обращения в сообщениях: имя пользователя или «друг»."""
-    name = get_user_name(user)
+    name = user.name.strip() if user.name else None
     return name if name else "друг"
 
 def praise_word(user):
     """«Молодец» или «Умница» в зависимости от пола пользователя."""
-    return "Умница" if get_user_is_female(user) else "Молодец"
+    return "Умница" if user.is_female else "Молодец"
 
 # --- Безопасный ответ на callback (игнорирует ошибки "query is too old") ---
 async def safe_callback_answer(callback: CallbackQuery, text: str = None, show_alert: bool = False):
@@ -133,29 +175,11 @@ async def safe_callback_answer(callback: CallbackQuery, text: str = None, show_a
         else:
             raise  # Пробрасываем другие ошибки
 
-# --- Подписка (user tuple: ... index 10 = subscription_ends_at, 11 = trial_used) ---
-def get_subscription_ends_at(user):
-    """Дата окончания подписки (YYYY-MM-DD) или None."""
-    if len(user) > 10 and user[10]:
-        return user[10]
-    return None
-
-def get_trial_used(user):
-    """Использован ли пробный период."""
-    if len(user) > 11 and user[11] is not None:
-        return bool(user[11])
-    return False
-
+# --- Подписка ---
 def has_active_subscription(user):
     """Подписка активна (включая пробный период): сегодня <= subscription_ends_at."""
-    end = get_subscription_ends_at(user)
-    if not end:
-        return False
-    try:
-        end_date = date.fromisoformat(end)
-        return date.today() <= end_date
-    except (ValueError, TypeError):
-        return False
+    end = user.subscription_ends_at
+    return end is not None and date.today() <= end
 
 # --- FSM States ---
 class PogryzState(StatesGroup):
@@ -289,7 +313,7 @@ TRIAL_DAYS = 3
 def subscription_keyboard(user):
     """Клавиатура подписки: оплата 199 ₽ и пробный период (если ещё не использован)."""
     buttons = [[InlineKeyboardButton(text=f"Оформить подписку — {SUBSCRIPTION_PRICE_RUB} ₽/мес", callback_data="sub_pay")]]
-    if not get_trial_used(user):
+    if not user.trial_used:
         buttons.append([InlineKeyboardButton(text="Попробовать 3 дня бесплатно", callback_data="sub_trial")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
@@ -302,8 +326,8 @@ def paywall_message():
 
 async def send_paywall(target, user, is_admin: bool):
     """target: message или callback.message. Показать оплату и/или пробный период.
-    Кнопка «Попробовать бесплатно» показывается только если пробный период ещё не использован."""
-    user = get_user(user[1]) or user  # свежие данные из БД (trial_used и т.д.)
+    Кнопка «Попробовать бесплатно» показывается только если пробный период ещё не использован.
+    user — актуальная запись: все set_* обновляют её в кэше, перечитывать не нужно."""
     text = paywall_message()
     kb = subscription_keyboard(user)
     await target.answer(text, reply_markup=kb)
@@ -312,7 +336,7 @@ async def send_welcome_and_next(reply_target, user, state: FSMContext, is_admin:
     """Отправить приветствие и следующий шаг (время или настройки). reply_target — message или callback.message."""
     name = get_display_name(user)
     welcome_text = welcome_text_with_name(name)
-    if not user[5]:  # review_time не установлен
+    if not user.review_time:
         await reply_target.answer(
             welcome_text +
             "**Начнём настройку:**\n\n"
@@ -329,7 +353,7 @@ async def send_welcome_and_next(reply_target, user, state: FSMContext, is_admin:
         await reply_target.answer(
             welcome_text +
             f"**Твои настройки:**\n"
-            f"⏰ Время напоминаний: {user[5]}\n"
+            f"⏰ Время напоминаний: {user.review_time}\n"
             f"🌍 Часовой пояс: {tz_name}\n\n"
             f"Всё готово, {name}! Я буду помогать тебе каждый день. 🙌💙",
             parse_mode="Markdown",
@@ -338,14 +362,15 @@ async def send_welcome_and_next(reply_target, user, state: FSMContext, is_admin:
         await state.clear()
 
 
+@round_trip_budget(5)
 async def start(message: Message, state: FSMContext):
-    create_user(message.from_user.id)
-    user = get_user(message.from_user.id)
+    await create_user(message.from_user.id)
+    user = await get_user(message.from_user.id)
     if not user:
         await message.answer("Что-то пошло не так. Попробуйте ещё раз /start 🙌")
         return
 
-    name = get_user_name(user)
+    name = user.name.strip() if user.name else None
 
     # --- Если имя не указано — просим ввести ---
     if not name:
@@ -358,7 +383,7 @@ async def start(message: Message, state: FSMContext):
         return
 
     # --- Если пол не указан — спрашиваем для правильных окончаний ---
-    if len(user) > 9 and user[9] is None:
+    if user.is_female is None:
         await message.answer(
             f"{name}, укажи, пожалуйста, свой пол:",
             reply_markup=gender_keyboard()
@@ -369,7 +394,7 @@ async def start(message: Message, state: FSMContext):
     welcome_text = welcome_text_with_name(name)
 
     # --- Если review_time ещё не установлен ---
-    if not user[5]:  # review_time
+    if not user.review_time:
         await message.answer(
             welcome_text +
             "**Начнём настройку:**\n\n"
@@ -386,7 +411,7 @@ async def start(message: Message, state: FSMContext):
         await message.answer(
             welcome_text +
             f"**Твои настройки:**\n"
-            f"⏰ Время напоминаний: {user[5]}\n"
+            f"⏰ Время напоминаний: {user.review_time}\n"
             f"🌍 Часовой пояс: {tz_name}\n\n"
             f"Всё готово, {name}! Я буду помогать тебе каждый день. 🙌💙",
             parse_mode="Markdown",
@@ -395,20 +420,21 @@ async def start(message: Message, state: FSMContext):
 
 
 # --- Сохранение имени ---
+@round_trip_budget(4)
 async def save_name(message: Message, state: FSMContext):
     name = message.text.strip() if message.text else ""
     if not name or len(name) < 2:
         await message.answer("Напиши, пожалуйста, своё имя (хотя бы 2 буквы).")
         return
-    user = get_user(message.from_user.id)
+    user = await get_user(message.from_user.id)
     if not user:
         await message.answer("Напиши /start 🙌")
         await state.clear()
         return
-    set_user_name(user[0], name[:100])
-    user = get_user(message.from_user.id)  # обновлённые данные
+    await set_user_name(user.id, name[:100])
+    user = replace(user, name=name[:100].strip())
     # Если пол ещё не указан — спрашиваем
-    if len(user) > 9 and user[9] is None:
+    if user.is_female is None:
         await message.answer(
             f"{get_display_name(user)}, укажи, пожалуйста, свой пол:",
             reply_markup=gender_keyboard()
@@ -420,6 +446,7 @@ async def save_name(message: Message, state: FSMContext):
 
 
 # --- Кнопка "Начать" ---
+@round_trip_budget(4)
 async def start_button_handler(callback: CallbackQuery, state: FSMContext):
     await safe_callback_answer(callback)  # убираем "часики"
     await callback.message.delete()  # удаляем приветственное сообщение с кнопкой
@@ -442,8 +469,9 @@ def checkin_keyboard(user_id):
     ])
 
 # --- /pogryz ---
+@round_trip_budget(4)
 async def pogryz_start(message: Message, state: FSMContext):
-    user = get_user(message.from_user.id)
+    user = await get_user(message.from_user.id)
     if not user:
         await message.answer("Напиши /start 🙌")
         return
@@ -457,25 +485,27 @@ async def pogryz_start(message: Message, state: FSMContext):
     )
     await state.set_state(PogryzState.waiting_text)
 
+@round_trip_budget(4)
 async def save_pogryz(message: Message, state: FSMContext):
-    user = get_user(message.from_user.id)
+    user = await get_user(message.from_user.id)
     if not user:
         await message.answer("Напиши /start 🙌")
         return
 
-    add_event(user[0], message.text)
+    await add_event(user.id, message.text)
     name = get_display_name(user)
     await message.answer(
         f"✅ Событие записано!\n\n"
-        f"Спасибо, {name}, что поделил{'ся' if not get_user_is_female(user) else 'ась'}. Вечером мы сможем разобрать это вместе. 💙",
+        f"Спасибо, {name}, что поделил{'ся' if not user.is_female else 'ась'}. Вечером мы сможем разобрать это вместе. 💙",
         reply_markup=main_keyboard(message.from_user.id == ADMIN_ID, has_active_subscription(user))
     )
     await state.clear()
 
 
 # --- /review ---
+@round_trip_budget(4)
 async def start_review(message: Message, state: FSMContext):
-    user = get_user(message.from_user.id)
+    user = await get_user(message.from_user.id)
     if not user:
         await message.answer("Напиши /start 🙌")
         return
@@ -484,7 +514,7 @@ async def start_review(message: Message, state: FSMContext):
         await message.answer(" ", reply_markup=main_keyboard(False, False))
         return
 
-    events = get_today_events(user[0])
+    events = await get_today_events(user.id, get_user_local_date(user))
     name = get_display_name(user)
     if not events:
         await message.answer(
@@ -494,7 +524,8 @@ async def start_review(message: Message, state: FSMContext):
         )
         return
 
-    await state.update_data(events=events, index=0)
+    # В FSM только id событий и позиция: текст следующего события читается по id
+    await state.set_data({"event_ids": [event[0] for event in events], "index": 0})
     first_event = events[0]
     event_count = len(events)
     await message.answer(
@@ -506,38 +537,34 @@ async def start_review(message: Message, state: FSMContext):
     await state.set_state(ReviewState.waiting_analysis)
 
 
+@round_trip_budget(7)
 async def save_review_answer(message: Message, state: FSMContext):
     data = await state.get_data()
     index = data.get("index", 0)
-    events = data.get("events", [])
+    event_ids = data.get("event_ids", [])
+    if index >= len(event_ids):
+        await state.clear()
+        await message.answer("Разбор прервался. Напиши /review, чтобы начать заново 🙌")
+        return
 
-    user = get_user(message.from_user.id)
-    save_analysis(events[index][0], message.text)
+    user = await get_user(message.from_user.id)
+    await save_analysis(event_ids[index], message.text)
 
     index += 1
-    if index < len(events):
+    if index < len(event_ids):
         await state.update_data(index=index)
-        next_event = events[index]
+        next_text = await get_event_text(user.id, event_ids[index])
         await message.answer(
-            f"**Событие {index + 1} из {len(events)}:**\n\n"
-            f"_{next_event[3]}_\n\n"
+            f"**Событие {index + 1} из {len(event_ids)}:**\n\n"
+            f"_{next_text or '…'}_\n\n"
             "Что стало причиной? Какие чувства и мысли были в этот момент? 🤔"
         )
     else:
-        conn = get_connection()
-        try:
-            cur = conn.cursor()
-            cur.execute(
-                "UPDATE users SET current_streak = 0 WHERE id = %s",
-                (user[0],)
-            )
-            conn.commit()
-        finally:
-            return_connection(conn)
+        await reset_current_streak(user.id)
 
         name = get_display_name(user)
         await message.answer(
-            f"🎉 Отлично, {name}! Ты разобрал{'а' if get_user_is_female(user) else ''} все моменты дня!\n\n"
+            f"🎉 Отлично, {name}! Ты разобрал{'а' if user.is_female else ''} все моменты дня!\n\n"
             "Это важный шаг к пониманию себя и своих триггеров. "
             "Каждый разбор делает тебя сильнее! 💪✨\n\n"
             "Продолжай работать над собой, у тебя всё получается! 🌟",
@@ -547,6 +574,7 @@ async def save_review_answer(message: Message, state: FSMContext):
 
 
 # --- /set_time ---
+@round_trip_budget(4)
 async def save_time(message: Message, state: FSMContext):
     time_text = message.text.strip()
     if not re.match(r"^\d{2}:\d{2}$", time_text):
@@ -558,12 +586,13 @@ async def save_time(message: Message, state: FSMContext):
         )
         return
 
-    user = get_user(message.from_user.id)
+    user = await get_user(message.from_user.id)
     if not user:
         await message.answer("Напиши /start 🙌")
         return
 
-    set_review_time(user[0], time_text)
+    await set_review_time(user.id, time_text)
+    schedule_user(user, review_time=time_text)
     name = get_display_name(user)
     # Always prompt for timezone selection after setting review time (as per user request)
     # This ensures users set their timezone during initial setup
@@ -577,144 +606,189 @@ async def save_time(message: Message, state: FSMContext):
 
 
 # --- Reminder loop ---
-async def reminder_loop(bot: Bot):
-    while True:
+# Индекс напоминаний: строится один раз при старте, дальше обновляется через schedule_user()
+reminder_scheduler = ReminderScheduler(checkin_always=(ADMIN_ID,))
+
+
+def schedule_user(user, **changes):
+    """Обновить индекс напоминаний после смены времени разбора, часового пояса или подписки.
+    changes — новые значения, если строка user ещё не перечитана из БД (review_time=..., subscription_ends_at=...)."""
+    fields = {
+        "timezone_offset": get_user_timezone(user),
+        "review_time": user.review_time,
+        "subscription_ends_at": user.subscription_ends_at,
+    }
+    fields.update(changes)
+    reminder_scheduler.update_user(user.id, user.telegram_id, **fields)
+
+
+def expiry_reminder_message(user_row, last_sent, local_date):
+    """Уведомление об окончании подписки (10:00 по местному времени в последний день) или None."""
+    today_str = local_date.isoformat()
+    if user_row.subscription_ends_at != local_date:
+        return None  # Подписку уже продлили
+    # Проверяем, что уведомление еще не было отправлено сегодня
+    if last_sent == today_str:
+        return None
+    name = get_display_name(user_row)
+    is_trial = user_row.trial_used
+    trial_text = "пробный период" if is_trial else "подписка"
+    return outbox_message(
+        f"{EXPIRY}:{user_row.id}:{today_str}",
+        user_row.telegram_id,
+        f"📢 {name}, сегодня заканчивается твой {trial_text}! 📅\n\n"
+        "Чтобы продолжить пользоваться ботом (записывать моменты, "
+        "вечерний разбор и напоминания), оформи подписку. 💙",
+        reply_markup=subscription_keyboard(user_row)
+    )
+
+
+def checkin_reminder_message(user_row, last_sent, local_date):
+    """Дневной check-in (13:00 по местному времени) или None."""
+    today_str = local_date.isoformat()
+    # Проверяем, что уведомление еще не было отправлено сегодня
+    if last_sent == today_str:
+        return None
+    tg_id = user_row.telegram_id
+    # Админы всегда получают уведомления, остальные - только с активной подпиской
+    if tg_id != ADMIN_ID and not has_active_subscription(user_row):
+        return None
+    name = get_display_name(user_row)
+    return outbox_message(
+        f"{CHECKIN}:{user_row.id}:{today_str}",
+        tg_id,
+        f"Привет, {name}! 👋 Как дела? Как ты себя чувствуешь?",
+        reply_markup=checkin_keyboard(user_row.id)
+    )
+
+
+def review_reminder_message(user_row, today_events, local_date):
+    """Вечерний разбор в выбранное пользователем время."""
+    user_id, tg_id = user_row.id, user_row.telegram_id
+    key = f"{REVIEW}:{user_id}:{local_date.isoformat()}"
+    name = get_display_name(user_row)
+    if today_events:
+        return outbox_message(
+            key,
+            tg_id,
+            f"🌙 Добрый вечер, {name}! Время вечернего разбора!\n\n"
+            "У Вас есть записанные события за сегодня. "
+            "Давай разберём их вместе! 💙\n\n"
+            "Используй команду /review"
+        )
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text="✅ Да, целы", callback_data=f"yes_{user_id}"),
+            InlineKeyboardButton(text="❌ Нет, погрыз", callback_data=f"no_{user_id}")
+        ]
+    ])
+    return outbox_message(
+        key,
+        tg_id,
+        f"🌙 Добрый вечер, {name}!\n\n"
+        "Как дела? Целостны ли твои ногти сейчас? 💅",
+        reply_markup=keyboard
+    )
+
+
+def due_reminder_message(kind, target, local_date):
+    user_row, last_sent, today_events = target
+    if kind == EXPIRY:
+        return expiry_reminder_message(user_row, last_sent[kind], local_date)
+    if kind == CHECKIN:
+        return checkin_reminder_message(user_row, last_sent[kind], local_date)
+    if kind == REVIEW:
+        return review_reminder_message(user_row, today_events, local_date)
+    return None
+
+
+CLUSTER = None  # ClusterMember, если REMINDER_SHARDS > 0; устанавливается в main()
+
+
+async def get_due_now(utc_now):
+    """Список (kind, user_id, tg_id, local_date) на текущую минуту — из индекса в памяти или из Postgres."""
+    if CLUSTER is not None:
+        if not CLUSTER.owned:
+            return []
+        return await get_due_reminders(
+            utc_now,
+            checkin_time=CHECKIN_TIME,
+            expiry_time=EXPIRY_TIME,
+            checkin_always=(ADMIN_ID,),
+            node_id=CLUSTER.node_id,
+            shards=CLUSTER.shards,
+            window_minutes=REMINDER_CATCHUP_MINUTES,
+        )
+    if REMINDER_SOURCE == "sql":
+        return await get_due_reminders(
+            utc_now,
+            checkin_time=CHECKIN_TIME,
+            expiry_time=EXPIRY_TIME,
+            checkin_always=(ADMIN_ID,),
+        )
+    return reminder_scheduler.pop_due(utc_now)
+
+
+@round_trip_budget(8)
+async def reminder_tick(outbox: OutboxWorkers, utc_now):
+    """Один тик напоминаний: пакетно читаем нужных пользователей и одной транзакцией кладём сообщения
+    в outbox вместе с отметками «отправлено сегодня». Доставкой занимаются воркеры outbox,
+    поэтому число запросов к БД не зависит от числа пользователей, а сбой отправки не теряет сообщение."""
+    due = await get_due_now(utc_now)
+    if not due:
+        return 0
+    try:
+        return await _enqueue_due_reminders(outbox, due)
+    except Exception:
+        # Индекс в памяти уже переставил эти напоминания на завтра — возвращаем их, чтобы следующий тик
+        # попробовал снова. SQL-источник и кластер восстанавливаются сами (last_*_sent_date, окно догоняния)
+        if CLUSTER is None and REMINDER_SOURCE != "sql":
+            reminder_scheduler.restore(due)
+        raise
+
+
+async def _enqueue_due_reminders(outbox: OutboxWorkers, due):
+    for kind, _, _, _ in due:
+        REMINDERS_DUE.inc(kind=kind)
+    targets = await get_reminder_targets({user_id: local_date for _, user_id, _, local_date in due})
+    messages = []
+    sent = {REVIEW: [], CHECKIN: [], EXPIRY: []}
+    for kind, user_id, _, local_date in due:
+        target = targets.get(user_id)
+        if not target:
+            continue  # Пользователь удалён
+        message = due_reminder_message(kind, target, local_date)
+        if message:
+            messages.append(message)
+            sent[kind].append((user_id, local_date.isoformat()))
+    if not messages:
+        return 0
+    inserted = await enqueue_reminders(messages, sent)
+    REMINDERS_ENQUEUED.inc(inserted)
+    outbox.notify()
+    return inserted
+
+
+async def reminder_loop(outbox: OutboxWorkers):
+    # Индекс в памяти строим один раз; если БД недоступна — пробуем снова через минуту
+    while REMINDER_SOURCE != "sql" and CLUSTER is None:
         try:
-            utc_now = datetime.now(timezone.utc)
-            
-            # Get all users with their timezones
-            try:
-                all_users = get_all_users()
-            except Exception as e:
-                # Если ошибка соединения с БД, ждем и пробуем снова
-                print(f"Database connection error in reminder_loop: {e}")
-                await asyncio.sleep(60)  # Ждем минуту перед следующей попыткой
-                continue
-            
-            today_str = date.today().isoformat()
-            
-            for user_id, tg_id, tz_offset in all_users:
-                if tz_offset is None:
-                    continue  # Skip users without timezone set
-                
-                # Calculate user's local time
-                user_tz = timezone(timedelta(hours=tz_offset))
-                user_local_time = utc_now.astimezone(user_tz)
-                now_str = user_local_time.strftime("%H:%M")
-                current_hour = user_local_time.hour
-                current_minute = user_local_time.minute
-                
-                # Уведомление об окончании подписки (10:00 утра)
-                if current_hour == 10 and current_minute == 0:
-                    user_row = get_user(tg_id)
-                    if user_row:
-                        sub_end = get_subscription_ends_at(user_row)
-                        if sub_end:
-                            try:
-                                end_date = date.fromisoformat(sub_end)
-                                # Если подписка заканчивается сегодня
-                                if end_date == date.today():
-                                    # Проверяем, что уведомление еще не было отправлено сегодня
-                                    last_notified = get_last_subscription_expiry_notified_date(user_id)
-                                    if last_notified != today_str:
-                                        name = get_display_name(user_row)
-                                        is_trial = get_trial_used(user_row)
-                                        trial_text = "пробный период" if is_trial else "подписка"
-                                        try:
-                                            await bot.send_message(
-                                                tg_id,
-                                                f"📢 {name}, сегодня заканчивается твой {trial_text}! 📅\n\n"
-                                                "Чтобы продолжить пользоваться ботом (записывать моменты, "
-                                                "вечерний разбор и напоминания), оформи подписку. 💙",
-                                                reply_markup=subscription_keyboard(user_row)
-                                            )
-                                            set_last_subscription_expiry_notified_date(user_id, today_str)
-                                        except Exception:
-                                            pass  # Skip if user blocked bot or other error
-                            except (ValueError, TypeError):
-                                pass
-                
-                # 1:00 PM check-in notification (13:00-13:01)
-                # Проверяем диапазон, чтобы не пропустить уведомление
-                if current_hour == 13 and current_minute == 0:
-                    # Проверяем, что уведомление еще не было отправлено сегодня
-                    last_sent = get_last_checkin_sent_date(user_id)
-                    if last_sent == today_str:
-                        continue  # Уже отправлено сегодня
-                    
-                    # Проверяем подписку
-                    user_row = get_user(tg_id)
-                    if not user_row:
-                        continue
-                    
-                    # Админы всегда получают уведомления, остальные - только с активной подпиской
-                    if tg_id != ADMIN_ID and not has_active_subscription(user_row):
-                        continue
-                    
-                    keyboard = checkin_keyboard(user_id)
-                    try:
-                        name = get_display_name(user_row)
-                        await bot.send_message(
-                            tg_id,
-                            f"Привет, {name}! 👋 Как дела? Как ты себя чувствуешь?",
-                            reply_markup=keyboard
-                        )
-                        # Отмечаем, что уведомление отправлено сегодня
-                        set_last_checkin_sent_date(user_id, today_str)
-                    except Exception:
-                        pass  # Skip if user blocked bot or other error
-            
-            # Evening review reminders
-            try:
-                users = get_users_with_review_time_and_tz()
-            except Exception as e:
-                # Если ошибка соединения с БД, пропускаем вечерние напоминания в этой итерации
-                print(f"Database connection error getting review users: {e}")
-                users = []
-            
-            for user_id, tg_id, review_time, tz_offset in users:
-                if tz_offset is None:
-                    continue  # Skip users without timezone set
-                
-                # Calculate user's local time
-                user_tz = timezone(timedelta(hours=tz_offset))
-                user_local_time = utc_now.astimezone(user_tz)
-                now_str = user_local_time.strftime("%H:%M")
-                
-                if review_time == now_str:
-                    events = get_today_events(user_id)
-                    try:
-                        u = get_user(tg_id)
-                        name = get_display_name(u) if u else "друг"
-                        if events:
-                            await bot.send_message(
-                                tg_id,
-                                f"🌙 Добрый вечер, {name}! Время вечернего разбора!\n\n"
-                                "У Вас есть записанные события за сегодня. "
-                                "Давай разберём их вместе! 💙\n\n"
-                                "Используй команду /review"
-                            )
-                        else:
-                            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                                [
-                                    InlineKeyboardButton(text="✅ Да, целы", callback_data=f"yes_{user_id}"),
-                                    InlineKeyboardButton(text="❌ Нет, погрыз", callback_data=f"no_{user_id}")
-                                ]
-                            ])
-                            await bot.send_message(
-                                tg_id,
-                                f"🌙 Добрый вечер, {name}!\n\n"
-                                "Как дела? Целостны ли твои ногти сейчас? 💅",
-                                reply_markup=keyboard
-                            )
-                    except Exception:
-                        pass  # Skip if user blocked bot or other error
-            
+            reminder_scheduler.load(await get_users_for_scheduler())
+            break
+        except Exception as e:
+            print(f"Database connection error in reminder_loop: {e}")
             await asyncio.sleep(60)
+
+    while True:
+        try:
+            with REMINDER_TICK_DURATION.time():
+                await reminder_tick(outbox, datetime.now(timezone.utc))
         except Exception as e:
-            # Обработка любых других неожиданных ошибок
+            # Ошибка БД или любая другая неожиданная ошибка — пробуем на следующей минуте
             print(f"Unexpected error in reminder_loop: {e}")
-            await asyncio.sleep(60)  # Ждем минуту перед следующей попыткой
+        # Спим до начала следующей минуты — все напоминания привязаны к ЧЧ:ММ
+        now = datetime.now(timezone.utc)
+        await asyncio.sleep(60 - now.second - now.microsecond / 1_000_000)
 
 
 
@@ -722,12 +796,12 @@ async def reminder_loop(bot: Bot):
 async def gender_callback_handler(callback: CallbackQuery, state: FSMContext):
     if callback.data not in ("gender_yes", "gender_no"):
         return False
-    user = get_user(callback.from_user.id)
+    user = await get_user(callback.from_user.id)
     if not user:
         await safe_callback_answer(callback, "❌ Пользователь не найден")
         return True
-    set_user_is_female(user[0], callback.data == "gender_yes")
-    user = get_user(callback.from_user.id)
+    await set_user_is_female(user.id, callback.data == "gender_yes")
+    user = replace(user, is_female=callback.data == "gender_yes")
     try:
         await callback.message.edit_reply_markup(None)
     except Exception:
@@ -739,17 +813,17 @@ async def gender_callback_handler(callback: CallbackQuery, state: FSMContext):
 # --- Подписка: пробный период и оплата ---
 async def subscription_callback_handler(callback: CallbackQuery, state: FSMContext):
     if callback.data == "sub_trial":
-        user = get_user(callback.from_user.id)
+        user = await get_user(callback.from_user.id)
         if not user:
             await safe_callback_answer(callback, "❌ Пользователь не найден")
             return True
-        if get_trial_used(user):
+        if user.trial_used:
             await safe_callback_answer(callback, "Пробный период уже использован.", show_alert=True)
             return True
         end_date = date.today() + timedelta(days=TRIAL_DAYS)
-        set_subscription_ends_at(user[0], end_date.isoformat())
-        set_trial_used(user[0], True)
-        user = get_user(callback.from_user.id)  # перечитать из БД после обновления подписки
+        await start_trial(user.id, end_date)
+        user = replace(user, subscription_ends_at=end_date, trial_used=True)
+        schedule_user(user)
         try:
             await callback.message.delete()
         except Exception:
@@ -765,7 +839,7 @@ async def subscription_callback_handler(callback: CallbackQuery, state: FSMConte
         await safe_callback_answer(callback)
         return True
     if callback.data == "sub_pay":
-        user = get_user(callback.from_user.id)
+        user = await get_user(callback.from_user.id)
         if not user:
             await safe_callback_answer(callback, "❌ Пользователь не найден")
             return True
@@ -782,14 +856,14 @@ async def subscription_callback_handler(callback: CallbackQuery, state: FSMConte
                 "capture": True,  # списать сразу, без ручного подтверждения в личном кабинете
                 "confirmation": {"type": "redirect", "return_url": return_url},
                 "description": "Подписка на 1 месяц",
-                "metadata": {"user_id": str(user[0])},
+                "metadata": {"user_id": str(user.id)},
             })
             pay_id = payment.id
             url = payment.confirmation.confirmation_url if payment.confirmation else None
             if not url:
                 await safe_callback_answer(callback, "Ошибка создания платежа.", show_alert=True)
                 return True
-            db_create_payment(user[0], pay_id, SUBSCRIPTION_PRICE_RUB)
+            await db_create_payment(user.id, pay_id, SUBSCRIPTION_PRICE_RUB)
             try:
                 await callback.message.delete()
             except Exception:
@@ -801,7 +875,7 @@ async def subscription_callback_handler(callback: CallbackQuery, state: FSMConte
                 "После успешной оплаты подписка продлится автоматически. 💙",
                 reply_markup=main_keyboard(callback.from_user.id == ADMIN_ID, has_active_subscription(user))
             )
-            set_payment_telegram_message(pay_id, sent_msg.message_id)
+            await set_payment_telegram_message(pay_id, sent_msg.message_id)
         except Exception as e:
             await safe_callback_answer(callback, "Ошибка при создании платежа. Попробуйте позже.", show_alert=True)
             return True
@@ -810,6 +884,7 @@ async def subscription_callback_handler(callback: CallbackQuery, state: FSMConte
     return False
 
 # --- Кнопки Да/Нет и сохранение текста ---
+@round_trip_budget(6)
 async def button_handler(callback: CallbackQuery, state: FSMContext):
     # Handle gender selection (after name)
     if await gender_callback_handler(callback, state):
@@ -821,23 +896,22 @@ async def button_handler(callback: CallbackQuery, state: FSMContext):
     if callback.data.startswith("tz_"):
         tz_key = callback.data[3:]  # Remove "tz_" prefix
         if tz_key in RUSSIAN_TIMEZONES:
-            user = get_user(callback.from_user.id)
+            user = await get_user(callback.from_user.id)
             if not user:
                 await safe_callback_answer(callback, "❌ Пользователь не найден")
                 return
             
             tz_info = RUSSIAN_TIMEZONES[tz_key]
-            set_timezone(user[0], tz_info["offset"])
-            user = get_user(callback.from_user.id)  # обновить данные
-            
-            # Для новых пользователей без подписки — автоматически активируем триал
-            if callback.from_user.id != ADMIN_ID and not has_active_subscription(user) and not get_trial_used(user):
-                set_subscription_ends_at(user[0], (date.today() + timedelta(days=TRIAL_DAYS)).isoformat())
-                set_trial_used(user[0], True)
-                user = get_user(callback.from_user.id)
-                trial_activated = True
+            # Для новых пользователей без подписки — автоматически активируем триал (тем же UPDATE)
+            trial_activated = callback.from_user.id != ADMIN_ID and not has_active_subscription(user) and not user.trial_used
+            if trial_activated:
+                trial_ends_at = date.today() + timedelta(days=TRIAL_DAYS)
+                await set_timezone(user.id, tz_info["offset"], trial_ends_at=trial_ends_at)
+                user = replace(user, timezone_offset=tz_info["offset"], subscription_ends_at=trial_ends_at, trial_used=True)
             else:
-                trial_activated = False
+                await set_timezone(user.id, tz_info["offset"])
+                user = replace(user, timezone_offset=tz_info["offset"])
+            schedule_user(user)
             
             await callback.message.edit_reply_markup(None)
             name = get_display_name(user)
@@ -864,7 +938,7 @@ async def button_handler(callback: CallbackQuery, state: FSMContext):
     if callback.data.startswith("checkin_great_"):
         user_id = int(callback.data.split("_")[2])
         await callback.message.edit_reply_markup(None)
-        user = get_user(callback.from_user.id)
+        user = await get_user(callback.from_user.id)
         name = get_display_name(user) if user else "друг"
         await callback.message.answer(
             f"Это замечательно, {name}! 🎉\n\n"
@@ -878,8 +952,8 @@ async def button_handler(callback: CallbackQuery, state: FSMContext):
     if callback.data.startswith("checkin_nibbling_"):
         user_id = int(callback.data.split("_")[2])
         await callback.message.edit_reply_markup(None)
-        u = get_user(callback.from_user.id)
-        feel = "чувствовала" if (u and get_user_is_female(u)) else "чувствовал"
+        u = await get_user(callback.from_user.id)
+        feel = "чувствовала" if (u and u.is_female) else "чувствовал"
         await callback.message.answer(
             "Понимаю, такое бывает 😔\n\n"
             f"Расскажи, пожалуйста, что произошло? Что ты {feel} в этот момент?"
@@ -895,7 +969,7 @@ async def button_handler(callback: CallbackQuery, state: FSMContext):
         return
     
     user_id = int(callback.data.split("_")[1])
-    user = get_user(callback.from_user.id)
+    user = await get_user(callback.from_user.id)
     if not user:
         await safe_callback_answer(callback, "❌ Пользователь не найден")
         return
@@ -909,15 +983,15 @@ async def button_handler(callback: CallbackQuery, state: FSMContext):
     await callback.message.edit_reply_markup(None)
 
     if callback.data.startswith("yes_"):
-        today = datetime.now().date().isoformat()
-        last_clean = user[4]  # last_clean_day — уже считали этот день?
+        today = get_user_local_date(user)
+        last_clean = user.last_clean_day  # уже считали этот день?
         if last_clean == today:
             # Уже начислен +1 за сегодня (например, ответили «Да» на первом напоминании, потом сменили время)
             name = get_display_name(user)
-            current_streak = user[2] or 0
-            max_streak = user[3] or 0
+            current_streak = user.current_streak or 0
+            max_streak = user.max_streak or 0
             await callback.message.answer(
-                f"👍 Отлично, {name}! Ты уже отметил{'а' if get_user_is_female(user) else ''} этот день без грызения.\n\n"
+                f"👍 Отлично, {name}! Ты уже отметил{'а' if user.is_female else ''} этот день без грызения.\n\n"
                 f"📊 Твоя статистика без изменений:\n"
                 f"• Текущая серия: {current_streak} {'день' if current_streak == 1 else 'дней' if current_streak < 5 else 'дней'} 🔥\n"
                 f"• Максимальная серия: {max_streak} {'день' if max_streak == 1 else 'дней' if max_streak < 5 else 'дней'} ⭐",
@@ -925,18 +999,9 @@ async def button_handler(callback: CallbackQuery, state: FSMContext):
             )
             await safe_callback_answer(callback)
             return
-        current_streak = (user[2] or 0) + 1
-        max_streak = max(user[3] or 0, current_streak)
-        conn = get_connection()
-        try:
-            cur = conn.cursor()
-            cur.execute(
-                "UPDATE users SET current_streak = %s, max_streak = %s, last_clean_day = %s WHERE id = %s",
-                (current_streak, max_streak, today, user[0])
-            )
-            conn.commit()
-        finally:
-            return_connection(conn)
+        current_streak = (user.current_streak or 0) + 1
+        max_streak = max(user.max_streak or 0, current_streak)
+        await set_streak(user.id, current_streak, max_streak, today)
         name = get_display_name(user)
         await callback.message.answer(
             f"🎉 {praise_word(user)}, {name}! Продолжай в том же духе! 💪\n\n"
@@ -958,22 +1023,23 @@ async def button_handler(callback: CallbackQuery, state: FSMContext):
         await safe_callback_answer(callback)
 
 
+@round_trip_budget(7)
 async def save_callback_text(message: Message, state: FSMContext):
     data = await state.get_data()
     user_id = data.get("user_id")
-    add_event(user_id, message.text)
-    user = get_user(message.from_user.id)
-    events = get_today_events(user[0])
-    await state.clear()
+    await add_event(user_id, message.text)
+    user = await get_user(message.from_user.id)
+    events = await get_today_events(user.id, get_user_local_date(user))
     name = get_display_name(user)
     if not events:
+        await state.clear()
         await message.answer(
             f"🎉 Отлично, {name}! Сегодня нет записанных моментов!\n\n"
             "Это значит, что ты справляешься! Продолжай в том же духе! 💪✨",
             reply_markup=main_keyboard(message.from_user.id == ADMIN_ID, has_active_subscription(user))
         )
         return
-    await state.update_data(events=events, index=0)
+    await state.set_data({"event_ids": [event[0] for event in events], "index": 0})  # заменяет user_id
     first_event = events[0]
     event_count = len(events)
     await message.answer(
@@ -985,18 +1051,19 @@ async def save_callback_text(message: Message, state: FSMContext):
     await state.set_state(ReviewState.waiting_analysis)
 
 
+@round_trip_budget(5)
 async def save_checkin_nibbling(message: Message, state: FSMContext):
     data = await state.get_data()
     user_id = data.get("user_id")
-    user = get_user(message.from_user.id)
-    if not user or user[0] != user_id:
+    user = await get_user(message.from_user.id)
+    if not user or user.id != user_id:
         await message.answer(
             "❌ Произошла ошибка. Пожалуйста, попробуй ещё раз или напиши /start"
         )
         await state.clear()
         return
     # Log the message for evening review
-    add_event(user_id, f"[Дневной чек-ин] {message.text}")
+    await add_event(user_id, f"[Дневной чек-ин] {message.text}")
     name = get_display_name(user)
     await message.answer(
         f"Спасибо, {name}, что поделились! 🙏\n\n"
@@ -1007,9 +1074,10 @@ async def save_checkin_nibbling(message: Message, state: FSMContext):
     await state.clear()
 
 
+@round_trip_budget(5)
 async def keyboard_handler(message: Message, state: FSMContext):
     if message.text == "📌 Записать момент":
-        user = get_user(message.from_user.id)
+        user = await get_user(message.from_user.id)
         if not user:
             await message.answer("Напиши /start 🙌")
             return
@@ -1019,17 +1087,12 @@ async def keyboard_handler(message: Message, state: FSMContext):
             return
         await pogryz_start(message, state)
     elif message.text == "💳 Подписка":
-        user = get_user(message.from_user.id)
+        user = await get_user(message.from_user.id)
         if not user:
             await message.answer("Напиши /start 🙌")
             return
         if has_active_subscription(user):
-            end_str = get_subscription_ends_at(user)
-            try:
-                end_date = date.fromisoformat(end_str)
-                end_fmt = end_date.strftime("%d.%m.%Y")
-            except (ValueError, TypeError):
-                end_fmt = end_str or "—"
+            end_fmt = user.subscription_ends_at.strftime("%d.%m.%Y")
             await message.answer(
                 f"✅ Подписка активна до {end_fmt}.\n\n"
                 "Можете продлить в любой момент:",
@@ -1039,7 +1102,7 @@ async def keyboard_handler(message: Message, state: FSMContext):
             await send_paywall(message, user, message.from_user.id == ADMIN_ID)
             await message.answer(" ", reply_markup=main_keyboard(message.from_user.id == ADMIN_ID, False))
     elif message.text == "⚙️ Настройки":
-        user = get_user(message.from_user.id)
+        user = await get_user(message.from_user.id)
         if user and message.from_user.id != ADMIN_ID and not has_active_subscription(user):
             await send_paywall(message, user, False)
             await message.answer(" ", reply_markup=main_keyboard(False, False))
@@ -1049,7 +1112,7 @@ async def keyboard_handler(message: Message, state: FSMContext):
             reply_markup=settings_keyboard(message.from_user.id == ADMIN_ID)
         )
     elif message.text == "◀️ Назад":
-        user = get_user(message.from_user.id)
+        user = await get_user(message.from_user.id)
         has_sub = has_active_subscription(user) if user else True
         await message.answer(
             "◀️ Назад",
@@ -1064,7 +1127,7 @@ async def keyboard_handler(message: Message, state: FSMContext):
         )
         await state.set_state(TimeState.waiting_time)
     elif message.text == "🌍 Изменить часовой пояс":
-        user = get_user(message.from_user.id)
+        user = await get_user(message.from_user.id)
         if not user:
             await message.answer("Напиши /start 🙌")
             return
@@ -1079,7 +1142,7 @@ async def keyboard_handler(message: Message, state: FSMContext):
         await admin_stats(message)
     else:
         # Любое другое сообщение — подсказка: сначала кнопка, потом текст
-        user = get_user(message.from_user.id)
+        user = await get_user(message.from_user.id)
         has_sub = has_active_subscription(user) if user else True
         await message.answer(
             "Чтобы записать момент, сначала нажми кнопку «📌 Записать момент», а затем напиши, что произошло.",
@@ -1091,35 +1154,7 @@ async def admin_stats(message: Message):
     if message.from_user.id != ADMIN_ID:
         return
 
-    conn = get_connection()
-    try:
-        cur = conn.cursor()
-
-        # Всего пользователей
-        cur.execute("SELECT COUNT(*) FROM users")
-        users_count = cur.fetchone()[0]
-
-        # Новые сегодня
-        today = datetime.now().date().isoformat()
-        cur.execute(
-            "SELECT COUNT(*) FROM users WHERE created_at LIKE %s",
-            (f"{today}%",)
-        )
-        new_today = cur.fetchone()[0]
-
-        # Всего событий
-        cur.execute("SELECT COUNT(*) FROM events")
-        events_count = cur.fetchone()[0]
-
-        # Активные сегодня
-        cur.execute("""
-            SELECT COUNT(DISTINCT user_id)
-            FROM events
-            WHERE datetime LIKE %s
-        """, (f"{today}%",))
-        active_today = cur.fetchone()[0]
-    finally:
-        return_connection(conn)
+    users_count, new_today, events_count, active_today = await get_bot_stats(datetime.now(timezone.utc).date())
 
     await message.answer(
         "📊 *Статистика бота*\n\n"
@@ -1134,29 +1169,81 @@ async def admin_stats(message: Message):
 
 
 # --- Рассылка актуального меню при старте бота ---
-async def broadcast_keyboard_on_startup(bot: Bot):
-    """При каждом деплое отправляет всем пользователям актуальное меню."""
+BROADCAST_STATE_KEY = "keyboard_broadcast"
+BROADCAST_BATCH_SIZE = 500
+
+
+def keyboard_fingerprint(markup):
+    """Короткий отпечаток раскладки клавиатуры: меняется только при изменении кнопок/параметров."""
+    return hashlib.sha256(markup.model_dump_json(exclude_none=True).encode()).hexdigest()[:16]
+
+
+def main_keyboard_fingerprints():
+    return {
+        "admin": keyboard_fingerprint(main_keyboard(is_admin=True)),
+        "subscribed": keyboard_fingerprint(main_keyboard(is_admin=False, has_subscription=True)),
+        "unsubscribed": keyboard_fingerprint(main_keyboard(is_admin=False, has_subscription=False)),
+    }
+
+
+async def broadcast_keyboard_on_startup(outbox: OutboxWorkers):
+    """При деплое отправляет актуальное меню только тем, у кого оно изменилось.
+
+    Для каждого пользователя хранится отпечаток последней доставленной раскладки (keyboard_fingerprint),
+    прогресс прохода по id сохраняется в bot_state — после рестарта рассылка продолжается с того же места.
+    Сообщения идут через outbox с самым низким приоритетом, чтобы не вытеснять живой трафик.
+    При нескольких репликах рассылку ведёт та, что взяла advisory lock; остальные пропускают
+    (если она упадёт, прогресс сохранён — продолжит следующая запущенная реплика)."""
     try:
-        users = get_all_users()
-        for user_id, tg_id, _ in users:
-            try:
-                is_admin = tg_id == ADMIN_ID
-                user_row = get_user(tg_id)
-                has_sub = has_active_subscription(user_row) if user_row else False
-                await bot.send_message(
-                    tg_id,
-                    " ",
-                    reply_markup=main_keyboard(is_admin=is_admin, has_subscription=has_sub)
-                )
-                await asyncio.sleep(0.05)  # Небольшая пауза, чтобы не упереться в лимиты
-            except Exception:
-                pass  # Пользователь заблокировал бота или другая ошибка — пропускаем
-    except Exception:
-        pass  # Ошибка при получении пользователей — не падаем при старте
+        lock = await try_advisory_lock(BROADCAST_LOCK_ID)
+    except Exception as e:
+        print(f"Keyboard broadcast stopped: {e}")
+        return
+    if lock is None:
+        print("Keyboard broadcast: another replica is running it, skipping")
+        return
+    try:
+        fingerprints = main_keyboard_fingerprints()
+        markups = {
+            fingerprints["admin"]: main_keyboard(is_admin=True),
+            fingerprints["subscribed"]: main_keyboard(is_admin=False, has_subscription=True),
+            fingerprints["unsubscribed"]: main_keyboard(is_admin=False, has_subscription=False),
+        }
+        # Ключ идемпотентности уникален для прохода: раскладка пользователя может вернуться к прежней
+        # (подписка → истекла → продлена), и старая строка outbox с тем же отпечатком не должна её глушить.
+        # Повторов внутри прохода нет и после рестарта: отпечаток меняется той же транзакцией, что и outbox
+        run_id = f"{time.time_ns():x}"
+        after_id = int(await get_bot_state(BROADCAST_STATE_KEY) or 0)
+        if after_id:
+            print(f"Keyboard broadcast: resuming after user id {after_id}")
+        while True:
+            batch, last_id = await get_keyboard_broadcast_batch(
+                after_id, BROADCAST_BATCH_SIZE, ADMIN_ID, date.today(), fingerprints
+            )
+            if last_id is None:
+                break
+            messages = [
+                outbox_message(f"keyboard:{user_id}:{wanted}:{run_id}", tg_id, " ",
+                               reply_markup=markups[wanted], priority=PRIORITY_BROADCAST)
+                for user_id, tg_id, wanted in batch
+            ]
+            # Отпечаток обновляется вместе с постановкой в outbox: доставку (и отказ заблокировавших бота)
+            # дальше ведут воркеры, повторно на следующем деплое не отправляем
+            await enqueue_keyboard_batch(messages, [(user_id, wanted) for user_id, _, wanted in batch])
+            outbox.notify()
+            after_id = last_id
+            await set_bot_state(BROADCAST_STATE_KEY, str(after_id))
+        # Проход завершён — следующий деплой начнёт сначала
+        await set_bot_state(BROADCAST_STATE_KEY, "0")
+    except Exception as e:
+        # Ошибка БД — не падаем при старте, прогресс сохранён
+        print(f"Keyboard broadcast stopped: {e}")
+    finally:
+        await release_advisory_lock(lock, BROADCAST_LOCK_ID)
 
 
 # --- YooKassa webhook (подписка после оплаты) ---
-BOT_FOR_WEBHOOK = None  # устанавливается в main() для отправки сообщения пользователю
+OUTBOX = None  # воркеры outbox; устанавливаются в main() — будим их после оплаты
 
 async def yookassa_webhook(request):
     """Обработчик POST от YooKassa: payment.succeeded -> продлить подписку."""
@@ -1169,7 +1256,7 @@ async def yookassa_webhook(request):
     payment_id_yookassa = obj.get("id")
     if event != "payment.succeeded" or not payment_id_yookassa:
         return web.Response(status=200, text="OK")
-    row = get_payment_by_yookassa_id(payment_id_yookassa)
+    row = await get_payment_by_yookassa_id(payment_id_yookassa)
     if not row:
         return web.Response(status=200, text="OK")
     our_id, user_id, _, status, telegram_message_id = row
@@ -1185,63 +1272,78 @@ async def yookassa_webhook(request):
             return web.Response(status=200, text="OK")
     except Exception:
         return web.Response(status=200, text="OK")
-    mark_payment_succeeded(our_id)
-    user_row = get_user_by_id(user_id)
+    user_row = await get_user_by_id(user_id)
     if not user_row:
+        await mark_payment_succeeded(our_id)
         return web.Response(status=200, text="OK")
     today = date.today()
-    end_str = get_subscription_ends_at(user_row) if len(user_row) > 10 else None
-    if end_str:
-        try:
-            end_date = date.fromisoformat(end_str)
-            start = end_date if end_date >= today else today
-        except (ValueError, TypeError):
-            start = today
-    else:
-        start = today
+    end_date = user_row.subscription_ends_at
+    start = end_date if end_date and end_date >= today else today
     new_end = start + timedelta(days=30)
-    set_subscription_ends_at(user_id, new_end.isoformat())
-    telegram_id = user_row[1]
-    if BOT_FOR_WEBHOOK:
-        try:
-            if telegram_message_id:
-                try:
-                    await BOT_FOR_WEBHOOK.delete_message(chat_id=telegram_id, message_id=telegram_message_id)
-                except Exception:
-                    pass
-            name = get_display_name(user_row)
-            await BOT_FOR_WEBHOOK.send_message(
-                telegram_id,
-                f"✅ Оплата прошла успешно, {name}!\n\n"
-                f"Подписка продлена до {new_end.strftime('%d.%m.%Y')}. Спасибо! 💙"
-            )
-        except Exception:
-            pass
+    telegram_id = user_row.telegram_id
+    name = get_display_name(user_row)
+    messages = []
+    if telegram_message_id:
+        # Удаляем сообщение со ссылкой на оплату
+        messages.append(outbox_message(
+            f"payment:{payment_id_yookassa}:delete_link", telegram_id,
+            method="delete_message", message_id=telegram_message_id, priority=PRIORITY_PAYMENT
+        ))
+    # Подтверждение оплаты идёт первым в очереди — раньше напоминаний и рассылок
+    messages.append(outbox_message(
+        f"payment:{payment_id_yookassa}:confirmation", telegram_id,
+        f"✅ Оплата прошла успешно, {name}!\n\n"
+        f"Подписка продлена до {new_end.strftime('%d.%m.%Y')}. Спасибо! 💙",
+        priority=PRIORITY_PAYMENT
+    ))
+    # Статус платежа, продление и уведомления — одной транзакцией; повторный вебхук ничего не изменит
+    if await complete_payment(our_id, user_id, new_end, messages):
+        schedule_user(user_row, subscription_ends_at=new_end)
+        if OUTBOX:
+            OUTBOX.notify()
     return web.Response(status=200, text="OK")
 
 
 # --- Защита от дублирования сообщений (один update обрабатываем один раз) ---
-PROCESSED_UPDATE_IDS = set()
-MAX_PROCESSED_IDS = 5000
-
-
 class DeduplicationMiddleware(BaseMiddleware):
-    """Пропускает уже обработанные update_id — убирает двойные ответы."""
+    """Пропускает уже обработанные update_id — убирает двойные ответы (окно и режимы — в dedup.py)."""
+
+    def __init__(self, deduplicator: UpdateDeduplicator):
+        self.deduplicator = deduplicator
 
     async def __call__(self, handler, event, data):
-        if isinstance(event, Update):
-            uid = event.update_id
-            if uid in PROCESSED_UPDATE_IDS:
-                return  # Уже обрабатывали — не отвечаем повторно
-            PROCESSED_UPDATE_IDS.add(uid)
-            if len(PROCESSED_UPDATE_IDS) > MAX_PROCESSED_IDS:
-                PROCESSED_UPDATE_IDS.clear()
+        if isinstance(event, Update) and await self.deduplicator.is_duplicate(event.update_id):
+            return  # Уже обрабатывали — не отвечаем повторно
         return await handler(event, data)
 
 
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время работы каждого хендлера (inner middleware: хендлер уже выбран фильтрами)."""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        set_handler(name)
+        with UPDATE_DURATION.time(handler=name):
+            return await handler(event, data)
+
+
 # --- Проверка авторизации Telegram Web App ---
-def verify_telegram_webapp_data(init_data: str) -> dict:
-    """Проверяет и парсит initData от Telegram Web App."""
+# Оба ключа выводятся из BOT_TOKEN один раз при старте, а не на каждый запрос
+WEBAPP_DATA_KEY = hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest() if BOT_TOKEN else None
+if WEBAPP_SESSION_SECRET:
+    WEBAPP_SESSION_KEY = WEBAPP_SESSION_SECRET.encode()
+elif BOT_TOKEN:
+    WEBAPP_SESSION_KEY = hmac.new(BOT_TOKEN.encode(), b"webapp-session", hashlib.sha256).digest()
+else:
+    WEBAPP_SESSION_KEY = None
+
+
+def verify_telegram_webapp_data(init_data: str, max_age=None) -> dict:
+    """Проверяет и парсит initData от Telegram Web App. initData старше max_age секунд
+    (по auth_date; по умолчанию WEBAPP_AUTH_MAX_AGE_SECONDS) не принимается."""
+    if WEBAPP_DATA_KEY is None:
+        return None
     try:
         # Парсим initData
         parsed_data = urllib.parse.parse_qs(init_data)
@@ -1259,22 +1361,21 @@ def verify_telegram_webapp_data(init_data: str) -> dict:
         
         data_check_string = '\n'.join(data_check_string)
         
-        # Вычисляем секретный ключ
-        secret_key = hmac.new(
-            "WebAppData".encode(),
-            BOT_TOKEN.encode(),
-            hashlib.sha256
-        ).digest()
-        
         # Вычисляем hash
         calculated_hash = hmac.new(
-            secret_key,
+            WEBAPP_DATA_KEY,
             data_check_string.encode(),
             hashlib.sha256
         ).hexdigest()
         
-        # Проверяем hash
-        if calculated_hash != received_hash:
+        # Проверяем hash (сравнение за постоянное время)
+        if not hmac.compare_digest(calculated_hash, received_hash):
+            return None
+        
+        # Подписанные, но старые initData (перехваченная ссылка) не принимаем
+        auth_date = int(parsed_data.get('auth_date', ['0'])[0])
+        max_age = WEBAPP_AUTH_MAX_AGE_SECONDS if max_age is None else max_age
+        if time.time() - auth_date > max_age:
             return None
         
         # Извлекаем user данные
@@ -1289,127 +1390,260 @@ def verify_telegram_webapp_data(init_data: str) -> dict:
         return None
 
 
+# --- Сессии мини-приложения ---
+# /api/session один раз проверяет initData и выдаёт короткоживущий токен «user_id.telegram_id.exp.подпись».
+# Дальше запросы идут с Authorization: Bearer <токен>: проверка — один HMAC и сравнение за постоянное
+# время, без разбора initData и без поиска пользователя по telegram_id.
+def _session_signature(payload):
+    digest = hmac.new(WEBAPP_SESSION_KEY, payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+
+def issue_webapp_session(user_id, telegram_id):
+    """Токен сессии и время его истечения (unix)."""
+    expires_at = int(time.time()) + WEBAPP_SESSION_TTL_SECONDS
+    payload = f"{user_id}.{telegram_id}.{expires_at}"
+    return f"{payload}.{_session_signature(payload)}", expires_at
+
+
+def verify_webapp_session(token):
+    """(user_id, telegram_id) из действующего токена или None."""
+    if WEBAPP_SESSION_KEY is None:
+        return None
+    try:
+        payload, signature = token.rsplit(".", 1)
+        if not hmac.compare_digest(_session_signature(payload), signature):
+            return None
+        user_id, telegram_id, expires_at = (int(part) for part in payload.split("."))
+    except (AttributeError, ValueError):
+        return None
+    if expires_at < time.time():
+        return None
+    return user_id, telegram_id
+
+
+def authenticate_webapp_request(request, data):
+    """Кто делает запрос к API: (telegram_id, user_id, None) или (None, None, ошибка для 401).
+    По токену сессии известны оба id; по initData (старые клиенты) — только telegram_id."""
+    authorization = request.headers.get("Authorization", "")
+    if authorization.startswith("Bearer "):
+        session = verify_webapp_session(authorization[len("Bearer "):].strip())
+        if not session:
+            return None, None, "Session expired"
+        user_id, telegram_id = session
+        return telegram_id, user_id, None
+    init_data = data.get('initData', '')
+    if not init_data:
+        return None, None, "No initData"
+    user_data = verify_telegram_webapp_data(init_data)
+    if not user_data:
+        return None, None, "Invalid auth"
+    telegram_id = user_data.get('id')
+    if not telegram_id:
+        return None, None, "No user ID"
+    return telegram_id, None, None
+
+
 # --- API endpoints для мини-приложения ---
-async def api_user_handler(request):
-    """API endpoint для получения данных пользователя."""
-    print("API /api/user запрос получен")
+# Условные запросы: ответ помечается ETag из штампа версии пользователя (users.api_version,
+# users.last_event_id) и параметров запроса. Мини-приложение хранит ответ и шлёт If-None-Match;
+# если версия не менялась, отвечаем 304 после одного lookup по users — без событий и без сборки JSON.
+@round_trip_budget(2)
+async def api_session_handler(request):
+    """Обмен initData на токен сессии: initData проверяется один раз (подпись и свежесть auth_date)."""
     try:
         data = await request.json()
         init_data = data.get('initData', '')
-        
         if not init_data:
-            print("API /api/user: нет initData")
             return web.Response(status=401, text=json.dumps({"error": "No initData"}))
         
-        # Проверяем авторизацию
         user_data = verify_telegram_webapp_data(init_data)
-        if not user_data:
-            print("API /api/user: неверный initData")
+        if not user_data or not user_data.get('id'):
             return web.Response(status=401, text=json.dumps({"error": "Invalid auth"}))
         
-        telegram_id = user_data.get('id')
-        if not telegram_id:
-            return web.Response(status=401, text=json.dumps({"error": "No user ID"}))
+        telegram_id = user_data['id']
+        user_id = await get_user_id(telegram_id)
+        if not user_id:
+            return web.Response(status=404, text=json.dumps({"error": "User not found"}))
         
-        # Получаем данные пользователя из БД
-        user = get_user(telegram_id)
+        token, expires_at = issue_webapp_session(user_id, telegram_id)
+        return web.Response(
+            status=200,
+            text=json.dumps({"token": token, "expiresAt": expires_at}),
+            content_type='application/json',
+            headers={"Cache-Control": "no-store"}
+        )
+    except Exception as e:
+        print(f"Ошибка API session: {e}")
+        return web.Response(status=500, text=json.dumps({"error": str(e)}))
+
+
+def webapp_etag(kind, stamp, data, *extra):
+    """Слабый ETag ответа kind для штампа stamp и тела запроса data (initData не входит)."""
+    params = {k: v for k, v in data.items() if k != "initData"}
+    raw = json.dumps([kind, stamp.user_id, stamp.api_version, stamp.last_event_id, *extra, params],
+                     sort_keys=True, default=str)
+    return 'W/"' + hashlib.sha256(raw.encode()).hexdigest()[:24] + '"'
+
+
+def etag_matches(request, etag):
+    """Совпадает ли If-None-Match запроса с etag (сравнение слабое, как требует RFC 9110 для If-None-Match)."""
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return False
+    tags = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+
+def not_modified(etag):
+    return web.Response(status=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+
+
+@round_trip_budget(3)
+async def api_user_handler(request):
+    """API endpoint для получения данных пользователя."""
+    print("API /api/user запрос получен")
+    try:
+        data = await request.json()
+        
+        # Проверяем авторизацию: токен сессии или initData
+        telegram_id, user_id, auth_error = authenticate_webapp_request(request, data)
+        if auth_error:
+            print(f"API /api/user: {auth_error}")
+            return web.Response(status=401, text=json.dumps({"error": auth_error}))
+        
+        stamp = await (get_webapp_stamp_by_id(user_id) if user_id else get_webapp_stamp(telegram_id))
+        if not stamp:
+            print(f"API /api/user: пользователь не найден telegram_id={telegram_id}")
+            return web.Response(status=404, text=json.dumps({"error": "User not found"}))
+        etag = webapp_etag("user", stamp, data)
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        
+        # Получаем данные пользователя из БД (обычно из кэша)
+        user = await get_user_by_id(stamp.user_id)
         if not user:
             print(f"API /api/user: пользователь не найден telegram_id={telegram_id}")
             return web.Response(status=404, text=json.dumps({"error": "User not found"}))
         
         # Формируем ответ (created_at — дата регистрации в боте, для календаря)
-        created_at = user[7] if len(user) > 7 and user[7] else None
+        created_at = user.created_at
         response_data = {
-            "name": get_user_name(user) or "друг",
-            "current_streak": user[2] or 0,
-            "max_streak": user[3] or 0,
-            "created_at": created_at[:10] if created_at and len(created_at) >= 10 else None,
+            "name": get_display_name(user),
+            "current_streak": user.current_streak or 0,
+            "max_streak": user.max_streak or 0,
+            "created_at": created_at.date().isoformat() if created_at else None,
         }
         
         print(f"API /api/user: OK telegram_id={telegram_id}")
         return web.Response(
             status=200,
             text=json.dumps(response_data),
-            content_type='application/json'
+            content_type='application/json',
+            headers={"ETag": etag, "Cache-Control": "private, no-cache"}
         )
     except Exception as e:
         print(f"Ошибка API user: {e}")
         return web.Response(status=500, text=json.dumps({"error": str(e)}))
 
 
+def parse_chart_range(data, today):
+    """Диапазон дат графика из запроса: from/to (YYYY-MM-DD, по поясу пользователя) или days до сегодня.
+    По умолчанию — последние CHART_DEFAULT_DAYS дней; длина ограничена CHART_MAX_DAYS. None — неверный запрос."""
+    try:
+        end = date.fromisoformat(data["to"]) if data.get("to") else today
+        if data.get("from"):
+            start = date.fromisoformat(data["from"])
+        else:
+            start = end - timedelta(days=int(data.get("days") or CHART_DEFAULT_DAYS) - 1)
+    except (TypeError, ValueError):
+        return None
+    if start > end or (end - start).days >= CHART_MAX_DAYS:
+        return None
+    return start, end
+
+
+def parse_events_cursor(value):
+    """Курсор истории 'datetime,id' (как nextBefore в ответе) -> (datetime, id); None — неверный курсор."""
+    try:
+        dt_str, event_id = value.rsplit(",", 1)
+        dt = datetime.fromisoformat(dt_str.replace("Z", "+00:00"))
+        if dt.tzinfo is None:
+            return None
+        return dt, int(event_id)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+@round_trip_budget(5)
 async def api_events_handler(request):
-    """API endpoint для получения событий и данных для графика."""
+    """API endpoint для получения событий и данных для графика/календаря."""
     try:
         data = await request.json()
-        init_data = data.get('initData', '')
-        
-        if not init_data:
-            return web.Response(status=401, text=json.dumps({"error": "No initData"}))
-        
-        # Проверяем авторизацию
-        user_data = verify_telegram_webapp_data(init_data)
-        if not user_data:
-            return web.Response(status=401, text=json.dumps({"error": "Invalid auth"}))
         
-        telegram_id = user_data.get('id')
-        if not telegram_id:
-            return web.Response(status=401, text=json.dumps({"error": "No user ID"}))
+        # Проверяем авторизацию: токен сессии или initData
+        telegram_id, user_id, auth_error = authenticate_webapp_request(request, data)
+        if auth_error:
+            return web.Response(status=401, text=json.dumps({"error": auth_error}))
         
-        # Получаем данные пользователя из БД
-        user = get_user(telegram_id)
-        if not user:
+        # Штамп: id, версия и часовой пояс (дни графика — по местному времени пользователя).
+        # «Сегодня» входит в ETag: график по умолчанию кончается сегодняшним днём
+        stamp = await (get_webapp_stamp_by_id(user_id) if user_id else get_webapp_stamp(telegram_id))
+        if not stamp:
             return web.Response(status=404, text=json.dumps({"error": "User not found"}))
+        today = get_user_local_date(stamp)
+        etag = webapp_etag("events", stamp, data, today)
+        if etag_matches(request, etag):
+            return not_modified(etag)
         
-        # Получаем все события пользователя
-        conn = get_connection()
+        # Следующие страницы истории (before=<datetime,id>) — без графика, только события
+        before = None
+        if data.get("before"):
+            before = parse_events_cursor(data["before"])
+            if not before:
+                return web.Response(status=400, text=json.dumps({"error": "Invalid cursor"}))
         try:
-            cur = conn.cursor()
-            cur.execute("""
-                SELECT datetime, text FROM events
-                WHERE user_id = %s
-                ORDER BY datetime DESC
-                LIMIT 100
-            """, (user[0],))
-            events = cur.fetchall()
-        finally:
-            return_connection(conn)
+            limit = min(max(int(data.get("limit") or EVENTS_PAGE_SIZE), 1), EVENTS_PAGE_MAX)
+        except (TypeError, ValueError):
+            return web.Response(status=400, text=json.dumps({"error": "Invalid limit"}))
         
-        # Формируем данные для графика (последние 30 дней)
-        chart_data = []
-        today = date.today()
-        for i in range(30):
-            day = today - timedelta(days=29 - i)
-            day_str = day.isoformat()
+        response_data = {}
+        if before is None:
+            chart_range = parse_chart_range(data, today)
+            if not chart_range:
+                return web.Response(status=400, text=json.dumps({"error": "Invalid range"}))
+            start, end = chart_range
             
-            # Подсчитываем события за этот день
-            count = sum(1 for event in events if event[0] and event[0].startswith(day_str))
-            chart_data.append({
-                "date": day_str,
-                "value": count
-            })
+            # Точное число событий по дням — GROUP BY в Postgres, независимо от числа событий
+            counts = await get_event_counts_by_day(stamp.user_id, start, end)
+            response_data["chartData"] = [
+                {"date": day.isoformat(), "value": counts.get(day, 0)}
+                for day in (start + timedelta(days=i) for i in range((end - start).days + 1))
+            ]
+        
+        # Страница истории (keyset: каждая страница стоит одинаково); календарю при листании месяцев не нужна
+        events = []
+        if data.get("events", True):
+            events = await get_recent_events(stamp.user_id, limit=limit + 1, before=before)
+        has_more = len(events) > limit
+        events = events[:limit]
         
-        # События хранятся в UTC (сервер). Отдаём datetime с суффиксом Z,
+        # Отдаём datetime в UTC с суффиксом Z,
         # чтобы в браузере new Date() парсил как UTC и getHours() давал локальный час.
-        def as_utc_iso(dt_str):
-            if not dt_str:
-                return dt_str
-            s = (dt_str.strip() or "").rstrip("Zz")
-            if not s:
-                return dt_str
-            # Уже указана таймзона (например +03:00 или -05:00)
-            if "+" in s[-6:] or (len(s) >= 6 and s[-6] in "+-" and ":" in s[-3:]):
-                return dt_str
-            return s + "Z"
-
-        response_data = {
-            "events": [{"datetime": as_utc_iso(e[0]), "text": e[1]} for e in events],
-            "chartData": chart_data
-        }
+        def as_utc_iso(dt):
+            if not dt:
+                return None
+            return dt.astimezone(timezone.utc).isoformat().replace("+00:00", "Z")
+
+        response_data["events"] = [{"id": e[2], "datetime": as_utc_iso(e[0]), "text": e[1]} for e in events]
+        # Курсор следующей страницы: datetime с микросекундами, чтобы граница совпала точно
+        response_data["nextBefore"] = f"{as_utc_iso(events[-1][0])},{events[-1][2]}" if has_more else None
         
         return web.Response(
             status=200,
             text=json.dumps(response_data),
-            content_type='application/json'
+            content_type='application/json',
+            headers={"ETag": etag, "Cache-Control": "private, no-cache"}
         )
     except Exception as e:
         print(f"Ошибка API events: {e}")
@@ -1425,23 +1659,67 @@ async def cors_middleware(request, handler):
             headers={
                 "Access-Control-Allow-Origin": "*",
                 "Access-Control-Allow-Methods": "POST, GET, OPTIONS",
-                "Access-Control-Allow-Headers": "Content-Type",
+                "Access-Control-Allow-Headers": "Content-Type, If-None-Match, Authorization",
                 "Access-Control-Max-Age": "86400",
             },
         )
     response = await handler(request)
     response.headers["Access-Control-Allow-Origin"] = "*"
+    response.headers["Access-Control-Expose-Headers"] = "ETag"
     return response
 
 
+# --- Метрики HTTP API и /metrics ---
+@web.middleware
+async def metrics_middleware(request, handler):
+    route = request.match_info.route.resource
+    route = route.canonical if route is not None else "unmatched"
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        API_REQUEST_DURATION.observe(
+            time.perf_counter() - started, route=route, method=request.method, status=str(status)
+        )
+
+
+async def metrics_handler(request):
+    if not METRICS_TOKEN:
+        return web.Response(status=404, text="Not Found")
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        return web.Response(status=401, text="Unauthorized")
+    return web.Response(body=REGISTRY.render().encode(), headers={"Content-Type": METRICS_CONTENT_TYPE})
+
+
+def telegram_webhook_secret():
+    """Секрет вебхука Telegram (разрешены A-Z, a-z, 0-9, _ и -): из env или HMAC от токена бота."""
+    if TELEGRAM_WEBHOOK_SECRET:
+        return TELEGRAM_WEBHOOK_SECRET
+    return hmac.new(BOT_TOKEN.encode(), b"telegram-webhook", hashlib.sha256).hexdigest()
+
+
 # --- Webhook-сервер для ЮKassa ---
 # После оплаты ЮKassa шлёт запрос на наш сервер — подписка продлевается автоматически.
 # В личном кабинете ЮKassa: Настройки → HTTP-уведомления → URL: https://ВАШ-ДОМЕН.railway.app/webhook/yookassa
-async def start_webhook_server(port: int):
-    app = web.Application(middlewares=[cors_middleware])
+# В режиме вебхука (TELEGRAM_WEBHOOK_URL) сюда же Telegram присылает апдейты: передаются dp и bot.
+async def start_webhook_server(port: int, dp: Dispatcher = None, bot: Bot = None):
+    app = web.Application(middlewares=[metrics_middleware, cors_middleware])
     app.router.add_post("/webhook/yookassa", yookassa_webhook)
+    app.router.add_post("/api/session", api_session_handler)
     app.router.add_post("/api/user", api_user_handler)
     app.router.add_post("/api/events", api_events_handler)
+    app.router.add_get("/metrics", metrics_handler)
+    if dp is not None:
+        # Отвечает 200 сразу и обрабатывает апдейт в фоне; чужие запросы (без секрета) получают 401
+        SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=telegram_webhook_secret()).register(
+            app, path=TELEGRAM_WEBHOOK_PATH
+        )
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, "0.0.0.0", port)
@@ -1453,22 +1731,27 @@ async def start_webhook_server(port: int):
         pass
 
 
-# --- main ---
-async def main():
-    global BOT_FOR_WEBHOOK
-    bot = Bot(token=BOT_TOKEN)
-    BOT_FOR_WEBHOOK = bot
-    dp = Dispatcher(storage=MemoryStorage())
+# --- Диспетчер ---
+def create_fsm_storage():
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    return PostgresStorage(ttl_hours=FSM_STATE_TTL_HOURS)
 
-    # Webhook для ЮKassa: слушаем на PORT (Railway подставляет сам) или 8080 локально
-    port = os.environ.get("PORT") or os.environ.get("WEBHOOK_PORT") or "8080"
-    try:
-        asyncio.create_task(start_webhook_server(int(port)))
-    except Exception:
-        pass
+
+def create_update_deduplicator(bot_id=None):
+    return UpdateDeduplicator(mode=UPDATE_DEDUP, window=UPDATE_DEDUP_WINDOW, bot_id=bot_id)
+
+
+def create_dispatcher(storage=None, deduplicator=None):
+    """Dispatcher со всеми middleware и хендлерами бота. Используется в main() и в benchmarks/replay.py
+    (прогон записанных апдейтов через настоящие хендлеры)."""
+    dp = Dispatcher(storage=storage or create_fsm_storage())
 
     # Сначала ставим защиту от дублей
-    dp.update.outer_middleware(DeduplicationMiddleware())
+    dp.update.outer_middleware(DeduplicationMiddleware(deduplicator or create_update_deduplicator()))
+    dp.update.outer_middleware(TracingMiddleware(threshold_ms=SLOW_UPDATE_MS))
+    dp.message.middleware(HandlerMetricsMiddleware())
+    dp.callback_query.middleware(HandlerMetricsMiddleware())
 
     dp.message.register(start, Command("start"))
     dp.message.register(pogryz_start, Command("pogryz"))
@@ -1484,18 +1767,81 @@ async def main():
     dp.callback_query.register(start_button_handler, lambda c: c.data == "start_bot")
 
     dp.message.register(keyboard_handler)
+    return dp
+
+
+# --- main ---
+async def main():
+    global OUTBOX, CLUSTER
+
+    # Инициализация БД при старте (с обработкой ошибок)
+    try:
+        await init_db()
+    except Exception as e:
+        # Если не удалось подключиться при старте, попробуем позже при первом обращении
+        print(f"Warning: Could not initialize database at startup: {e}")
+        print("Database will be initialized on first use.")
+
+    if TELEGRAM_API_URL:
+        bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+    else:
+        bot = Bot(token=BOT_TOKEN)
+    bot.session.middleware(TelegramTracingMiddleware())
+    sender = MessageSender(bot, workers=SEND_WORKERS, rate=SEND_RATE_PER_SEC)
+    sender.start()
+    outbox = OutboxWorkers(sender, workers=OUTBOX_WORKERS, max_attempts=OUTBOX_MAX_ATTEMPTS)
+    outbox.start()
+    OUTBOX = outbox
+
+    deduplicator = create_update_deduplicator(bot_id=bot.id)
+    await deduplicator.start()  # снимок окна из прошлого запуска — до первого апдейта
+    dp = create_dispatcher(deduplicator=deduplicator)
+    if isinstance(dp.storage, PostgresStorage):
+        dp.storage.start()  # чистка брошенных состояний
+
+    # Webhook для ЮKassa (и для Telegram в режиме вебхука): слушаем на PORT (Railway подставляет сам) или 8080 локально
+    port = os.environ.get("PORT") or os.environ.get("WEBHOOK_PORT") or "8080"
+    server = None
+    try:
+        telegram_dp = dp if TELEGRAM_WEBHOOK_URL else None
+        server = asyncio.create_task(start_webhook_server(int(port), telegram_dp, bot))
+    except Exception:
+        pass
+
+    if REMINDER_SHARDS > 0:
+        CLUSTER = ClusterMember(REMINDER_SHARDS, CLUSTER_HEARTBEAT_SECONDS, CLUSTER_LEASE_SECONDS)
+        CLUSTER.start()
 
     # При старте отправляем всем пользователям актуальное меню (после деплоя не нужен /start)
-    asyncio.create_task(broadcast_keyboard_on_startup(bot))
+    asyncio.create_task(broadcast_keyboard_on_startup(outbox))
+
+    asyncio.create_task(reminder_loop(outbox))
 
-    asyncio.create_task(reminder_loop(bot))
-    
     try:
-        await dp.start_polling(bot)
+        if TELEGRAM_WEBHOOK_URL and server is not None:
+            # Вебхук не снимаем при остановке: при перезапуске/деплое апдейты копятся у Telegram и доходят
+            # до следующей реплики. Повторный setWebhook с тем же URL с нескольких реплик безопасен.
+            await bot.set_webhook(
+                TELEGRAM_WEBHOOK_URL.rstrip("/") + TELEGRAM_WEBHOOK_PATH,
+                secret_token=telegram_webhook_secret(),
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+            await server
+        else:
+            # Вебхук от прошлого деплоя в режиме вебхука мешает getUpdates (409 Conflict) — снимаем его;
+            # накопившиеся апдейты не сбрасываем, их заберёт polling
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
     finally:
+        if CLUSTER is not None:
+            await CLUSTER.stop()
+        await deduplicator.stop()
+        await dp.storage.close()
+        await outbox.stop()
+        await sender.stop()
         # Корректно закрываем пул соединений при остановке
         try:
-            close_pool()
+            await close_pool()
         except Exception:
             pass
 
@@ -1506,13 +1852,13 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         # Обработка Ctrl+C
         try:
-            close_pool()
+            asyncio.run(close_pool())
         except Exception:
             pass
     except Exception:
         # Обработка других исключений
         try:
-            close_pool()
+            asyncio.run(close_pool())
         except Exception:
             pass
         raise
\ No newline at end of file
@@ -0,0 +1,185 @@
+import bisect
+import time
+from contextlib import contextmanager
+
+# --- Метрики в формате Prometheus (text exposition 0.0.4) ---
+# Маленький реестр без внешних зависимостей: счётчики, gauge и гистограммы с метками.
+# Всё работает в одном event loop, поэтому блокировки не нужны.
+# Отдаётся на GET /metrics веб-сервера (start_webhook_server в main.py).
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        (registry or REGISTRY).register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: expected labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(labels[name] for name in self.labelnames)
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self._values.items()):
+            lines.extend(self._sample_lines(key, value))
+        return lines
+
+    def _sample_lines(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # [счётчики по корзинам (не накопительные)..., сумма, количество]
+            state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """with HISTOGRAM.time(label=...): — записать длительность блока в секундах."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _sample_lines(self, key, state):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), state):
+            cumulative += count
+            le = _format_value(bound)
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', le))} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(state[-2])}")
+        lines.append(f"{self.name}_count{labels} {state[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def on_collect(self, callback):
+        """callback() вызывается перед каждой выдачей /metrics — для gauge, которые снимаются «на момент»."""
+        self._collectors.append(callback)
+        return callback
+
+    def render(self):
+        for callback in self._collectors:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Metrics collector error: {e}")
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# --- Метрики бота ---
+UPDATE_DURATION = Histogram(
+    "bot_update_duration_seconds", "Время обработки апдейта Telegram хендлером", ("handler",)
+)
+DB_QUERY_DURATION = Histogram(
+    "bot_db_query_duration_seconds", "Время вызова функции db.py (с ожиданием соединения из пула)", ("function",)
+)
+DB_ERRORS = Counter(
+    "bot_db_errors_total", "Вызовы функций db.py, завершившиеся исключением", ("function",)
+)
+DB_POOL_CONNECTIONS = Gauge(
+    "bot_db_pool_connections", "Соединения пула Postgres по состоянию", ("state",)
+)
+DB_POOL_WAITING = Gauge(
+    "bot_db_pool_requests_waiting", "Запросы, ожидающие свободное соединение из пула"
+)
+USER_CACHE_ENTRIES = Gauge(
+    "bot_user_cache_entries", "Строк пользователей в кэше процесса"
+)
+USER_CACHE_LOOKUPS = Counter(
+    "bot_user_cache_lookups_total", "Обращения к кэшу пользователей: hit / miss", ("result",)
+)
+TELEGRAM_SEND_DURATION = Histogram(
+    "bot_telegram_send_duration_seconds", "Время вызова Bot API из очереди отправки", ("method",)
+)
+TELEGRAM_SEND_ERRORS = Counter(
+    "bot_telegram_send_errors_total", "Ошибки Bot API по классу исключения", ("method", "error")
+)
+SEND_QUEUE_SIZE = Gauge(
+    "bot_send_queue_size", "Сообщений в очереди MessageSender"
+)
+REMINDER_TICK_DURATION = Histogram(
+    "bot_reminder_tick_duration_seconds", "Длительность одного тика reminder_loop"
+)
+REMINDERS_DUE = Counter(
+    "bot_reminders_due_total", "Напоминаний, которым наступило время, по виду", ("kind",)
+)
+REMINDER_SHARDS_OWNED = Gauge(
+    "bot_reminder_shards_owned", "Шардов напоминаний, арендованных этой репликой (0 — не в кластере)"
+)
+REMINDERS_ENQUEUED = Counter(
+    "bot_reminders_enqueued_total", "Напоминаний, поставленных в outbox"
+)
+API_REQUEST_DURATION = Histogram(
+    "bot_api_request_duration_seconds", "Время обработки HTTP-запроса по маршруту", ("route", "method", "status")
+)
@@ -0,0 +1,119 @@
+import asyncio
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.types import InlineKeyboardMarkup, ReplyKeyboardMarkup
+
+from db import claim_outbox_batch, mark_outbox_sent, mark_outbox_failed, purge_outbox
+from sender import MessageSender, PRIORITY_REMINDER
+
+# --- Outbox: доставка сообщений из таблицы outbox ---
+# Продюсеры (reminder_loop, вебхук ЮKassa, рассылка меню) только вставляют строки в outbox
+# в той же транзакции, что и свои отметки; отправкой занимаются воркеры ниже.
+# Ошибка отправки не теряется: повтор с экспоненциальной задержкой, после max_attempts — статус 'dead'.
+
+
+def outbox_message(key, chat_id, text=None, reply_markup=None, priority=PRIORITY_REMINDER,
+                   method="send_message", **kwargs):
+    """Собрать сообщение для db.enqueue_*: (idempotency_key, chat_id, method, payload, priority)."""
+    payload = dict(kwargs)
+    if text is not None:
+        payload["text"] = text
+    if reply_markup is not None:
+        payload["reply_markup"] = reply_markup.model_dump(exclude_none=True)
+    return key, chat_id, method, payload, priority
+
+
+def _restore_payload(payload):
+    payload = dict(payload)
+    markup = payload.get("reply_markup")
+    if isinstance(markup, dict):
+        if "inline_keyboard" in markup:
+            payload["reply_markup"] = InlineKeyboardMarkup.model_validate(markup)
+        elif "keyboard" in markup:
+            payload["reply_markup"] = ReplyKeyboardMarkup.model_validate(markup)
+    return payload
+
+
+def _is_permanent_error(e):
+    """Ошибки, при которых повтор бессмысленен: бот заблокирован, чат не найден, сообщение уже удалено."""
+    return isinstance(e, (TelegramForbiddenError, TelegramBadRequest))
+
+
+class OutboxWorkers:
+    """Пул воркеров, разбирающих outbox через общий MessageSender (лимиты Telegram соблюдаются там)."""
+
+    def __init__(self, sender: MessageSender, workers=2, batch_size=50, max_attempts=5,
+                 poll_interval=2.0, base_backoff=5.0, max_backoff=3600.0):
+        self.sender = sender
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+            self._tasks.append(asyncio.create_task(self._purge_loop()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self):
+        """Разбудить воркеров сразу после вставки (не ждать poll_interval)."""
+        self._wakeup.set()
+
+    def backoff(self, attempts):
+        return min(self.max_backoff, self.base_backoff * 2 ** (attempts - 1))
+
+    async def process_batch(self):
+        """Забрать и отправить одну пачку. Возвращает число забранных строк."""
+        rows = await claim_outbox_batch(self.batch_size)
+        if not rows:
+            return 0
+        results = await asyncio.gather(*(
+            self.sender.submit(method, chat_id, priority, **_restore_payload(payload))
+            for _, chat_id, method, payload, priority, _ in rows
+        ), return_exceptions=True)
+        sent, failed = [], []
+        for (outbox_id, _, _, _, _, attempts), result in zip(rows, results):
+            if not isinstance(result, BaseException):
+                sent.append(outbox_id)
+            elif _is_permanent_error(result) or attempts >= self.max_attempts:
+                failed.append((outbox_id, repr(result), None))
+            elif isinstance(result, TelegramRetryAfter):
+                failed.append((outbox_id, repr(result), max(result.retry_after, self.backoff(attempts))))
+            else:
+                failed.append((outbox_id, repr(result), self.backoff(attempts)))
+        await mark_outbox_sent(sent)
+        await mark_outbox_failed(failed)
+        return len(rows)
+
+    async def _worker(self):
+        while True:
+            try:
+                if await self.process_batch():
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Outbox worker error: {e}")
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _purge_loop(self):
+        while True:
+            await asyncio.sleep(3600)
+            try:
+                await purge_outbox()
+            except Exception as e:
+                print(f"Outbox purge error: {e}")
@@ -0,0 +1,196 @@
+import heapq
+import itertools
+from datetime import datetime, date, timedelta, timezone
+
+# --- Индекс напоминаний ---
+# Min-heap по ближайшему времени срабатывания (UTC) для каждой пары (пользователь, вид напоминания).
+# Строится один раз при старте и обновляется точечно при смене времени разбора, пояса или подписки,
+# поэтому тик reminder_loop стоит O(пользователей к отправке), а не O(всех пользователей).
+
+REVIEW = "review"      # вечерний разбор в review_time
+CHECKIN = "checkin"    # дневной check-in в 13:00
+EXPIRY = "expiry"      # уведомление об окончании подписки в 10:00
+
+CHECKIN_TIME = "13:00"
+EXPIRY_TIME = "10:00"
+
+
+def _parse_hhmm(value):
+    """'21:30' -> (21, 30) или None, если формат неверный."""
+    try:
+        hour, minute = value.split(":")
+        hour, minute = int(hour), int(minute)
+    except (AttributeError, ValueError):
+        return None
+    if not (0 <= hour <= 23 and 0 <= minute <= 59):
+        return None
+    return hour, minute
+
+
+def _parse_date(value):
+    if isinstance(value, date):
+        return value
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _floor_minute(dt):
+    return dt.replace(second=0, microsecond=0)
+
+
+def next_local_time_utc(hhmm, tz_offset, not_before):
+    """Ближайший момент (UTC), когда у пользователя с поясом tz_offset наступит hhmm, не раньше not_before."""
+    parsed = _parse_hhmm(hhmm)
+    if parsed is None or tz_offset is None:
+        return None
+    user_tz = timezone(timedelta(hours=tz_offset))
+    local_now = _floor_minute(not_before.astimezone(user_tz))
+    candidate = local_now.replace(hour=parsed[0], minute=parsed[1])
+    if candidate < local_now:
+        candidate += timedelta(days=1)
+    return candidate.astimezone(timezone.utc)
+
+
+class _UserSlot:
+    __slots__ = ("tg_id", "timezone_offset", "review_time", "subscription_ends_at")
+
+    def __init__(self, tg_id, timezone_offset, review_time, subscription_ends_at):
+        self.tg_id = tg_id
+        self.timezone_offset = timezone_offset
+        self.review_time = review_time
+        self.subscription_ends_at = _parse_date(subscription_ends_at)
+
+
+class ReminderScheduler:
+    """Расписание напоминаний в памяти процесса.
+
+    checkin_always — telegram_id, которым check-in приходит без подписки (админ).
+    grace — насколько поздно ещё можно отправить напоминание (после паузы цикла или рестарта).
+    """
+
+    def __init__(self, checkin_always=(), grace=timedelta(minutes=10)):
+        self.checkin_always = frozenset(checkin_always)
+        self.grace = grace
+        self._users = {}
+        self._heap = []
+        self._entries = {}  # (user_id, kind) -> seq актуальной записи в куче; устаревшие пропускаются
+        self._seq = itertools.count()
+        self._popped = {}  # (user_id, kind) -> (fire_at, seq новой записи) последнего pop_due — для restore
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self, rows, now_utc=None):
+        """Построить индекс с нуля. rows: (id, telegram_id, timezone_offset, review_time, subscription_ends_at)."""
+        now_utc = now_utc or datetime.now(timezone.utc)
+        self._users.clear()
+        self._entries.clear()
+        self._heap = []
+        for user_id, tg_id, tz_offset, review_time, sub_end in rows:
+            self._users[user_id] = _UserSlot(tg_id, tz_offset, review_time, sub_end)
+            self._schedule_all(user_id, now_utc)
+        heapq.heapify(self._heap)
+
+    def update_user(self, user_id, tg_id, timezone_offset, review_time, subscription_ends_at, now_utc=None):
+        """Пересчитать все напоминания пользователя после изменения его настроек или подписки."""
+        now_utc = now_utc or datetime.now(timezone.utc)
+        self._users[user_id] = _UserSlot(tg_id, timezone_offset, review_time, subscription_ends_at)
+        self._schedule_all(user_id, now_utc, push=True)
+
+    def remove_user(self, user_id):
+        self._users.pop(user_id, None)
+        for kind in (REVIEW, CHECKIN, EXPIRY):
+            self._entries.pop((user_id, kind), None)
+
+    def next_fire_at(self):
+        """Время ближайшего напоминания (UTC) или None."""
+        while self._heap:
+            fire_at, seq, user_id, kind = self._heap[0]
+            if self._entries.get((user_id, kind)) == seq:
+                return fire_at
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self, now_utc):
+        """Забрать все наступившие напоминания: список (kind, user_id, tg_id, local_date).
+
+        local_date — дата срабатывания по местному времени пользователя (для отметок «уже отправлено»).
+
+        Повторяющиеся напоминания сразу переставляются на следующий день.
+        Сильно опоздавшие (старше grace) пропускаются, чтобы не будить пользователя не вовремя.
+        """
+        due = []
+        self._popped = {}
+        while self._heap and self._heap[0][0] <= now_utc:
+            fire_at, seq, user_id, kind = heapq.heappop(self._heap)
+            if self._entries.get((user_id, kind)) != seq:
+                continue
+            del self._entries[(user_id, kind)]
+            slot = self._users.get(user_id)
+            if slot is None:
+                continue
+            if kind != EXPIRY:
+                self._schedule(user_id, kind, fire_at + timedelta(minutes=1), push=True)
+            if now_utc - fire_at <= self.grace:
+                user_tz = timezone(timedelta(hours=slot.timezone_offset))
+                due.append((kind, user_id, slot.tg_id, fire_at.astimezone(user_tz).date()))
+                self._popped[(user_id, kind)] = (fire_at, self._entries.get((user_id, kind)))
+        return due
+
+    def restore(self, due):
+        """Вернуть напоминания из последнего pop_due на их исходное время — если поставить их в outbox
+        не удалось (ошибка БД). Следующий тик заберёт их снова, пока не истечёт grace.
+        Напоминания, которые уже пересчитал update_user/remove_user, не трогаются."""
+        for kind, user_id, _, _ in due:
+            popped = self._popped.pop((user_id, kind), None)
+            if popped is None or user_id not in self._users:
+                continue
+            fire_at, rescheduled_seq = popped
+            if self._entries.get((user_id, kind)) != rescheduled_seq:
+                continue
+            seq = next(self._seq)
+            self._entries[(user_id, kind)] = seq
+            heapq.heappush(self._heap, (fire_at, seq, user_id, kind))
+
+    # --- внутреннее ---
+    def _schedule_all(self, user_id, not_before, push=False):
+        for kind in (REVIEW, CHECKIN, EXPIRY):
+            self._schedule(user_id, kind, not_before, push)
+
+    def _schedule(self, user_id, kind, not_before, push):
+        self._entries.pop((user_id, kind), None)
+        fire_at = self._compute_fire_at(self._users[user_id], kind, not_before)
+        if fire_at is None:
+            return
+        seq = next(self._seq)
+        self._entries[(user_id, kind)] = seq
+        entry = (fire_at, seq, user_id, kind)
+        if push:
+            heapq.heappush(self._heap, entry)
+        else:
+            self._heap.append(entry)
+
+    def _compute_fire_at(self, slot, kind, not_before):
+        if slot.timezone_offset is None:
+            return None
+        if kind == REVIEW:
+            return next_local_time_utc(slot.review_time, slot.timezone_offset, not_before)
+        user_tz = timezone(timedelta(hours=slot.timezone_offset))
+        if kind == CHECKIN:
+            fire_at = next_local_time_utc(CHECKIN_TIME, slot.timezone_offset, not_before)
+            if slot.tg_id in self.checkin_always:
+                return fire_at
+            # Check-in только пока действует подписка; после продления update_user вернёт его в расписание
+            if slot.subscription_ends_at is None or fire_at.astimezone(user_tz).date() > slot.subscription_ends_at:
+                return None
+            return fire_at
+        if kind == EXPIRY:
+            if slot.subscription_ends_at is None:
+                return None
+            hour, minute = _parse_hhmm(EXPIRY_TIME)
+            local_fire = datetime.combine(slot.subscription_ends_at, datetime.min.time(), user_tz).replace(hour=hour, minute=minute)
+            fire_at = local_fire.astimezone(timezone.utc)
+            return fire_at if fire_at >= _floor_minute(not_before) else None
+        return None
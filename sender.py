@@ -0,0 +1,176 @@
+import asyncio
+import itertools
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+
+from metrics import TELEGRAM_SEND_DURATION, TELEGRAM_SEND_ERRORS, SEND_QUEUE_SIZE, REGISTRY
+
+# --- Централизованная отправка сообщений ---
+# Все массовые отправки (напоминания, рассылка меню, подтверждения оплаты) идут через одну очередь:
+# глобальный token bucket держит общий темп под лимитом Telegram (~30 сообщений/с),
+# лимит на чат не даёт слать в один чат чаще раза в секунду, а приоритеты гарантируют,
+# что подтверждение оплаты обгонит тысячи напоминаний и рассылку.
+
+PRIORITY_PAYMENT = 0
+PRIORITY_REMINDER = 1
+PRIORITY_BROADCAST = 2
+
+
+class TokenBucket:
+    """Простой token bucket: rate токенов в секунду, не больше burst накопленных."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Остановить выдачу токенов (ответ 429 / RetryAfter от Telegram)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class _Job:
+    __slots__ = ("method", "chat_id", "kwargs", "future", "attempts")
+
+    def __init__(self, method, chat_id, kwargs, future):
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.future = future
+        self.attempts = 0
+
+
+class MessageSender:
+    """Пул корутин-отправителей поверх одной приоритетной очереди.
+
+    rate — сообщений в секунду на весь бот, per_chat_interval — минимальный интервал между
+    сообщениями в один чат, max_retries — сколько раз повторять после RetryAfter.
+    """
+
+    def __init__(self, bot: Bot, workers=8, rate=25, per_chat_interval=1.0, max_retries=3):
+        self.bot = bot
+        self.workers = workers
+        self.bucket = TokenBucket(rate)
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self._queue = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._chat_next_at = {}
+        self._deferred = {}  # seq -> (TimerHandle, элемент очереди): ждут освобождения лимита чата
+        self._tasks = []
+        REGISTRY.on_collect(lambda: SEND_QUEUE_SIZE.set(self.qsize()))
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for handle, item in self._deferred.values():
+            handle.cancel()
+            self._queue.put_nowait(item)
+        self._deferred.clear()
+
+    def qsize(self):
+        return self._queue.qsize() + len(self._deferred)
+
+    def submit(self, method, chat_id, priority=PRIORITY_REMINDER, **kwargs):
+        """Поставить вызов bot.<method>(chat_id=..., **kwargs) в очередь. Возвращает Future с результатом."""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((priority, next(self._seq), _Job(method, chat_id, kwargs, future)))
+        return future
+
+    async def send_message(self, chat_id, text, priority=PRIORITY_REMINDER, **kwargs):
+        """Отправить сообщение через очередь и дождаться результата (исключения Telegram пробрасываются)."""
+        return await self.submit("send_message", chat_id, priority, text=text, **kwargs)
+
+    async def delete_message(self, chat_id, message_id, priority=PRIORITY_PAYMENT):
+        return await self.submit("delete_message", chat_id, priority, message_id=message_id)
+
+    # --- внутреннее ---
+    def _take_chat_slot(self, chat_id):
+        """0 — слот чата свободен и занят этим вызовом; иначе через сколько секунд он освободится."""
+        now = time.monotonic()
+        next_at = self._chat_next_at.get(chat_id, now)
+        if next_at > now:
+            return next_at - now
+        self._chat_next_at[chat_id] = now + self.per_chat_interval
+        if len(self._chat_next_at) > 10000:
+            # Чистим чаты, лимит которых давно истёк, чтобы словарь не рос бесконечно
+            self._chat_next_at = {c: t for c, t in self._chat_next_at.items() if t > now}
+        return 0
+
+    def _defer(self, delay, item):
+        """Вернуть задачу в очередь через delay секунд с прежними (priority, seq): воркер не ждёт,
+        а порядок сообщений в чате сохраняется."""
+        handle = asyncio.get_running_loop().call_later(delay, self._requeue, item)
+        self._deferred[item[1]] = (handle, item)
+
+    def _requeue(self, item):
+        self._deferred.pop(item[1], None)
+        self._queue.put_nowait(item)
+
+    async def _call(self, job):
+        started = time.perf_counter()
+        try:
+            return await getattr(self.bot, job.method)(chat_id=job.chat_id, **job.kwargs)
+        except Exception as e:
+            TELEGRAM_SEND_ERRORS.inc(method=job.method, error=type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_SEND_DURATION.observe(time.perf_counter() - started, method=job.method)
+
+    async def _worker(self):
+        while True:
+            priority, seq, job = await self._queue.get()
+            try:
+                if job.future.cancelled():
+                    continue
+                delay = self._take_chat_slot(job.chat_id)
+                if delay:
+                    # Лимит чата ещё не истёк: воркер берёт следующую задачу, эта вернётся в очередь позже
+                    self._defer(delay, (priority, seq, job))
+                    continue
+                await self.bucket.acquire()
+                result = await self._call(job)
+            except TelegramRetryAfter as e:
+                self.bucket.pause(e.retry_after)
+                job.attempts += 1
+                if job.attempts <= self.max_retries:
+                    self._queue.put_nowait((priority, next(self._seq), job))
+                elif not job.future.done():
+                    job.future.set_exception(e)
+            except asyncio.CancelledError:
+                if not job.future.done():
+                    job.future.cancel()
+                raise
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,51 @@
+import unittest
+
+from dedup import RESET_CONFIRMATIONS, UpdateWindow
+
+
+class UpdateWindowTest(unittest.TestCase):
+    def setUp(self):
+        self.window = UpdateWindow(window=64)
+        for update_id in range(1000, 1100):
+            self.assertFalse(self.window.check_and_mark(update_id))
+
+    def test_duplicates_inside_window(self):
+        self.assertTrue(self.window.check_and_mark(1099))
+        self.assertTrue(self.window.check_and_mark(1050))
+        self.assertFalse(self.window.check_and_mark(1100))
+
+    def test_single_stale_id_does_not_reset(self):
+        # Старый повтор / поддельный вебхук далеко ниже окна: отброшен, окно не сброшено
+        self.assertTrue(self.window.check_and_mark(5))
+        self.assertEqual(self.window.high, 1099)
+        self.assertTrue(self.window.check_and_mark(1099))
+        self.assertFalse(self.window.check_and_mark(1100))
+
+    def test_scattered_stale_ids_do_not_reset(self):
+        for update_id in (5, 700, 6, 300, 300, 301):
+            self.assertTrue(self.window.check_and_mark(update_id))
+            self.window.check_and_mark(self.window.high + 1)  # обычный трафик между ними
+        self.assertGreater(self.window.high, 1099)
+
+    def test_consecutive_low_ids_reset(self):
+        # Сброс update_id у Telegram: новая последовательность принимается после подтверждения
+        results = [self.window.check_and_mark(update_id) for update_id in range(10, 10 + RESET_CONFIRMATIONS)]
+        self.assertEqual(results, [True] * (RESET_CONFIRMATIONS - 1) + [False])
+        self.assertEqual(self.window.high, 10 + RESET_CONFIRMATIONS - 1)
+        self.assertFalse(self.window.check_and_mark(10 + RESET_CONFIRMATIONS))
+        self.assertTrue(self.window.check_and_mark(10 + RESET_CONFIRMATIONS))
+
+    def test_repeated_low_id_is_not_confirmation(self):
+        for _ in range(RESET_CONFIRMATIONS + 2):
+            self.assertTrue(self.window.check_and_mark(10))
+        self.assertEqual(self.window.high, 1099)
+
+    def test_dump_and_load(self):
+        restored = UpdateWindow(window=64)
+        restored.load(self.window.dump())
+        self.assertTrue(restored.check_and_mark(1099))
+        self.assertFalse(restored.check_and_mark(1100))
+
+
+if __name__ == "__main__":
+    unittest.main()
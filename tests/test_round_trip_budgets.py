@@ -0,0 +1,105 @@
+"""Бюджеты обращений к БД (@round_trip_budget) на основных сценариях бота.
+
+Апдейты сценариев из benchmarks/replay.py идут через настоящий Dispatcher (main.create_dispatcher)
+с fake Bot API и Postgres в отдельной схеме, DB_BUDGET_MODE=raise: превышение бюджета в хендлере
+пробрасывается из feed_update и роняет тест. Нужен Postgres в TEST_DATABASE_URL (или
+BENCH_DATABASE_URL); без него тест пропускается.
+
+    TEST_DATABASE_URL=postgresql://localhost/test python -m pytest tests/test_round_trip_budgets.py
+"""
+import itertools
+import os
+import sys
+import unittest
+from datetime import date
+from unittest import mock
+
+import psycopg
+from psycopg.conninfo import make_conninfo
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL") or os.environ.get("BENCH_DATABASE_URL")
+TEST_SCHEMA = "test_round_trip_budgets"
+SCENARIOS = ("onboarding", "timezone", "review", "payment")
+
+
+@unittest.skipUnless(TEST_DATABASE_URL, "TEST_DATABASE_URL is not set")
+class RoundTripBudgetTest(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        with psycopg.connect(TEST_DATABASE_URL, autocommit=True) as conn:
+            conn.execute(f'DROP SCHEMA IF EXISTS "{TEST_SCHEMA}" CASCADE')
+            conn.execute(f'CREATE SCHEMA "{TEST_SCHEMA}"')
+        cls.env = mock.patch.dict(os.environ, {
+            "DATABASE_URL": make_conninfo(TEST_DATABASE_URL, options=f"-c search_path={TEST_SCHEMA}"),
+            "DB_BUDGET_MODE": "raise",
+            "SLOW_UPDATE_MS": "60000",
+        })
+        cls.env.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.env.stop()
+        with psycopg.connect(TEST_DATABASE_URL, autocommit=True) as conn:
+            conn.execute(f'DROP SCHEMA IF EXISTS "{TEST_SCHEMA}" CASCADE')
+
+    async def asyncSetUp(self):
+        from aiogram import Bot
+        from aiogram.client.session.aiohttp import AiohttpSession
+        from aiogram.client.telegram import TelegramAPIServer
+        import budget
+        import db
+        import main
+        from dedup import UpdateDeduplicator
+        from fake_telegram import FakeTelegramServer
+        from replay import BENCH_TOKEN
+
+        # Модули могли быть импортированы раньше с другими env: режим и оплата — без внешнего API
+        for patcher in (mock.patch.object(budget, "DB_BUDGET_MODE", "raise"),
+                        mock.patch.object(main, "YOOKASSA_SHOP_ID", None),
+                        mock.patch.object(main, "YOOKASSA_SECRET_KEY", None)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        await db.init_db()
+        self.server = FakeTelegramServer()
+        url = await self.server.start()
+        self.bot = Bot(token=BENCH_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(url)))
+        self.dp = main.create_dispatcher(deduplicator=UpdateDeduplicator(mode="memory"))
+
+    async def asyncTearDown(self):
+        import db
+
+        await self.bot.session.close()
+        await self.server.stop()
+        await db.close_pool()
+
+    async def test_budget_mode_raises(self):
+        import db
+        from budget import RoundTripBudgetExceeded, budget_scope
+
+        with self.assertRaises(RoundTripBudgetExceeded):
+            with budget_scope("over_budget", 0):
+                await db.get_bot_stats(date.today())
+
+    async def test_scenarios_stay_within_budget(self):
+        from aiogram.types import Update
+        import db
+        from replay import generated_streams
+
+        update_ids = itertools.count(1)
+        for n, scenario in enumerate(SCENARIOS):
+            with self.subTest(scenario=scenario):
+                self.server.calls.clear()
+                [(tg_id, steps)] = generated_streams([scenario], 1, 800_000_000 + n)
+                for step, data in steps:
+                    update = Update.model_validate({"update_id": next(update_ids), **data}, context={"bot": self.bot})
+                    with self.subTest(step=step):
+                        await self.dp.feed_update(self.bot, update)
+                self.assertIsNotNone(await db.get_user(tg_id))
+                self.assertTrue(self.server.calls)
+
+
+if __name__ == "__main__":
+    unittest.main()
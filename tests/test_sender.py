@@ -0,0 +1,54 @@
+import asyncio
+import time
+import unittest
+
+from sender import MessageSender, PRIORITY_BROADCAST, PRIORITY_PAYMENT
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []  # (секунды от старта, chat_id, text)
+        self.started = time.monotonic()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((time.monotonic() - self.started, chat_id, text))
+        return text
+
+
+class MessageSenderTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.bot = FakeBot()
+        self.sender = MessageSender(self.bot, workers=2, rate=1000, per_chat_interval=0.3)
+        self.sender.start()
+
+    async def asyncTearDown(self):
+        await self.sender.stop()
+
+    async def test_chat_interval_does_not_block_workers(self):
+        busy = [self.sender.submit("send_message", 1, PRIORITY_BROADCAST, text=f"a{i}") for i in range(3)]
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.sender.qsize(), 2)  # отложенные задачи чата 1 видны в размере очереди
+        others = [self.sender.submit("send_message", 2, PRIORITY_PAYMENT, text="pay")]
+        others += [self.sender.submit("send_message", 3 + i, PRIORITY_BROADCAST, text=f"b{i}") for i in range(3)]
+        await asyncio.gather(*others)
+        # Оба воркера свободны, хотя у чата 1 ещё две задачи ждут лимит
+        self.assertLess(max(at for at, chat_id, _ in self.bot.sent if chat_id != 1), 0.2)
+        await asyncio.gather(*busy)
+        chat_1 = [(at, text) for at, chat_id, text in self.bot.sent if chat_id == 1]
+        self.assertEqual([text for _, text in chat_1], ["a0", "a1", "a2"])
+        for (previous, _), (current, _) in zip(chat_1, chat_1[1:]):
+            self.assertGreaterEqual(current - previous, 0.29)
+
+    async def test_stop_keeps_deferred_jobs(self):
+        self.sender.submit("send_message", 1, PRIORITY_BROADCAST, text="a0")
+        self.sender.submit("send_message", 1, PRIORITY_BROADCAST, text="a1")
+        await asyncio.sleep(0.05)
+        await self.sender.stop()
+        self.assertEqual(self.sender.qsize(), 1)
+        self.sender.start()
+        await asyncio.sleep(0.4)
+        self.assertEqual([text for _, _, text in self.bot.sent], ["a0", "a1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+import json
+import time
+from contextvars import ContextVar
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import Update
+
+from budget import budget_scope
+
+# --- Трассировка апдейтов ---
+# На каждый апдейт открывается span (contextvar), в который db.py и сессия бота записывают свои вызовы.
+# Если апдейт обрабатывался дольше порога, в лог уходит одна JSON-строка с разбивкой времени:
+# ожидание пула, запросы к БД, вызовы Telegram API и остаток — код хендлера.
+
+MAX_RECORDED_CALLS = 50
+
+_current_span = ContextVar("update_span", default=None)
+
+
+class UpdateSpan:
+    __slots__ = ("update_id", "event_type", "user_id", "handler", "started",
+                 "db_seconds", "pool_wait_seconds", "telegram_seconds", "calls", "dropped_calls")
+
+    def __init__(self, update_id, event_type, user_id):
+        self.update_id = update_id
+        self.event_type = event_type
+        self.user_id = user_id
+        self.handler = None
+        self.started = time.perf_counter()
+        self.db_seconds = 0.0
+        self.pool_wait_seconds = 0.0
+        self.telegram_seconds = 0.0
+        self.calls = []  # (kind, name, ms) в порядке вызова
+        self.dropped_calls = 0
+
+    def _add_call(self, kind, name, seconds):
+        if len(self.calls) < MAX_RECORDED_CALLS:
+            self.calls.append((kind, name, round(seconds * 1000, 2)))
+        else:
+            self.dropped_calls += 1
+
+    def to_record(self, total_seconds, budget=None):
+        other = max(0.0, total_seconds - self.db_seconds - self.telegram_seconds)
+        return {
+            "event": "slow_update",
+            "update_id": self.update_id,
+            "type": self.event_type,
+            "user_id": self.user_id,
+            "handler": self.handler,
+            "total_ms": round(total_seconds * 1000, 1),
+            "db_ms": round(self.db_seconds * 1000, 1),
+            "pool_wait_ms": round(self.pool_wait_seconds * 1000, 1),
+            "telegram_ms": round(self.telegram_seconds * 1000, 1),
+            "handler_ms": round(other * 1000, 1),
+            "db_round_trips": budget.round_trips if budget else None,
+            "db_checkouts": budget.checkouts if budget else None,
+            "calls": [{"kind": kind, "name": name, "ms": ms} for kind, name, ms in self.calls],
+            "dropped_calls": self.dropped_calls,
+        }
+
+
+def current_span():
+    return _current_span.get()
+
+
+def record_db(function, seconds):
+    """Вызов функции db.py (включая ожидание соединения)."""
+    span = _current_span.get()
+    if span is not None:
+        span.db_seconds += seconds
+        span._add_call("db", function, seconds)
+
+
+def record_pool_wait(seconds):
+    span = _current_span.get()
+    if span is not None:
+        span.pool_wait_seconds += seconds
+
+
+def record_telegram(method, seconds):
+    span = _current_span.get()
+    if span is not None:
+        span.telegram_seconds += seconds
+        span._add_call("telegram", method, seconds)
+
+
+def set_handler(name):
+    span = _current_span.get()
+    if span is not None:
+        span.handler = name
+
+
+def _event_user_id(update):
+    event = update.event
+    from_user = getattr(event, "from_user", None)
+    return from_user.id if from_user else None
+
+
+class TracingMiddleware(BaseMiddleware):
+    """Outer middleware на dp.update: span на апдейт и лог медленных апдейтов (дольше threshold_ms)."""
+
+    def __init__(self, threshold_ms=1000):
+        self.threshold = threshold_ms / 1000
+
+    async def __call__(self, handler, event, data):
+        if not isinstance(event, Update):
+            return await handler(event, data)
+        span = UpdateSpan(event.update_id, event.event_type, _event_user_id(event))
+        token = _current_span.set(span)
+        try:
+            # Область бюджета без лимита: считает обращения к БД за весь апдейт (лимиты — у хендлеров)
+            with budget_scope("update") as budget:
+                return await handler(event, data)
+        finally:
+            _current_span.reset(token)
+            total = time.perf_counter() - span.started
+            if total >= self.threshold:
+                print(json.dumps(span.to_record(total, budget), ensure_ascii=False))
+
+
+class TelegramTracingMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: время каждого вызова Bot API попадает в span текущего апдейта."""
+
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            record_telegram(type(method).__name__, time.perf_counter() - started)
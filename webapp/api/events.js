@@ -9,17 +9,34 @@ module.exports = async function handler(req, res) {
   try {
     const body = typeof req.body === 'string' ? JSON.parse(req.body || '{}') : (req.body || {});
     const initData = body.initData;
-    if (!initData) {
+    const authorization = req.headers['authorization'];
+    if (!initData && !authorization) {
       res.setHeader('Access-Control-Allow-Origin', '*');
       return res.status(401).json({ error: 'No initData' });
     }
     const response = await fetch(`${BOT_API_URL}/api/events`, {
       method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ initData }),
+      // Токен сессии (/api/session) и валидатор из кэша мини-приложения — бот ответит 304,
+      // если данные не менялись
+      headers: Object.assign(
+        { 'Content-Type': 'application/json' },
+        authorization ? { Authorization: authorization } : {},
+        req.headers['if-none-match'] ? { 'If-None-Match': req.headers['if-none-match'] } : {},
+      ),
+      // Диапазон графика/календаря (from, to, days), флаг events и страница истории (before, limit) — как есть
+      body: JSON.stringify({
+        initData, from: body.from, to: body.to, days: body.days, events: body.events,
+        before: body.before, limit: body.limit,
+      }),
     });
-    const text = await response.text();
     res.setHeader('Access-Control-Allow-Origin', '*');
+    res.setHeader('Access-Control-Expose-Headers', 'ETag');
+    for (const header of ['ETag', 'Cache-Control']) {
+      const value = response.headers.get(header);
+      if (value) res.setHeader(header, value);
+    }
+    if (response.status === 304) return res.status(304).end();
+    const text = await response.text();
     res.status(response.status).setHeader('Content-Type', 'application/json').send(text);
   } catch (e) {
     res.setHeader('Access-Control-Allow-Origin', '*');
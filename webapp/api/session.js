@@ -0,0 +1,29 @@
+// Прокси к /api/session бота на Railway: обмен initData на токен сессии. CommonJS для Vercel без конвертации.
+const BOT_API_URL = process.env.BOT_API_URL || 'https://nogtegrizzly-production.up.railway.app';
+
+module.exports = async function handler(req, res) {
+  if (req.method !== 'POST') {
+    res.setHeader('Access-Control-Allow-Origin', '*');
+    return res.status(405).json({ error: 'Method not allowed' });
+  }
+  try {
+    const body = typeof req.body === 'string' ? JSON.parse(req.body || '{}') : (req.body || {});
+    const initData = body.initData;
+    if (!initData) {
+      res.setHeader('Access-Control-Allow-Origin', '*');
+      return res.status(401).json({ error: 'No initData' });
+    }
+    const response = await fetch(`${BOT_API_URL}/api/session`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ initData }),
+    });
+    const text = await response.text();
+    res.setHeader('Access-Control-Allow-Origin', '*');
+    res.setHeader('Cache-Control', 'no-store');
+    res.status(response.status).setHeader('Content-Type', 'application/json').send(text);
+  } catch (e) {
+    res.setHeader('Access-Control-Allow-Origin', '*');
+    res.status(500).json({ error: String(e && (e.message || e)) });
+  }
+};
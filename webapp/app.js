@@ -10,17 +10,93 @@ let eventsData = null;
 let currentCalendarYear = new Date().getFullYear();
 let currentCalendarMonth = new Date().getMonth();
 
-// Даты с записанными моментами (грызли) — для календаря красный
-function getDatesWithEvents() {
-    const set = new Set();
-    const events = eventsData?.events || [];
-    events.forEach(e => {
-        if (e.datetime) {
-            const d = e.datetime.slice(0, 10);
-            set.add(d);
-        }
-    });
-    return set;
+// Число моментов (грызли) по дням 'YYYY-MM-DD' — считается на сервере (GROUP BY по дням в поясе пользователя)
+const dayCounts = new Map();
+const loadedMonths = new Set();
+
+// История моментов: первая страница приходит вместе с eventsData, дальше — по курсору nextBefore
+const HISTORY_PAGE_SIZE = 50;
+let historyCursor = null;
+let historyLoading = false;
+
+function mergeChartData(chartData) {
+    (chartData || []).forEach(d => dayCounts.set(d.date, d.value));
+}
+
+// Ответы API с ETag храним в localStorage: при повторном открытии шлём If-None-Match, и если данные
+// не менялись, бот отвечает 304 без тела — показываем сохранённый ответ
+const API_CACHE_PREFIX = 'apiCache:';
+
+function apiCacheKey(path, payload) {
+    const userId = tg.initDataUnsafe?.user?.id ?? '';
+    return `${API_CACHE_PREFIX}${userId}:${path}:${JSON.stringify(payload)}`;
+}
+
+function readApiCache(key) {
+    try {
+        return JSON.parse(localStorage.getItem(key) || 'null');
+    } catch (_) {
+        return null;
+    }
+}
+
+function writeApiCache(key, etag, text) {
+    try {
+        localStorage.setItem(key, JSON.stringify({ etag, text }));
+    } catch (_) {}  // хранилище недоступно или переполнено — просто без кэша
+}
+
+// Токен сессии: initData проверяется ботом один раз (/api/session), дальше запросы идут с токеном.
+// Если сессию открыть не удалось (старый бот, сеть), запросы идут с initData, как раньше
+let sessionToken = null;
+
+async function openSession() {
+    sessionToken = null;
+    try {
+        const response = await fetch((API_URL || window.location.origin) + '/api/session', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ initData: tg.initData }),
+        });
+        if (response.ok) sessionToken = (await response.json()).token || null;
+    } catch (error) {
+        console.error('Ошибка открытия сессии:', error);
+    }
+}
+
+// POST к API с токеном сессии (или initData); на 401 по истёкшему токену — новая сессия и один повтор
+async function apiFetch(path, payload, headers = {}) {
+    const send = () => {
+        const allHeaders = Object.assign({ 'Content-Type': 'application/json' }, headers);
+        let body = payload;
+        if (sessionToken) allHeaders['Authorization'] = 'Bearer ' + sessionToken;
+        else body = Object.assign({ initData: tg.initData }, payload);
+        return fetch((API_URL || window.location.origin) + path, {
+            method: 'POST',
+            headers: allHeaders,
+            body: JSON.stringify(body),
+        });
+    };
+    let response = await send();
+    if (response.status === 401 && sessionToken) {
+        await openSession();
+        response = await send();
+    }
+    return response;
+}
+
+// POST к API с условным запросом. Возвращает { ok, status, text }; на 304 text — из кэша
+async function postApi(path, payload) {
+    const key = apiCacheKey(path, payload);
+    const cached = readApiCache(key);
+    const headers = {};
+    if (cached && cached.etag) headers['If-None-Match'] = cached.etag;
+    const response = await apiFetch(path, payload, headers);
+    if (response.status === 304 && cached) return { ok: true, status: 200, text: cached.text };
+    const text = await response.text();
+    const etag = response.headers.get('ETag');
+    if (response.ok && etag) writeApiCache(key, etag, text);
+    return { ok: response.ok, status: response.status, text };
 }
 
 const MONTH_NAMES = ['Январь', 'Февраль', 'Март', 'Апрель', 'Май', 'Июнь', 'Июль', 'Август', 'Сентябрь', 'Октябрь', 'Ноябрь', 'Декабрь'];
@@ -53,10 +129,12 @@ async function init() {
             tg.showAlert('Ошибка: initData не доступен. Откройте мини-приложение кнопкой в боте.');
             return;
         }
+        await openSession();
         await loadUserData();
         await loadEventsData();
         updateMainScreen();
         setupEventHandlers();
+        setupHistoryScroll();
         renderCalendar(new Date().getFullYear(), new Date().getMonth());
         setActiveNav('mainScreen');
     } catch (error) {
@@ -69,13 +147,8 @@ async function loadUserData() {
     try {
         const initData = tg.initData;
         if (!initData) throw new Error('initData не доступен');
-        const url = (API_URL || window.location.origin) + '/api/user';
-        const response = await fetch(url, {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ initData }),
-        });
-        const errorText = await response.text();
+        const response = await postApi('/api/user', {});
+        const errorText = response.text;
         if (!response.ok) {
             let msg = errorText || `Код ${response.status}`;
             try {
@@ -96,17 +169,97 @@ async function loadUserData() {
 
 async function loadEventsData() {
     try {
-        const initData = tg.initData;
-        const response = await fetch((API_URL || window.location.origin) + '/api/events', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ initData }),
-        });
+        const response = await postApi('/api/events', {});
         if (!response.ok) throw new Error('Ошибка загрузки событий');
-        eventsData = await response.json();
+        eventsData = JSON.parse(response.text);
+        mergeChartData(eventsData.chartData);
     } catch (error) {
         console.error('Ошибка загрузки событий:', error);
-        eventsData = { events: [], chartData: [] };
+        eventsData = { events: [], chartData: [], nextBefore: null };
+    }
+    historyCursor = eventsData.nextBefore || null;
+    appendHistory(eventsData.events || []);
+}
+
+function formatEventDate(iso) {
+    const dt = new Date(iso);
+    if (isNaN(dt.getTime())) return '';
+    const pad = (n) => String(n).padStart(2, '0');
+    return `${pad(dt.getDate())}.${pad(dt.getMonth() + 1)}.${dt.getFullYear()} ${pad(dt.getHours())}:${pad(dt.getMinutes())}`;
+}
+
+function appendHistory(events) {
+    const list = document.getElementById('historyList');
+    events.forEach(e => {
+        const item = document.createElement('div');
+        item.className = 'history-item';
+        const date = document.createElement('div');
+        date.className = 'history-date';
+        date.textContent = formatEventDate(e.datetime);
+        const text = document.createElement('div');
+        text.className = 'history-text';
+        text.textContent = e.text || '';
+        item.append(date, text);
+        list.appendChild(item);
+    });
+    document.getElementById('historyEmpty').style.display = list.children.length ? 'none' : 'block';
+}
+
+// Следующая страница истории по курсору (keyset: каждая страница стоит серверу одинаково)
+async function loadMoreHistory() {
+    if (!historyCursor || historyLoading) return;
+    historyLoading = true;
+    let loaded = false;
+    try {
+        const response = await apiFetch('/api/events', { before: historyCursor, limit: HISTORY_PAGE_SIZE });
+        if (!response.ok) throw new Error('Ошибка загрузки истории');
+        const page = await response.json();
+        historyCursor = page.nextBefore || null;
+        appendHistory(page.events || []);
+        loaded = true;
+    } catch (error) {
+        console.error('Ошибка загрузки истории:', error);
+    } finally {
+        historyLoading = false;
+    }
+    // Страница короче экрана — наблюдатель не сработает снова, догружаем сразу
+    const sentinel = document.getElementById('historySentinel');
+    if (loaded && historyCursor && sentinel.offsetParent && sentinel.getBoundingClientRect().top < window.innerHeight + 200) {
+        loadMoreHistory();
+    }
+}
+
+function setupHistoryScroll() {
+    const sentinel = document.getElementById('historySentinel');
+    if (!('IntersectionObserver' in window)) {
+        window.addEventListener('scroll', () => {
+            if (sentinel.getBoundingClientRect().top < window.innerHeight + 200) loadMoreHistory();
+        });
+        return;
+    }
+    new IntersectionObserver(entries => {
+        if (entries.some(e => e.isIntersecting)) loadMoreHistory();
+    }, { rootMargin: '200px' }).observe(sentinel);
+}
+
+// Счётчики по дням за месяц календаря (без списка событий); каждый месяц загружается один раз
+async function loadMonthCounts(year, month) {
+    const monthKey = formatDateKey(year, month, 1).slice(0, 7);
+    if (loadedMonths.has(monthKey)) return false;
+    loadedMonths.add(monthKey);
+    try {
+        const response = await postApi('/api/events', {
+            from: formatDateKey(year, month, 1),
+            to: formatDateKey(year, month, new Date(year, month + 1, 0).getDate()),
+            events: false,
+        });
+        if (!response.ok) throw new Error('Ошибка загрузки календаря');
+        mergeChartData(JSON.parse(response.text).chartData);
+        return true;
+    } catch (error) {
+        console.error('Ошибка загрузки календаря:', error);
+        loadedMonths.delete(monthKey);
+        return false;
     }
 }
 
@@ -346,7 +499,14 @@ function getRegistrationDateKey() {
 }
 
 function renderCalendar(year, month) {
-    const datesWithEvents = getDatesWithEvents();
+    // Пока счётчики месяца грузятся, рисуем то, что уже есть, и перерисовываем после загрузки
+    loadMonthCounts(year, month).then(loaded => {
+        if (loaded && year === currentCalendarYear && month === currentCalendarMonth) drawCalendar(year, month);
+    });
+    drawCalendar(year, month);
+}
+
+function drawCalendar(year, month) {
     const registrationDateKey = getRegistrationDateKey();
     const firstDay = new Date(year, month, 1);
     const lastDay = new Date(year, month + 1, 0);
@@ -367,7 +527,7 @@ function renderCalendar(year, month) {
         cellDate.setHours(0, 0, 0, 0);
         const isPast = cellDate < today;
         const isBeforeRegistration = registrationDateKey && key < registrationDateKey;
-        const hasEvents = datesWithEvents.has(key);
+        const hasEvents = (dayCounts.get(key) || 0) > 0;
         let cls = 'calendar-day';
         if (isToday(year, month, day)) cls += ' today';
         if (isPast) cls += ' past';